@@ -39,6 +39,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django_q',
     'accounts',
     'segmentation',
 ]
@@ -130,4 +131,90 @@ STATIC_URL = "/static/"
 STATICFILES_DIRS = []
 
 MEDIA_URL = '/media/'
-MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
\ No newline at end of file
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+
+# Background jobs (django-q, ORM broker)
+# Run workers with: python manage.py qcluster
+
+Q_CLUSTER = {
+    'name': 'segmentation',
+    'workers': 2,
+    'timeout': 3600,
+    'retry': 3900,
+    'orm': 'default',
+}
+
+# Queue SAM embedding precompute for every uploaded batch
+SAM_PRECOMPUTE_ON_UPLOAD = False
+# SAM inference admission control (see segmentation.ai.sam)
+SAM_MAX_CONCURRENT_INFERENCES = 2
+SAM_TORCH_THREADS = None  # None: CPU count / concurrent inferences
+SAM_TORCH_INTEROP_THREADS = 1
+SAM_QUEUE_TIMEOUT_SECONDS = 10
+SAM_RETRY_AFTER_SECONDS = 2
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'segmentation': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
+
+# Largest image the tiled SAM reader will open (whole-slide / aerial
+# imagery); everything else keeps PIL's default decompression-bomb limit
+MAX_IMAGE_PIXELS = 2_000_000_000
+
+# Tiled SAM inference (see segmentation.ai.tiling)
+SAM_TILE_SIZE = 1024
+SAM_TILE_OVERLAP = 128
+SAM_TILED_MIN_PIXELS = 6000 * 6000
+# Largest region (viewport) one tiled request may cover
+SAM_TILED_MAX_REGION_PIXELS = 4096 * 4096
+
+# Send per-stage AI latencies in a Server-Timing response header
+SAM_SERVER_TIMING = False
+
+# Decoded RGB images kept in memory per process for the AI endpoints
+# and on-demand tiles (bytes). JPEGs decode faster with
+# `pip install simplejpeg` when available.
+DECODED_IMAGE_CACHE_BYTES = 64 * 1024 * 1024
+
+# Unix socket of `manage.py sam_server`. Web workers send AI requests
+# there and fall back to in-process inference when nothing listens.
+# None disables the server client entirely.
+SAM_SERVER_SOCKET = os.environ.get("SAM_SERVER_SOCKET", "/tmp/sam-inference.sock")
+
+# ZIP ingestion pool: worker count (None: min(8, CPUs)), members per
+# task, and "process" or "thread" workers
+INGEST_WORKERS = None
+INGEST_CHUNK_MEMBERS = 16
+INGEST_EXECUTOR = "process"
+
+# Image rows registered per duplicate lookup + bulk insert on upload
+IMAGE_BULK_BATCH_SIZE = 500
+
+# Largest archive accepted through resumable chunked uploads (bytes)
+CHUNKED_UPLOAD_MAX_BYTES = 20 * 1024 * 1024 * 1024
+# Unfinished chunked uploads idle for longer are aborted by gc_blobs
+CHUNKED_UPLOAD_EXPIRY_SECONDS = 7 * 24 * 3600
+
+# Preview pyramid built at ingest: longest side of each level (the
+# smallest is the list thumbnail), and worker threads (None: min(8, CPUs))
+PREVIEW_SIZES = (256, 1024, 2048)
+PREVIEW_WORKERS = None
+
+# Deep Zoom tiles for the annotation canvas: tile edge (256 or 512),
+# overlap in pixels, and the on-disk tile cache (None: MEDIA_ROOT/tiles)
+TILE_SIZE = 256
+TILE_OVERLAP = 1
+TILE_CACHE_ROOT = None
+
+# Content-addressed store for original images and their previews
+# (None: MEDIA_ROOT/blobs; must stay under MEDIA_ROOT, files are served
+# as media). `manage.py gc_blobs` frees files no image uses any more.
+BLOB_STORE_ROOT = None
@@ -0,0 +1,298 @@
+"""
+Inference backends for SAM on CPU.
+
+Every backend returns a regular `Sam` module whose image_encoder and
+mask_decoder may have been swapped for a faster implementation with
+the same call signature, so SamPredictor and the scheduler work
+unchanged:
+
+- eager:        fp32 PyTorch (reference)
+- int8:         dynamic int8 quantization of all nn.Linear layers
+- torchscript:  traced image encoder + mask decoder
+- onnx:         image encoder + mask decoder run by onnxruntime
+                (optional dependency: pip install onnxruntime)
+
+Exported artifacts live in SAM_EXPORT_DIR and are re-exported when
+the checkpoint is newer than them.
+
+Imports torch: only import this module from code paths that load the
+model (see segmentation.ai.sam.get_sam_model).
+"""
+import logging
+import os
+
+import torch
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ('eager', 'int8', 'torchscript', 'onnx')
+
+# Backends that only run on CPU
+CPU_ONLY_BACKENDS = ('int8', 'onnx')
+
+ONNX_OPSET = 17
+
+
+class BackendError(Exception):
+    pass
+
+
+def export_dir():
+    return getattr(
+        settings,
+        "SAM_EXPORT_DIR",
+        os.path.join(settings.BASE_DIR, "models", "exported")
+    )
+
+
+def apply_backend(model, backend, *, model_type, checkpoint):
+    """
+    Convert an eval-mode fp32 Sam model to `backend`.
+    Returns the model to use (may be the same object).
+    """
+    if backend not in BACKENDS:
+        raise BackendError(
+            f"Unknown SAM backend '{backend}', expected one of {', '.join(BACKENDS)}"
+        )
+
+    if backend == 'eager':
+        return model
+
+    if backend == 'int8':
+        return torch.ao.quantization.quantize_dynamic(
+            model,
+            {torch.nn.Linear},
+            dtype=torch.qint8
+        )
+
+    paths = export_model(model, backend, model_type=model_type, checkpoint=checkpoint)
+
+    if backend == 'torchscript':
+        img_size = model.image_encoder.img_size
+        model.image_encoder = TorchScriptImageEncoder(
+            torch.jit.load(paths["image_encoder"], map_location=model.device),
+            img_size
+        )
+        model.mask_decoder = MaskDecoderVariants(
+            torch.jit.load(paths["mask_decoder_single"], map_location=model.device),
+            torch.jit.load(paths["mask_decoder_multi"], map_location=model.device),
+        )
+        return model
+
+    img_size = model.image_encoder.img_size
+    model.image_encoder = OnnxImageEncoder(paths["image_encoder"], img_size)
+    model.mask_decoder = MaskDecoderVariants(
+        OnnxMaskDecoder(paths["mask_decoder_single"]),
+        OnnxMaskDecoder(paths["mask_decoder_multi"]),
+    )
+    return model
+
+
+# --------------------------------------------------
+# Export
+# --------------------------------------------------
+def artifact_paths(backend, model_type):
+    ext = 'onnx' if backend == 'onnx' else 'ts.pt'
+    base = os.path.join(export_dir(), f"{model_type}")
+    return {
+        "image_encoder": f"{base}_image_encoder.{ext}",
+        "mask_decoder_single": f"{base}_mask_decoder_single.{ext}",
+        "mask_decoder_multi": f"{base}_mask_decoder_multi.{ext}",
+    }
+
+
+def export_model(model, backend, *, model_type, checkpoint, force=False):
+    """
+    Export the encoder and both decoder variants for `backend` unless
+    up-to-date artifacts already exist. Returns the artifact paths.
+    """
+    paths = artifact_paths(backend, model_type)
+    checkpoint_mtime = os.path.getmtime(checkpoint) if os.path.exists(checkpoint) else 0
+
+    stale = force or any(
+        not os.path.exists(path) or os.path.getmtime(path) < checkpoint_mtime
+        for path in paths.values()
+    )
+    if not stale:
+        return paths
+
+    if backend == 'onnx':
+        _require_onnxruntime()
+
+    os.makedirs(export_dir(), exist_ok=True)
+    logger.info("Exporting SAM %s to %s", model_type, backend)
+
+    image_input, decoder_inputs = _example_inputs(model)
+    modules = {
+        "image_encoder": (model.image_encoder, (image_input,)),
+        "mask_decoder_single": (_DecoderExport(model.mask_decoder, False), decoder_inputs),
+        "mask_decoder_multi": (_DecoderExport(model.mask_decoder, True), decoder_inputs),
+    }
+
+    for name, (module, inputs) in modules.items():
+        tmp_path = f"{paths[name]}.{os.getpid()}.tmp"
+        if backend == 'onnx':
+            _export_onnx(name, module, inputs, tmp_path)
+        else:
+            _export_torchscript(module, inputs, tmp_path)
+        os.replace(tmp_path, paths[name])
+
+    return paths
+
+
+class _DecoderExport(torch.nn.Module):
+    """Fixes multimask_output so the decoder graph is a plain function."""
+
+    def __init__(self, mask_decoder, multimask_output):
+        super().__init__()
+        self.mask_decoder = mask_decoder
+        self.multimask_output = multimask_output
+
+    def forward(self, image_embeddings, image_pe, sparse, dense):
+        return self.mask_decoder(
+            image_embeddings=image_embeddings,
+            image_pe=image_pe,
+            sparse_prompt_embeddings=sparse,
+            dense_prompt_embeddings=dense,
+            multimask_output=self.multimask_output,
+        )
+
+
+def _example_inputs(model):
+    device = model.device
+    img_size = model.image_encoder.img_size
+    embed_dim = model.prompt_encoder.embed_dim
+    embed_h, embed_w = model.prompt_encoder.image_embedding_size
+
+    image = torch.zeros(1, 3, img_size, img_size, device=device)
+    decoder_inputs = (
+        torch.zeros(1, embed_dim, embed_h, embed_w, device=device),
+        model.prompt_encoder.get_dense_pe(),
+        torch.zeros(1, 3, embed_dim, device=device),
+        torch.zeros(1, embed_dim, embed_h, embed_w, device=device),
+    )
+    return image, decoder_inputs
+
+
+def _export_torchscript(module, inputs, path):
+    with torch.inference_mode():
+        traced = torch.jit.trace(module, inputs, check_trace=False)
+    traced.save(path)
+
+
+def _export_onnx(name, module, inputs, path):
+    if name == "image_encoder":
+        input_names = ["image"]
+        output_names = ["image_embeddings"]
+        dynamic_axes = {"image": {0: "batch"}, "image_embeddings": {0: "batch"}}
+    else:
+        input_names = ["image_embeddings", "image_pe", "sparse", "dense"]
+        output_names = ["masks", "iou_predictions"]
+        dynamic_axes = {
+            "sparse": {0: "prompts", 1: "tokens"},
+            "dense": {0: "prompts"},
+            "masks": {0: "prompts"},
+            "iou_predictions": {0: "prompts"},
+        }
+
+    with torch.no_grad():
+        torch.onnx.export(
+            module,
+            inputs,
+            path,
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=ONNX_OPSET,
+            dynamo=False,
+        )
+
+
+def _require_onnxruntime():
+    try:
+        import onnxruntime  # noqa: F401
+    except ImportError:
+        raise BackendError(
+            "The onnx SAM backend needs onnxruntime (pip install onnxruntime onnx)"
+        )
+
+
+# --------------------------------------------------
+# Drop-in modules
+# --------------------------------------------------
+class TorchScriptImageEncoder(torch.nn.Module):
+    def __init__(self, scripted, img_size):
+        super().__init__()
+        self.scripted = scripted
+        self.img_size = img_size
+
+    def forward(self, x):
+        return self.scripted(x)
+
+
+class OnnxImageEncoder(torch.nn.Module):
+    def __init__(self, path, img_size):
+        super().__init__()
+        self.session = _onnx_session(path)
+        self.img_size = img_size
+
+    def forward(self, x):
+        out = self.session.run(None, {"image": x.detach().cpu().numpy()})[0]
+        return torch.from_numpy(out).to(x.device)
+
+
+class OnnxMaskDecoder:
+    def __init__(self, path):
+        self.session = _onnx_session(path)
+
+    def __call__(self, image_embeddings, image_pe, sparse, dense):
+        masks, iou = self.session.run(None, {
+            "image_embeddings": image_embeddings.detach().cpu().numpy(),
+            "image_pe": image_pe.detach().cpu().numpy(),
+            "sparse": sparse.detach().cpu().numpy(),
+            "dense": dense.detach().cpu().numpy(),
+        })
+        device = image_embeddings.device
+        return torch.from_numpy(masks).to(device), torch.from_numpy(iou).to(device)
+
+
+class MaskDecoderVariants(torch.nn.Module):
+    """
+    Same call signature as segment_anything's MaskDecoder, dispatching
+    to the exported single- or multi-mask graph.
+    """
+
+    def __init__(self, single, multi):
+        super().__init__()
+        self.single = single
+        self.multi = multi
+
+    def forward(
+        self,
+        image_embeddings,
+        image_pe,
+        sparse_prompt_embeddings,
+        dense_prompt_embeddings,
+        multimask_output,
+    ):
+        decoder = self.multi if multimask_output else self.single
+        return decoder(
+            image_embeddings,
+            image_pe,
+            sparse_prompt_embeddings.contiguous(),
+            dense_prompt_embeddings.contiguous(),
+        )
+
+
+def _onnx_session(path):
+    _require_onnxruntime()
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return onnxruntime.InferenceSession(
+        path,
+        sess_options=options,
+        providers=["CPUExecutionProvider"]
+    )
@@ -0,0 +1,438 @@
+"""
+Benchmark of the SAM inference path, driven by `manage.py sam_benchmark`.
+
+Synthetic JPEGs of several sizes go through the same code the AI
+endpoints run (decode, scheduler, encoder, decoder, mask encoding) on a
+private scheduler and a throwaway embedding cache. Every stage reported
+by segmentation.utils.metrics gets latency percentiles and the peak
+RSS growth seen while it ran; bursts of concurrent jobs give
+throughput. With tiny=True a small randomly initialised SAM replaces
+the checkpoint so the suite runs on CPU-only CI.
+"""
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import wait
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+from segmentation.ai import sam
+from segmentation.ai.embedding_cache import EmbeddingCache
+from segmentation.ai.image_io import inference_max_side, read_rgb
+from segmentation.ai.inference import predict_from_prompts, predict_full_image
+from segmentation.ai.scheduler import InferenceScheduler
+from segmentation.utils.masks import MASK_FORMAT_PNG, encode_mask
+from segmentation.utils.metrics import StageTimings, activate, peak_rss_kb, stage
+
+DEFAULT_SIZES = ((640, 480), (1920, 1080), (4000, 3000))
+
+# RSS sampling period while a stage runs
+MEMORY_SAMPLE_SECONDS = 0.001
+
+SCENARIOS = ("presegment_cold", "prompt_warm")
+
+
+def build_tiny_sam(seed=0):
+    """
+    A SAM with the real architecture but a 2-block, 64-dim image
+    encoder and random weights: same code path, ~1/100 the compute.
+    """
+    from functools import partial
+
+    import torch
+    from segment_anything.modeling import (
+        ImageEncoderViT,
+        MaskDecoder,
+        PromptEncoder,
+        Sam,
+        TwoWayTransformer,
+    )
+
+    torch.manual_seed(seed)
+
+    encoder = ImageEncoderViT(
+        depth=2,
+        embed_dim=64,
+        img_size=1024,
+        mlp_ratio=2,
+        norm_layer=partial(torch.nn.LayerNorm, eps=1e-6),
+        num_heads=2,
+        patch_size=16,
+        qkv_bias=True,
+        use_rel_pos=True,
+        global_attn_indexes=[1],
+        window_size=14,
+        out_chans=256,
+    )
+    model = Sam(
+        image_encoder=encoder,
+        prompt_encoder=PromptEncoder(
+            embed_dim=256,
+            image_embedding_size=(64, 64),
+            input_image_size=(1024, 1024),
+            mask_in_chans=16,
+        ),
+        mask_decoder=MaskDecoder(
+            num_multimask_outputs=3,
+            transformer=TwoWayTransformer(
+                depth=2, embedding_dim=256, mlp_dim=2048, num_heads=8
+            ),
+            transformer_dim=256,
+            iou_head_depth=3,
+            iou_head_hidden_dim=256,
+        ),
+        pixel_mean=[123.675, 116.28, 103.53],
+        pixel_std=[58.395, 57.12, 57.375],
+    )
+    return model.eval()
+
+
+def write_synthetic_jpeg(directory, width, height, seed=0):
+    """Smooth random blobs (compresses and segments like a photo)."""
+    rng = np.random.default_rng(seed)
+    noise = rng.integers(0, 255, (max(2, height // 32), max(2, width // 32), 3), dtype=np.uint8)
+    image = cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC)
+
+    path = os.path.join(directory, f"synthetic_{width}x{height}_{seed}.jpg")
+    cv2.imwrite(path, image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return path
+
+
+def parse_size(value):
+    """ "1920x1080" -> (1920, 1080) """
+    try:
+        width, height = (int(v) for v in value.lower().split("x"))
+    except ValueError:
+        raise ValueError(f"Size must be WIDTHxHEIGHT: {value}")
+    if width <= 0 or height <= 0:
+        raise ValueError(f"Size must be positive: {value}")
+    return width, height
+
+
+# --------------------------------------------------
+# Memory
+# --------------------------------------------------
+def current_rss_bytes():
+    """Resident set size from /proc; None where that is unavailable."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class RssSampler:
+    """Background thread tracking the RSS high-water mark between reads."""
+
+    def __init__(self, interval=MEMORY_SAMPLE_SECONDS):
+        self.interval = interval
+        self.available = current_rss_bytes() is not None
+
+        self._lock = threading.Lock()
+        self._peak = current_rss_bytes() or 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if self.available:
+            self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def take_peak(self):
+        """(peak RSS since the previous call, RSS now), restarting from now."""
+        now = current_rss_bytes() or 0
+        with self._lock:
+            peak, self._peak = max(self._peak, now), now
+        return peak, now
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            rss = current_rss_bytes() or 0
+            with self._lock:
+                if rss > self._peak:
+                    self._peak = rss
+
+
+class MemoryStageTimings(StageTimings):
+    """
+    StageTimings that also keeps, per stage, how far RSS rose above
+    its level when the stage started. Stages end one after another in
+    a sequential run, so the previous stage's end is this one's start.
+    "total" encloses every stage and is measured from the iteration's
+    start.
+    """
+
+    def __init__(self, sampler):
+        super().__init__()
+        self.sampler = sampler
+        _, self.baseline = sampler.take_peak()
+        self.peak_bytes = {}
+        self._stage_start = self.baseline
+        self._iteration_peak = self.baseline
+
+    def add(self, name, ms):
+        super().add(name, ms)
+        if not self.sampler.available:
+            return
+
+        peak, now = self.sampler.take_peak()
+        with self._lock:
+            self._iteration_peak = max(self._iteration_peak, peak)
+            if name == "total":
+                growth = self._iteration_peak - self.baseline
+            else:
+                growth = max(0, peak - self._stage_start)
+            self._stage_start = now
+            self.peak_bytes[name] = max(self.peak_bytes.get(name, 0), growth)
+
+
+# --------------------------------------------------
+# Scenarios
+# --------------------------------------------------
+def _presegment_job(path, size):
+    width, height = size
+
+    def load_image():
+        return read_rgb(path, inference_max_side())
+
+    def run(predictor):
+        mask = predict_full_image(predictor, (height, width))
+        encode_mask(mask, MASK_FORMAT_PNG)
+        return mask
+
+    # A fresh key every time: the encoder always runs
+    return f"benchmark-{uuid.uuid4().hex}", load_image, run
+
+
+def _prompt_job(path, size, image_key):
+    width, height = size
+    rng = np.random.default_rng()
+
+    def load_image():
+        return read_rgb(path, inference_max_side())
+
+    def run(predictor):
+        point = rng.uniform((0, 0), (width, height)).astype(np.float32).reshape(1, 2)
+        mask, _, _ = predict_from_prompts(
+            predictor,
+            points=point,
+            labels=np.array([1]),
+            target_size=(height, width)
+        )
+        encode_mask(mask, MASK_FORMAT_PNG)
+        return mask
+
+    return image_key, load_image, run
+
+
+def _make_job(scenario, path, size, warm_key):
+    if scenario == "presegment_cold":
+        return _presegment_job(path, size)
+    return _prompt_job(path, size, warm_key)
+
+
+def _summarize(samples_ms, peak_bytes):
+    stages = {}
+    for name, samples in samples_ms.items():
+        values = np.asarray(samples)
+        stages[name] = {
+            "p50": round(float(np.percentile(values, 50)), 2),
+            "p95": round(float(np.percentile(values, 95)), 2),
+            "mean": round(float(values.mean()), 2),
+            "min": round(float(values.min()), 2),
+            "max": round(float(values.max()), 2),
+            "peak_memory_mb": (
+                round(peak_bytes[name] / 2 ** 20, 1) if name in peak_bytes else None
+            ),
+        }
+    return stages
+
+
+def _measure_latency(scheduler, sampler, scenario, path, size, warm_key, iterations, warmup):
+    samples_ms = {}
+    peak_bytes = {}
+
+    if scenario == "prompt_warm":
+        # Encode once so every measured prompt hits the cache
+        scheduler.run(*_make_job(scenario, path, size, warm_key))
+
+    for i in range(warmup + iterations):
+        timings = MemoryStageTimings(sampler)
+        image_key, load_image, run = _make_job(scenario, path, size, warm_key)
+
+        with activate(timings), stage("total"):
+            scheduler.run(image_key, load_image, run)
+
+        if i < warmup:
+            continue
+        for name, ms in timings.stages.items():
+            samples_ms.setdefault(name, []).append(ms)
+        for name, nbytes in timings.peak_bytes.items():
+            peak_bytes[name] = max(peak_bytes.get(name, 0), nbytes)
+
+    return _summarize(samples_ms, peak_bytes)
+
+
+def _measure_throughput(scheduler, scenario, path, size, warm_key, jobs):
+    start = time.perf_counter()
+    futures = [
+        scheduler.submit(*_make_job(scenario, path, size, warm_key))
+        for _ in range(jobs)
+    ]
+    wait(futures)
+    seconds = time.perf_counter() - start
+
+    failed = sum(1 for future in futures if future.exception() is not None)
+    return {
+        "jobs": jobs,
+        "failed": failed,
+        "seconds": round(seconds, 3),
+        "per_second": round((jobs - failed) / seconds, 2) if seconds else None,
+    }
+
+
+# --------------------------------------------------
+# Suite
+# --------------------------------------------------
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+            timeout=5,
+            check=True
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_benchmark(
+    *,
+    sizes=DEFAULT_SIZES,
+    scenarios=SCENARIOS,
+    iterations=10,
+    warmup=2,
+    burst=8,
+    workers=None,
+    tiny=False,
+    progress=None
+):
+    """
+    Returns a JSON-serialisable dict: run metadata plus, per scenario
+    and image size, stage latencies / peak memory and burst throughput.
+    """
+    import torch
+
+    start = time.perf_counter()
+    if tiny:
+        sam.use_model(build_tiny_sam())
+    sam.get_sam_model()
+    model_seconds = time.perf_counter() - start
+
+    workers = workers or sam.MAX_CONCURRENT_INFERENCES
+
+    with tempfile.TemporaryDirectory(prefix="sam-benchmark-") as workdir:
+        # Keep benchmark embeddings out of the real cache
+        real_cache = sam.embedding_cache
+        sam.embedding_cache = EmbeddingCache(
+            namespace="benchmark",
+            memory_bytes=real_cache.memory_bytes,
+            disk_dir=workdir,
+            disk_bytes=real_cache.disk_bytes,
+        )
+        scheduler = InferenceScheduler(
+            workers=workers,
+            max_queue_depth=max(burst, 1) + 1,
+            max_batch_size=getattr(settings, "SAM_MAX_BATCH_SIZE", 2),
+            max_wait_ms=getattr(settings, "SAM_BATCH_WAIT_MS", 15),
+        )
+
+        results = []
+        try:
+            with RssSampler() as sampler:
+                for width, height in sizes:
+                    path = write_synthetic_jpeg(workdir, width, height)
+                    warm_key = f"benchmark-warm-{width}x{height}"
+
+                    for scenario in scenarios:
+                        if progress:
+                            progress(f"{scenario} {width}x{height}")
+
+                        stages = _measure_latency(
+                            scheduler, sampler, scenario, path, (width, height),
+                            warm_key, iterations, warmup
+                        )
+                        throughput = (
+                            _measure_throughput(
+                                scheduler, scenario, path, (width, height), warm_key, burst
+                            ) if burst else None
+                        )
+                        results.append({
+                            "scenario": scenario,
+                            "size": f"{width}x{height}",
+                            "iterations": iterations,
+                            "stages_ms": stages,
+                            "throughput": throughput,
+                        })
+        finally:
+            scheduler.shutdown()
+            sam.embedding_cache = real_cache
+
+    status = sam.model_status()
+    peak_kb = peak_rss_kb()
+    return {
+        "meta": {
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "model": "tiny" if tiny else status["model_type"],
+            "backend": status["backend"],
+            "device": status["device"],
+            "model_load_seconds": round(model_seconds, 2),
+            "workers": workers,
+            "inference_max_side": inference_max_side(),
+            "torch_version": torch.__version__,
+            "torch_threads": torch.get_num_threads(),
+            "cpu_count": os.cpu_count(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "peak_rss_mb": round(peak_kb / 1024, 1) if peak_kb is not None else None,
+        },
+        "results": results,
+    }
+
+
+def compare(current, baseline, stage_name="total"):
+    """
+    (scenario, size, baseline p50, current p50, ratio) for every
+    result present in both runs.
+    """
+    previous = {
+        (result["scenario"], result["size"]): result
+        for result in baseline.get("results", [])
+    }
+
+    rows = []
+    for result in current["results"]:
+        before = previous.get((result["scenario"], result["size"]))
+        if before is None:
+            continue
+        old = before["stages_ms"].get(stage_name, {}).get("p50")
+        new = result["stages_ms"].get(stage_name, {}).get("p50")
+        if old is None or new is None:
+            continue
+        rows.append((result["scenario"], result["size"], old, new, round(new / old, 3) if old else None))
+    return rows
@@ -0,0 +1,275 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+
+import numpy as np
+from django.conf import settings
+
+# Memory tier: ~2 MB per vit_b embedding in float16 -> ~128 images
+DEFAULT_MEMORY_BYTES = 256 * 1024 * 1024
+
+# Disk tier: ~5000 images
+DEFAULT_DISK_BYTES = 10 * 1024 * 1024 * 1024
+
+# When the disk tier is over its cap, evict down to this fraction of it
+DISK_EVICTION_TARGET = 0.9
+
+
+class ImageEmbedding(NamedTuple):
+    """
+    SAM image-encoder output for a single image.
+
+    features is the (1, 256, 64, 64) encoder output stored as float16;
+    original_size / input_size are the (h, w) pairs SamPredictor uses
+    to map prompts and masks between image and model space.
+    """
+    features: np.ndarray
+    original_size: tuple
+    input_size: tuple
+
+    @property
+    def nbytes(self):
+        return self.features.nbytes
+
+
+class EmbeddingCache:
+    """
+    Two-tier cache of SAM image embeddings keyed by Image.checksum.
+
+    - memory: LRU bounded by total bytes, shared by all threads
+    - disk:   one .npz per image under MEDIA_ROOT, shared by all
+              processes, evicted least-recently-used first
+
+    A memory miss falls through to disk and promotes the entry.
+    """
+
+    def __init__(self, *, namespace, memory_bytes, disk_dir, disk_bytes):
+        self.namespace = namespace
+        self.memory_bytes = memory_bytes
+        self.disk_dir = os.path.join(disk_dir, namespace)
+        self.disk_bytes = disk_bytes
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._disk_used = None  # computed lazily on first write
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.memory_evictions = 0
+        self.disk_evictions = 0
+
+    # --------------------------------------------------
+    # Public API
+    # --------------------------------------------------
+    def get(self, key):
+        with self._lock:
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return embedding
+
+        embedding = self._read_disk(key)
+
+        with self._lock:
+            if embedding is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, embedding)
+
+        return embedding
+
+    def put(self, key, embedding):
+        embedding = embedding._replace(
+            features=np.ascontiguousarray(embedding.features, dtype=np.float16)
+        )
+
+        with self._lock:
+            self._remember(key, embedding)
+
+        self._write_disk(key, embedding)
+
+    def contains(self, key):
+        """Cheap presence check that does not load or count a hit."""
+        with self._lock:
+            if key in self._memory:
+                return True
+        return os.path.exists(self._disk_path(key))
+
+    def clear_memory(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_used = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "namespace": self.namespace,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(
+                    (self.memory_hits + self.disk_hits) / lookups, 4
+                ) if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_used,
+                "memory_limit_bytes": self.memory_bytes,
+                "memory_evictions": self.memory_evictions,
+                "disk_bytes": self._disk_used,
+                "disk_limit_bytes": self.disk_bytes,
+                "disk_evictions": self.disk_evictions,
+            }
+
+    # --------------------------------------------------
+    # Memory tier (caller holds self._lock)
+    # --------------------------------------------------
+    def _remember(self, key, embedding):
+        if embedding.nbytes > self.memory_bytes:
+            return
+
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_used -= previous.nbytes
+
+        self._memory[key] = embedding
+        self._memory_used += embedding.nbytes
+
+        while self._memory_used > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_used -= evicted.nbytes
+            self.memory_evictions += 1
+
+    # --------------------------------------------------
+    # Disk tier
+    # --------------------------------------------------
+    def _disk_path(self, key):
+        safe_key = re.sub(r'[^A-Za-z0-9_.-]', '_', key)
+        return os.path.join(self.disk_dir, safe_key[:2], f"{safe_key}.npz")
+
+    def _read_disk(self, key):
+        path = self._disk_path(key)
+
+        try:
+            with np.load(path) as data:
+                embedding = ImageEmbedding(
+                    features=data["features"],
+                    original_size=tuple(int(v) for v in data["original_size"]),
+                    input_size=tuple(int(v) for v in data["input_size"]),
+                )
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # Truncated / corrupted entry: drop it and treat as a miss
+            self._remove_file(path)
+            return None
+
+        # Touch so disk eviction is least-recently-used, not oldest-written
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return embedding
+
+    def _write_disk(self, key, embedding):
+        if self.disk_bytes <= 0:
+            return
+
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write-then-rename so readers in other processes never
+        # see a partially written file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                features=embedding.features,
+                original_size=np.array(embedding.original_size),
+                input_size=np.array(embedding.input_size),
+            )
+
+        # An entry being rewritten only adds the difference
+        try:
+            replaced = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmp_path, path)
+
+        size = os.path.getsize(path)
+
+        with self._lock:
+            if self._disk_used is None:
+                self._disk_used = self._scan_disk_usage()
+            else:
+                self._disk_used += size - replaced
+            over_limit = self._disk_used > self.disk_bytes
+
+        if over_limit:
+            self._evict_disk()
+
+    def _scan_disk_usage(self):
+        return sum(size for _, size, _ in self._iter_disk_entries())
+
+    def _iter_disk_entries(self):
+        if not os.path.isdir(self.disk_dir):
+            return
+        for shard in os.scandir(self.disk_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if not entry.name.endswith(".npz"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    def _evict_disk(self):
+        entries = sorted(self._iter_disk_entries(), key=lambda e: e[2])
+        used = sum(size for _, size, _ in entries)
+        target = self.disk_bytes * DISK_EVICTION_TARGET
+        evicted = 0
+
+        for path, size, _ in entries:
+            if used <= target:
+                break
+            if self._remove_file(path):
+                used -= size
+                evicted += 1
+
+        with self._lock:
+            self._disk_used = used
+            self.disk_evictions += evicted
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+
+def build_embedding_cache(namespace):
+    return EmbeddingCache(
+        namespace=namespace,
+        memory_bytes=getattr(
+            settings, "SAM_EMBEDDING_CACHE_MEMORY_BYTES", DEFAULT_MEMORY_BYTES
+        ),
+        disk_dir=getattr(
+            settings,
+            "SAM_EMBEDDING_CACHE_DIR",
+            os.path.join(settings.MEDIA_ROOT, "cache", "sam_embeddings"),
+        ),
+        disk_bytes=getattr(
+            settings, "SAM_EMBEDDING_CACHE_DISK_BYTES", DEFAULT_DISK_BYTES
+        ),
+    )
@@ -0,0 +1,242 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from django.conf import settings
+from PIL import Image as PILImage, ImageOps
+
+from segmentation.utils.metrics import stage
+
+# Optional: libjpeg-turbo decoder, faster than PIL / cv2 for JPEG
+# (pip install simplejpeg)
+try:
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+# Long-side size images are decoded at for SAM. SAM resizes to 1024
+# internally, so decoding any larger only costs time and memory.
+# None decodes at full resolution.
+DEFAULT_INFERENCE_MAX_SIDE = 1024
+
+
+def inference_max_side():
+    return getattr(settings, "SAM_INFERENCE_MAX_SIDE", DEFAULT_INFERENCE_MAX_SIDE)
+
+
+def read_rgb(file_path, max_side=None):
+    """
+    Decode an image file into an RGB uint8 ndarray for SAM.
+
+    With max_side, JPEGs are decoded directly at a reduced scale
+    (libjpeg DCT scaling via PIL draft mode: 1/2, 1/4 or 1/8, never
+    below max_side) and the result is then area-resized so its long
+    side is at most max_side. Other formats are decoded in full and
+    resized. EXIF orientation is applied, as cv2.imread does.
+
+    JPEGs go through simplejpeg when it is installed.
+    """
+    if simplejpeg is not None:
+        image = _read_jpeg_fast(file_path, max_side)
+        if image is not None:
+            if max_side:
+                with stage("resize"):
+                    return fit_long_side(image, max_side)
+            return image
+
+    if not max_side:
+        with stage("imread"):
+            image = cv2.imread(file_path)
+        if image is None:
+            raise ValueError(f"Unreadable image file: {file_path}")
+        with stage("cvtcolor"):
+            return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    try:
+        with PILImage.open(file_path) as img:
+            with stage("imread"):
+                if img.format == 'JPEG':
+                    w, h = img.size
+                    scale = min(1.0, max_side / max(w, h))
+                    img.draft('RGB', (round(w * scale), round(h * scale)))
+                img.load()
+            with stage("cvtcolor"):
+                img = ImageOps.exif_transpose(img)
+                image = np.asarray(img.convert('RGB'))
+    except (OSError, SyntaxError) as e:
+        raise ValueError(f"Unreadable image file: {file_path}") from e
+
+    with stage("resize"):
+        return fit_long_side(image, max_side)
+
+
+def fit_long_side(image, max_side):
+    h, w = image.shape[:2]
+    scale = max_side / max(h, w)
+    if scale >= 1:
+        return image
+
+    size = (max(1, round(w * scale)), max(1, round(h * scale)))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+# --------------------------------------------------
+# Fast JPEG path
+# --------------------------------------------------
+# EXIF orientation -> ndarray transform, same result as exif_transpose
+_ORIENTATION_TRANSFORMS = {
+    2: lambda a: a[:, ::-1],
+    3: lambda a: a[::-1, ::-1],
+    4: lambda a: a[::-1],
+    5: lambda a: a.swapaxes(0, 1),
+    6: lambda a: np.rot90(a, -1),
+    7: lambda a: np.rot90(a, 2).swapaxes(0, 1),
+    8: lambda a: np.rot90(a),
+}
+
+
+def _read_jpeg_fast(file_path, max_side):
+    """
+    Decode with simplejpeg (DCT-scaled when max_side is set).
+    Returns None for non-JPEG files or JPEGs it cannot handle (CMYK,
+    corrupt), so the caller falls back to PIL / cv2.
+    """
+    with stage("imread"):
+        with open(file_path, 'rb') as f:
+            data = f.read()
+
+        if not simplejpeg.is_jpeg(data):
+            return None
+
+        try:
+            h, w, _, _ = simplejpeg.decode_jpeg_header(data)
+            scale = min(1.0, max_side / max(w, h)) if max_side else 1.0
+            image = simplejpeg.decode_jpeg(
+                data,
+                colorspace='RGB',
+                min_height=round(h * scale),
+                min_width=round(w * scale)
+            )
+        except ValueError:
+            return None
+
+    with stage("cvtcolor"):
+        with PILImage.open(io.BytesIO(data)) as img:
+            orientation = img.getexif().get(0x0112, 1)
+
+        transform = _ORIENTATION_TRANSFORMS.get(orientation)
+        if transform is not None:
+            image = np.ascontiguousarray(transform(image))
+
+    return image
+
+
+# --------------------------------------------------
+# Decoded-image cache
+# --------------------------------------------------
+# Decoded RGB pixels: ~3 MB per 1024px image -> ~20 images, per
+# process (every web and q worker holds its own)
+DEFAULT_DECODED_CACHE_BYTES = 64 * 1024 * 1024
+
+
+class DecodedImageCache:
+    """
+    LRU of decoded images bounded by total bytes, shared by all
+    threads. Keys are (file path, mtime, max_side): a replaced file is
+    never served stale, and Image rows sharing a blob share one entry.
+    Arrays are read-only: callers share one buffer and must copy
+    before modifying it.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._used = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_load(self, key, load):
+        with self._lock:
+            image = self._entries.get(key)
+            if image is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return image
+            self.misses += 1
+
+        image = load()
+        image.setflags(write=False)
+
+        with self._lock:
+            self._remember(key, image)
+
+        return image
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._used = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._used,
+                "limit_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "fast_jpeg": simplejpeg is not None,
+            }
+
+    def _remember(self, key, image):
+        if image.nbytes > self.max_bytes:
+            return
+
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._used -= previous.nbytes
+
+        self._entries[key] = image
+        self._used += image.nbytes
+
+        while self._used > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._used -= evicted.nbytes
+            self.evictions += 1
+
+
+decoded_cache = DecodedImageCache(
+    getattr(settings, "DECODED_IMAGE_CACHE_BYTES", DEFAULT_DECODED_CACHE_BYTES)
+)
+
+
+def read_file_rgb(file_path, max_side=None):
+    """
+    read_rgb() through decoded_cache, for readers that come back to
+    the same file (AI requests, on-demand tiles). One-pass jobs call
+    read_rgb() directly so they do not flush the cache. Read-only.
+    """
+    try:
+        mtime = os.stat(file_path).st_mtime_ns
+    except OSError as e:
+        raise ValueError(f"Unreadable image file: {file_path}") from e
+
+    return decoded_cache.get_or_load(
+        (file_path, mtime, max_side),
+        lambda: read_rgb(file_path, max_side)
+    )
+
+
+def read_image_rgb(image, max_side=None):
+    """Decoded RGB pixels of an Image row, via decoded_cache. Read-only."""
+    return read_file_rgb(image.file_path, max_side)
@@ -0,0 +1,176 @@
+import cv2
+import numpy as np
+
+from segmentation.utils.metrics import stage
+
+# SAM's mask decoder works on 256x256 low-resolution logits
+LOW_RES_MASK_SIZE = 256
+
+
+def predict_full_image(predictor, target_size=None):
+    """
+    Pre-segmentation with a box prompt covering the whole image.
+
+    target_size is the (h, w) of the original image when the embedding
+    was computed from a reduced decode; the mask is returned at that
+    size. Returns a bool mask.
+    """
+    h, w = predictor.original_size
+    input_box = np.array([0, 0, w, h])
+
+    with stage("predict"):
+        logits, scores, _ = predictor.predict(
+            box=input_box,
+            multimask_output=False,
+            return_logits=True
+        )
+
+    with stage("upsample"):
+        return logits_to_mask(
+            logits[0],
+            output_size(predictor, target_size),
+            predictor.model.mask_threshold
+        )
+
+
+def predict_from_prompts(
+    predictor,
+    *,
+    points=None,
+    labels=None,
+    boxes=None,
+    mask_input=None,
+    multimask_output=False,
+    target_size=None
+):
+    """
+    Run only the prompt encoder + mask decoder against the embedding
+    already set on `predictor` (no image encoder pass).
+
+    Args:
+        points:      (N, 2) array of x, y in image coordinates
+        labels:      (N,) array, 1 = foreground, 0 = background
+        boxes:       (B, 4) array of x0, y0, x1, y1
+        mask_input:  (1, 256, 256) low-res logits from a previous call
+        multimask_output: return the best of SAM's 3 candidate masks
+        target_size: (h, w) of the original image, see predict_full_image
+
+    With more than one box every box is decoded in one batch (sharing
+    the points) and the resulting masks are merged; no low-res logits
+    are returned in that case.
+
+    Returns:
+        (mask, score, low_res_logits or None)
+    """
+    size = output_size(predictor, target_size)
+    points, boxes = scale_prompts(predictor, size, points, boxes)
+
+    if boxes is not None and len(boxes) > 1:
+        return _predict_multi_box(
+            predictor, points, labels, boxes, multimask_output, size
+        )
+
+    with stage("predict"):
+        logits, scores, low_res = predictor.predict(
+            point_coords=points,
+            point_labels=labels,
+            box=boxes[0] if boxes is not None else None,
+            mask_input=mask_input,
+            multimask_output=multimask_output,
+            return_logits=True
+        )
+
+    best = int(np.argmax(scores))
+    with stage("upsample"):
+        mask = logits_to_mask(logits[best], size, predictor.model.mask_threshold)
+    return mask, float(scores[best]), low_res[best:best + 1]
+
+
+def _predict_multi_box(predictor, points, labels, boxes, multimask_output, size):
+    import torch
+
+    device = predictor.device
+    box_count = len(boxes)
+
+    boxes_torch = predictor.transform.apply_boxes_torch(
+        torch.as_tensor(boxes, dtype=torch.float, device=device),
+        predictor.original_size
+    )
+
+    coords_torch = labels_torch = None
+    if points is not None:
+        coords = predictor.transform.apply_coords(points, predictor.original_size)
+        coords_torch = torch.as_tensor(coords, dtype=torch.float, device=device)
+        coords_torch = coords_torch[None].expand(box_count, -1, -1)
+        labels_torch = torch.as_tensor(labels, dtype=torch.int, device=device)
+        labels_torch = labels_torch[None].expand(box_count, -1)
+
+    with stage("predict"):
+        logits, scores, _ = predictor.predict_torch(
+            coords_torch,
+            labels_torch,
+            boxes=boxes_torch,
+            multimask_output=multimask_output,
+            return_logits=True
+        )
+
+    best = scores.argmax(dim=1)
+    index = torch.arange(box_count, device=device)
+    best_scores = scores[index, best]
+
+    # Union of the per-box masks == threshold on the per-pixel max logit
+    with stage("upsample"):
+        merged = logits[index, best].amax(dim=0).cpu().numpy()
+        mask = logits_to_mask(merged, size, predictor.model.mask_threshold)
+    return mask, float(best_scores.mean()), None
+
+
+# --------------------------------------------------
+# Reduced-resolution helpers
+# --------------------------------------------------
+def output_size(predictor, target_size):
+    """
+    (h, w) masks should be returned at. Falls back to the size the
+    embedding was computed at; a target whose orientation disagrees
+    with the decoded image (EXIF rotation) is swapped.
+    """
+    model_h, model_w = predictor.original_size
+    if not target_size:
+        return model_h, model_w
+
+    h, w = target_size
+    if (h > w) != (model_h > model_w) and h != w and model_h != model_w:
+        h, w = w, h
+    return h, w
+
+
+def scale_prompts(predictor, size, points, boxes):
+    """Map prompts from original-image to embedding coordinates."""
+    model_h, model_w = predictor.original_size
+    h, w = size
+    if (h, w) == (model_h, model_w):
+        return points, boxes
+
+    sx = model_w / w
+    sy = model_h / h
+
+    if points is not None:
+        points = points * np.array([sx, sy], dtype=np.float32)
+    if boxes is not None:
+        boxes = boxes * np.array([sx, sy, sx, sy], dtype=np.float32)
+    return points, boxes
+
+
+def logits_to_mask(logits, size, threshold=0.0):
+    """
+    Upsample mask logits to `size` (h, w) and threshold. Interpolating
+    logits rather than the binary mask keeps edges smooth.
+    """
+    h, w = size
+    if logits.shape != (h, w):
+        logits = cv2.resize(
+            np.ascontiguousarray(logits, dtype=np.float32),
+            (w, h),
+            interpolation=cv2.INTER_LINEAR
+        )
+    return logits > threshold
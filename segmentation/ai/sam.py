@@ -1,18 +1,314 @@
-import torch
+import logging
 import os
+import threading
+import time
+from contextlib import contextmanager
 from django.conf import settings
-from segment_anything import sam_model_registry, SamPredictor
 
-MODEL_TYPE = "vit_b"
-SAM_CHECKPOINT = os.path.join(
-    settings.BASE_DIR,
-    "models",
-    "sam_vit_b_01ec64.pth"
+from segmentation.ai.embedding_cache import ImageEmbedding, build_embedding_cache
+
+logger = logging.getLogger(__name__)
+
+MODEL_TYPE = getattr(settings, "SAM_MODEL_TYPE", "vit_b")
+SAM_CHECKPOINT = getattr(
+    settings,
+    "SAM_CHECKPOINT",
+    os.path.join(
+        settings.BASE_DIR,
+        "models",
+        "sam_vit_b_01ec64.pth"
+    )
+)
+
+# eager | int8 | torchscript | onnx, see segmentation.ai.backends
+SAM_BACKEND = getattr(settings, "SAM_BACKEND", "eager")
+
+# Embeddings depend on the encoder weights, so namespace them by model;
+# int8 embeddings differ from fp32 ones and are kept apart as well
+embedding_cache = build_embedding_cache(
+    f"{MODEL_TYPE}-int8" if SAM_BACKEND == "int8" else MODEL_TYPE
 )
 
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+# --------------------------------------------------
+# Admission control
+#
+# At most SAM_MAX_CONCURRENT_INFERENCES forward passes run at once in
+# this process, each on a torch pool of SAM_TORCH_THREADS threads, so
+# concurrent requests share the cores instead of oversubscribing them.
+# Requests that wait longer than SAM_QUEUE_TIMEOUT_SECONDS for a slot
+# are turned away with a Retry-After hint.
+# --------------------------------------------------
+MAX_CONCURRENT_INFERENCES = max(
+    1, getattr(settings, "SAM_MAX_CONCURRENT_INFERENCES", 2)
+)
+
+# None: split the cores evenly between concurrent inferences
+TORCH_THREADS = getattr(settings, "SAM_TORCH_THREADS", None)
+TORCH_INTEROP_THREADS = getattr(settings, "SAM_TORCH_INTEROP_THREADS", 1)
+
+QUEUE_TIMEOUT_SECONDS = getattr(settings, "SAM_QUEUE_TIMEOUT_SECONDS", 10)
+RETRY_AFTER_SECONDS = getattr(settings, "SAM_RETRY_AFTER_SECONDS", 2)
+
+_inference_slots = threading.BoundedSemaphore(MAX_CONCURRENT_INFERENCES)
+_threads_configured = False
+
+
+class InferenceBusy(Exception):
+    """Inference capacity is saturated; retry after `retry_after` seconds."""
+
+    def __init__(self, message="AI service is busy", retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after or RETRY_AFTER_SECONDS
+
+
+@contextmanager
+def inference_slot(timeout=None):
+    """
+    Hold one of the MAX_CONCURRENT_INFERENCES slots for a forward pass.
+    Raises InferenceBusy if none frees up within `timeout` seconds.
+    """
+    if not _inference_slots.acquire(timeout=timeout):
+        raise InferenceBusy("Timed out waiting for an inference slot")
+    try:
+        yield
+    finally:
+        _inference_slots.release()
+
+
+def torch_threads():
+    if TORCH_THREADS:
+        return TORCH_THREADS
+    return max(1, (os.cpu_count() or 1) // MAX_CONCURRENT_INFERENCES)
+
+
+def configure_torch_threads():
+    """
+    Apply the intra-/inter-op thread counts. Inter-op threads can only
+    be set before torch starts parallel work, so this runs once,
+    before the model is built.
+    """
+    global _threads_configured
+
+    if _threads_configured:
+        return
+
+    import torch
+
+    torch.set_num_threads(torch_threads())
+    try:
+        torch.set_num_interop_threads(TORCH_INTEROP_THREADS)
+    except RuntimeError:
+        logger.warning(
+            "torch inter-op threads already fixed at %s",
+            torch.get_num_interop_threads()
+        )
+    _threads_configured = True
+
+
+def admission_settings():
+    return {
+        "max_concurrent_inferences": MAX_CONCURRENT_INFERENCES,
+        "torch_threads": torch_threads(),
+        "torch_interop_threads": TORCH_INTEROP_THREADS,
+        "queue_timeout_seconds": QUEUE_TIMEOUT_SECONDS,
+        "retry_after_seconds": RETRY_AFTER_SECONDS,
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def log_admission_settings():
+    logger.info(
+        "SAM admission: %(max_concurrent_inferences)s concurrent inferences x "
+        "%(torch_threads)s torch threads (%(torch_interop_threads)s inter-op) "
+        "on %(cpu_count)s CPUs, queue timeout %(queue_timeout_seconds)ss",
+        admission_settings()
+    )
+
+
+# --------------------------------------------------
+# Lazy model provider
+#
+# torch / segment_anything are imported and the checkpoint is loaded
+# on the first call to get_predictor(), never at import time, so
+# migrate / shell / workers that never run inference stay light.
+# --------------------------------------------------
+_load_lock = threading.Lock()
+_sam = None
+_predictor = None
+_device = None
+_load_seconds = None
+
+
+def build_sam(backend=SAM_BACKEND, device=None):
+    """
+    Load the checkpoint and convert it to `backend`.
+    Use get_sam_model() for the shared process-wide instance.
+    """
+    import torch
+    from segment_anything import sam_model_registry
+    from segmentation.ai.backends import CPU_ONLY_BACKENDS, apply_backend
+
+    configure_torch_threads()
+
+    if device is None:
+        use_cuda = torch.cuda.is_available() and backend not in CPU_ONLY_BACKENDS
+        device = "cuda" if use_cuda else "cpu"
+
+    model = sam_model_registry[MODEL_TYPE](checkpoint=SAM_CHECKPOINT)
+    model.to(device=device)
+    model.eval()
+
+    return apply_backend(
+        model,
+        backend,
+        model_type=MODEL_TYPE,
+        checkpoint=SAM_CHECKPOINT
+    )
+
+
+def get_sam_model():
+    global _sam, _predictor, _device, _load_seconds
+
+    if _sam is not None:
+        return _sam
+
+    with _load_lock:
+        if _sam is not None:
+            return _sam
+
+        start = time.time()
+
+        from segment_anything import SamPredictor
+
+        model = build_sam()
+
+        _predictor = SamPredictor(model)
+        _device = str(model.device)
+        _load_seconds = round(time.time() - start, 2)
+        _sam = model
+
+        logger.info(
+            "Loaded SAM %s (%s backend) from %s on %s in %.2fs",
+            MODEL_TYPE, SAM_BACKEND, SAM_CHECKPOINT, _device, _load_seconds
+        )
+
+    return _sam
+
+
+def use_model(model, load_seconds=None):
+    """
+    Make an already built model the process-wide SAM instead of
+    loading the checkpoint (benchmarks with a stub model).
+    """
+    global _sam, _predictor, _device, _load_seconds
+    from segment_anything import SamPredictor
+
+    with _load_lock:
+        _predictor = SamPredictor(model)
+        _device = str(model.device)
+        _load_seconds = load_seconds
+        _sam = model
+
+
+def get_predictor():
+    get_sam_model()
+    return _predictor
+
+
+def new_predictor():
+    """
+    A SamPredictor with its own image state that shares the loaded
+    model weights. Use one per thread.
+    """
+    from segment_anything import SamPredictor
+
+    return SamPredictor(get_sam_model())
+
+
+def is_model_loaded():
+    return _sam is not None
+
+
+def model_status():
+    """
+    Readiness information that never triggers a model load.
+    """
+    return {
+        "model_type": MODEL_TYPE,
+        "backend": SAM_BACKEND,
+        "checkpoint": SAM_CHECKPOINT,
+        "checkpoint_exists": os.path.exists(SAM_CHECKPOINT),
+        "loaded": is_model_loaded(),
+        "device": _device,
+        "load_seconds": _load_seconds,
+        "admission": admission_settings(),
+    }
+
+
+def warm_up(run_encoder=False):
+    """
+    Load the model and optionally push one dummy image through the
+    encoder so first-request allocations happen ahead of traffic.
+    """
+    predictor = get_predictor()
+
+    if run_encoder:
+        import numpy as np
+        predictor.set_image(np.zeros((64, 64, 3), dtype=np.uint8))
+        predictor.reset_image()
+
+    return model_status()
+
+
+def restore_embedding(predictor, embedding):
+    """
+    Put a cached ImageEmbedding into `predictor` as if set_image()
+    had just run on the original image.
+    """
+    import torch
+
+    predictor.reset_image()
+    predictor.features = torch.from_numpy(embedding.features).to(
+        device=predictor.device,
+        dtype=torch.float32
+    )
+    predictor.original_size = tuple(embedding.original_size)
+    predictor.input_size = tuple(embedding.input_size)
+    predictor.is_image_set = True
+
+
+def set_image_cached(image_key, load_image, predictor=None):
+    """
+    Prepare `predictor` for predict() on the image identified by
+    image_key (Image.checksum).
+
+    On a cache hit the stored embedding is restored and the encoder
+    is skipped; load_image (a zero-arg callable returning an RGB
+    ndarray) is only called on a miss.
+
+    Not safe to call concurrently on a shared predictor; request
+    handlers should go through segmentation.ai.scheduler instead.
+    The encoder runs inside an inference slot.
+
+    Returns:
+        True on cache hit, False if the encoder had to run
+    """
+    if predictor is None:
+        predictor = get_predictor()
+
+    embedding = embedding_cache.get(image_key)
+
+    if embedding is not None:
+        restore_embedding(predictor, embedding)
+        return True
 
-sam = sam_model_registry[MODEL_TYPE](checkpoint=SAM_CHECKPOINT)
-sam.to(device=DEVICE)
+    image = load_image()
+    with inference_slot():
+        predictor.set_image(image)
 
-predictor = SamPredictor(sam)
+    embedding_cache.put(image_key, ImageEmbedding(
+        features=predictor.features.cpu().numpy(),
+        original_size=tuple(predictor.original_size),
+        input_size=tuple(predictor.input_size),
+    ))
+    return False
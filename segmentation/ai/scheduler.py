@@ -0,0 +1,410 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+
+import numpy as np
+from django.conf import settings
+
+from segmentation.ai import sam
+from segmentation.ai.embedding_cache import ImageEmbedding
+from segmentation.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_QUEUE_DEPTH = 32
+DEFAULT_MAX_BATCH_SIZE = 2
+DEFAULT_BATCH_WAIT_MS = 15
+
+# Number of recent requests kept for queue-latency percentiles
+LATENCY_WINDOW = 1000
+
+
+class SchedulerBusy(sam.InferenceBusy):
+    """Raised by submit() when the request queue is full."""
+
+
+class InferenceJob:
+    __slots__ = ('image_key', 'load_image', 'run', 'future', 'submitted_at', 'timings')
+
+    def __init__(self, image_key, load_image, run):
+        self.image_key = image_key
+        self.load_image = load_image
+        self.run = run
+        self.future = Future()
+        self.submitted_at = time.monotonic()
+        # Stage timings of the submitting request, if it is instrumented
+        self.timings = metrics.current()
+
+
+class InferenceScheduler:
+    """
+    Owns N worker threads, each with its own SamPredictor over the
+    shared model weights, fed from one bounded queue.
+
+    A worker takes the first queued job, then keeps collecting jobs
+    for up to max_wait_ms (or until max_batch_size) and runs every
+    image in that group that is not in the embedding cache through a
+    single batched encoder forward pass. Each job's `run(predictor)`
+    callable then executes against its image's embedding.
+    """
+
+    def __init__(self, *, workers, max_queue_depth, max_batch_size, max_wait_ms):
+        self.workers = max(1, workers)
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0, max_wait_ms) / 1000.0
+
+        self._queue = queue.Queue(maxsize=max_queue_depth)
+        self._threads = []
+        self._start_lock = threading.Lock()
+
+        # image_key -> Event for images currently being encoded, so two
+        # workers never run the encoder on the same image at once
+        self._encoding = {}
+        self._encoding_lock = threading.Lock()
+
+        self._stats_lock = threading.Lock()
+        self._queue_waits = deque(maxlen=LATENCY_WINDOW)
+        self._jobs_done = 0
+        self._jobs_failed = 0
+        self._jobs_rejected = 0
+        self._jobs_timed_out = 0
+        self._batches = 0
+        self._batched_jobs = 0
+        self._images_encoded = 0
+
+    # --------------------------------------------------
+    # Public API
+    # --------------------------------------------------
+    def submit(self, image_key, load_image, run):
+        """
+        Queue `run(predictor)` to execute once the predictor holds the
+        embedding for image_key. load_image is only called if the
+        embedding is not cached.
+
+        Returns:
+            concurrent.futures.Future with run()'s return value
+        """
+        self._ensure_started()
+
+        job = InferenceJob(image_key, load_image, run)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._stats_lock:
+                self._jobs_rejected += 1
+            raise SchedulerBusy("Inference queue is full")
+
+        return job.future
+
+    def run(self, image_key, load_image, run, queue_timeout=None):
+        """
+        submit() and wait for the result. A job still queued after
+        queue_timeout seconds is cancelled and raises SchedulerBusy;
+        once a worker has started it, run() waits for it to finish.
+        """
+        future = self.submit(image_key, load_image, run)
+
+        try:
+            return future.result(timeout=queue_timeout)
+        except TimeoutError:
+            if future.cancel():
+                with self._stats_lock:
+                    self._jobs_timed_out += 1
+                raise SchedulerBusy("Timed out waiting in the inference queue")
+            return future.result()
+
+    def shutdown(self):
+        """
+        Stop the worker threads once the queued jobs are done, releasing
+        their predictors. For short-lived schedulers (offline jobs).
+        """
+        with self._start_lock:
+            threads, self._threads = self._threads, []
+
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def stats(self):
+        with self._stats_lock:
+            waits = np.array(self._queue_waits) * 1000.0
+            return {
+                "workers": self.workers,
+                "workers_started": len(self._threads),
+                "queue_depth": self._queue.qsize(),
+                "max_queue_depth": self._queue.maxsize,
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": round(self.max_wait * 1000.0, 2),
+                "jobs_done": self._jobs_done,
+                "jobs_failed": self._jobs_failed,
+                "jobs_rejected": self._jobs_rejected,
+                "jobs_timed_out": self._jobs_timed_out,
+                "batches": self._batches,
+                "avg_batch_size": round(
+                    self._batched_jobs / self._batches, 2
+                ) if self._batches else 0.0,
+                "images_encoded": self._images_encoded,
+                "queue_wait_ms": {
+                    "p50": round(float(np.percentile(waits, 50)), 2),
+                    "p95": round(float(np.percentile(waits, 95)), 2),
+                    "max": round(float(waits.max()), 2),
+                } if len(waits) else None,
+            }
+
+    # --------------------------------------------------
+    # Workers
+    # --------------------------------------------------
+    def _ensure_started(self):
+        if self._threads:
+            return
+
+        with self._start_lock:
+            if self._threads:
+                return
+
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._worker_loop,
+                    name=f"sam-inference-{i}",
+                    daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def _worker_loop(self):
+        predictor = None
+
+        while True:
+            jobs = self._collect_batch()
+            if jobs is None:
+                return
+
+            with sam.inference_slot():
+                # Jobs whose caller gave up (queue timeout) are dropped here
+                jobs = [job for job in jobs if job.future.set_running_or_notify_cancel()]
+                if not jobs:
+                    continue
+                self._record_queue_waits(jobs)
+
+                try:
+                    if predictor is None:
+                        predictor = sam.new_predictor()
+                    self._process_batch(predictor, jobs)
+                except Exception as e:
+                    logger.exception("SAM inference batch failed")
+                    for job in jobs:
+                        if not job.future.done():
+                            job.future.set_exception(e)
+
+            with self._stats_lock:
+                self._batches += 1
+                self._batched_jobs += len(jobs)
+                for job in jobs:
+                    if job.future.exception() is None:
+                        self._jobs_done += 1
+                    else:
+                        self._jobs_failed += 1
+
+    def _collect_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        jobs = [first]
+
+        # Waiting for company only pays off when the encoder will run;
+        # decoder-only jobs (cached embedding) go out immediately
+        wait = 0 if sam.embedding_cache.contains(first.image_key) else self.max_wait
+        deadline = time.monotonic() + wait
+
+        while len(jobs) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    job = self._queue.get_nowait()
+                else:
+                    job = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+
+            if job is None:
+                # Shutdown marker: leave it for the next _collect_batch
+                self._queue.put(job)
+                break
+            jobs.append(job)
+
+        return jobs
+
+    def _record_queue_waits(self, jobs):
+        started = time.monotonic()
+        with self._stats_lock:
+            for job in jobs:
+                self._queue_waits.append(started - job.submitted_at)
+
+        for job in jobs:
+            if job.timings is not None:
+                job.timings.add("queue_wait", (started - job.submitted_at) * 1000.0)
+
+    def _process_batch(self, predictor, jobs):
+        embeddings = {}
+        missing = {}
+
+        for job in jobs:
+            if job.image_key in embeddings or job.image_key in missing:
+                continue
+            embedding = sam.embedding_cache.get(job.image_key)
+            if embedding is not None:
+                embeddings[job.image_key] = embedding
+            else:
+                missing[job.image_key] = job.load_image
+
+        if missing:
+            embeddings.update(self._encode_once(predictor, missing, jobs))
+
+        for job in jobs:
+            if job.future.done():
+                continue
+
+            try:
+                with metrics.activate(job.timings):
+                    with metrics.stage("restore_embedding"):
+                        sam.restore_embedding(predictor, embeddings[job.image_key])
+                    job.future.set_result(job.run(predictor))
+            except Exception as e:
+                job.future.set_exception(e)
+
+    def _encode_once(self, predictor, loaders, jobs):
+        """
+        Encode the images in `loaders`, except those another worker is
+        already encoding: for those, wait and read its cached result.
+        """
+        claimed = {}
+        pending = []
+
+        with self._encoding_lock:
+            for image_key, load_image in loaders.items():
+                event = self._encoding.get(image_key)
+                if event is None:
+                    self._encoding[image_key] = threading.Event()
+                    claimed[image_key] = load_image
+                else:
+                    pending.append((image_key, event))
+
+        try:
+            embeddings = self._encode(predictor, claimed, jobs)
+        finally:
+            with self._encoding_lock:
+                for image_key in claimed:
+                    self._encoding.pop(image_key).set()
+
+        leftover = {}
+        for image_key, event in pending:
+            event.wait()
+            embedding = sam.embedding_cache.get(image_key)
+            if embedding is not None:
+                embeddings[image_key] = embedding
+            else:
+                # The other worker failed; try ourselves
+                leftover[image_key] = loaders[image_key]
+
+        if leftover:
+            embeddings.update(self._encode(predictor, leftover, jobs))
+
+        return embeddings
+
+    def _encode(self, predictor, loaders, jobs):
+        """
+        Encode every image in `loaders` with one image_encoder call.
+        Jobs whose image fails to load are failed individually.
+        """
+        import torch
+
+        model = predictor.model
+        keys = []
+        inputs = []
+        sizes = []
+
+        for image_key, load_image in loaders.items():
+            # Decode time is charged to every request waiting on this image
+            waiting = metrics.FanOut(
+                job.timings for job in jobs if job.image_key == image_key
+            )
+
+            try:
+                with metrics.activate(waiting):
+                    image = load_image()
+            except Exception as e:
+                for job in jobs:
+                    if job.image_key == image_key:
+                        job.future.set_exception(e)
+                continue
+
+            with metrics.activate(waiting), metrics.stage("preprocess"):
+                input_image = predictor.transform.apply_image(image)
+                input_tensor = torch.as_tensor(input_image, device=predictor.device)
+                input_tensor = input_tensor.permute(2, 0, 1).contiguous()[None, :, :, :]
+                input_size = tuple(input_tensor.shape[-2:])
+                input_tensor = model.preprocess(input_tensor)
+
+            keys.append(image_key)
+            sizes.append((image.shape[:2], input_size))
+            inputs.append(input_tensor)
+
+        if not inputs:
+            return {}
+
+        start = time.perf_counter()
+        with torch.inference_mode():
+            features = model.image_encoder(torch.cat(inputs, dim=0))
+
+        # One batched pass: every request in it waited for all of it
+        metrics.FanOut(
+            job.timings for job in jobs if job.image_key in keys
+        ).add("set_image", (time.perf_counter() - start) * 1000.0)
+
+        with self._stats_lock:
+            self._images_encoded += len(keys)
+
+        embeddings = {}
+        for i, image_key in enumerate(keys):
+            original_size, input_size = sizes[i]
+            embedding = ImageEmbedding(
+                features=features[i:i + 1].cpu().numpy(),
+                original_size=tuple(original_size),
+                input_size=input_size,
+            )
+            sam.embedding_cache.put(image_key, embedding)
+            embeddings[image_key] = embedding
+
+        return embeddings
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    global _scheduler
+
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = InferenceScheduler(
+                    workers=getattr(
+                        settings, "SAM_INFERENCE_WORKERS", sam.MAX_CONCURRENT_INFERENCES
+                    ),
+                    max_queue_depth=getattr(
+                        settings, "SAM_MAX_QUEUE_DEPTH", DEFAULT_MAX_QUEUE_DEPTH
+                    ),
+                    max_batch_size=getattr(
+                        settings, "SAM_MAX_BATCH_SIZE", DEFAULT_MAX_BATCH_SIZE
+                    ),
+                    max_wait_ms=getattr(
+                        settings, "SAM_BATCH_WAIT_MS", DEFAULT_BATCH_WAIT_MS
+                    ),
+                )
+
+    return _scheduler
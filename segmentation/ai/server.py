@@ -0,0 +1,655 @@
+"""
+Out-of-process SAM inference over a local Unix socket.
+
+`manage.py sam_server` runs one process that owns the model, the
+embedding cache and the inference scheduler; web workers send it
+requests through InferenceClient instead of loading SAM themselves.
+When no server is listening the client reports it as unavailable and
+callers fall back to in-process inference.
+
+Wire format, both directions:
+
+    header   !4sBI   magic, op (request) or status (response), payload length
+    payload  bytes
+
+PRESEGMENT request payload:
+
+    !QII     image id, height, width
+    !H + utf-8 image key (checksum)
+    !H + utf-8 file path
+
+PRESEGMENT OK payload is `!II` (height, width) followed by the mask
+packed 8 pixels per byte (np.packbits). HEALTH returns JSON, BUSY a
+`!f` retry-after in seconds, ERROR and INVALID (a tiled region over
+the size cap) a utf-8 message.
+
+PROMPT, PRESEGMENT_TILED and PROMPT_TILED requests carry the image as
+above, then `!I` + JSON options, then optional raw bytes (PROMPT's
+mask_input as float16). Their OK payload is `!I` + JSON (score,
+region), `!I` + raw bytes (float16 low-res logits, may be empty) and
+the packed mask, absent when there is none.
+
+Unix sockets only: where socket.AF_UNIX does not exist (Windows) the
+server cannot run and the client always reports it as unavailable.
+"""
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+from django.conf import settings
+
+from segmentation.ai import sam
+from segmentation.ai.image_io import decoded_cache, inference_max_side, read_image_rgb
+from segmentation.ai.inference import LOW_RES_MASK_SIZE, predict_from_prompts, predict_full_image
+from segmentation.ai.scheduler import get_scheduler
+from segmentation.ai.tiling import RegionReader, RegionTooLarge, predict_tiled, presegment_tiled
+from segmentation.utils.metrics import stage
+
+logger = logging.getLogger(__name__)
+
+SERVER_SOCKET = getattr(settings, "SAM_SERVER_SOCKET", None)
+
+UNIX_SOCKETS_SUPPORTED = hasattr(socket, "AF_UNIX")
+
+# Connecting to a local socket either works at once or not at all
+CONNECT_TIMEOUT_SECONDS = getattr(settings, "SAM_SERVER_CONNECT_TIMEOUT", 0.5)
+
+# Covers queueing on the server plus the forward pass
+REQUEST_TIMEOUT_SECONDS = getattr(
+    settings, "SAM_SERVER_TIMEOUT", sam.QUEUE_TIMEOUT_SECONDS + 60
+)
+
+# Tiled requests run one forward pass per tile of the region (and may
+# decode the image into its raster first)
+TILED_REQUEST_TIMEOUT_SECONDS = getattr(
+    settings, "SAM_SERVER_TILED_TIMEOUT", sam.QUEUE_TIMEOUT_SECONDS + 600
+)
+
+# After a failed connect, skip the server for this long instead of
+# paying for a connect attempt on every request
+RETRY_SECONDS = getattr(settings, "SAM_SERVER_RETRY_SECONDS", 5)
+
+MAGIC = b"SAM1"
+HEADER = struct.Struct("!4sBI")
+IMAGE_HEADER = struct.Struct("!QII")
+MASK_HEADER = struct.Struct("!II")
+STRING_LENGTH = struct.Struct("!H")
+BLOB_LENGTH = struct.Struct("!I")
+RETRY_AFTER = struct.Struct("!f")
+
+MAX_PAYLOAD_BYTES = 256 * 1024 * 1024
+
+# Request ops
+OP_HEALTH = 1
+OP_PRESEGMENT = 2
+OP_PROMPT = 3
+OP_PRESEGMENT_TILED = 4
+OP_PROMPT_TILED = 5
+
+# Response statuses
+STATUS_OK = 0
+STATUS_BUSY = 1
+STATUS_ERROR = 2
+STATUS_INVALID = 3
+
+# What the server needs to know about an Image row
+ImageRef = namedtuple("ImageRef", "id file_path checksum height width")
+
+
+class InferenceServerUnavailable(Exception):
+    """No server is listening, or the connection broke."""
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# --------------------------------------------------
+# Framing
+# --------------------------------------------------
+def _recv_exact(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if not n:
+            raise ConnectionError("Connection closed mid-frame")
+        received += n
+    return bytes(buf)
+
+
+def send_frame(sock, code, payload=b""):
+    sock.sendall(HEADER.pack(MAGIC, code, len(payload)) + payload)
+
+
+def recv_frame(sock):
+    """(code, payload), or None on a clean EOF before a new frame."""
+    header = sock.recv(HEADER.size)
+    if not header:
+        return None
+    if len(header) < HEADER.size:
+        header += _recv_exact(sock, HEADER.size - len(header))
+
+    magic, code, length = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError("Bad frame magic")
+    if length > MAX_PAYLOAD_BYTES:
+        raise ProtocolError(f"Frame too large: {length} bytes")
+
+    return code, _recv_exact(sock, length) if length else b""
+
+
+def _pack_string(value):
+    data = value.encode("utf-8")
+    return STRING_LENGTH.pack(len(data)) + data
+
+
+def _unpack_string(payload, offset):
+    (length,) = STRING_LENGTH.unpack_from(payload, offset)
+    offset += STRING_LENGTH.size
+    return payload[offset:offset + length].decode("utf-8"), offset + length
+
+
+def pack_image(image):
+    return (
+        IMAGE_HEADER.pack(image.id, image.height, image.width)
+        + _pack_string(image.checksum)
+        + _pack_string(image.file_path)
+    )
+
+
+def _unpack_image(payload):
+    image_id, height, width = IMAGE_HEADER.unpack_from(payload)
+    checksum, offset = _unpack_string(payload, IMAGE_HEADER.size)
+    file_path, offset = _unpack_string(payload, offset)
+    return ImageRef(image_id, file_path, checksum, height, width), offset
+
+
+def unpack_image(payload):
+    return _unpack_image(payload)[0]
+
+
+def _pack_blob(data):
+    return BLOB_LENGTH.pack(len(data)) + data
+
+
+def _unpack_blob(payload, offset):
+    (length,) = BLOB_LENGTH.unpack_from(payload, offset)
+    offset += BLOB_LENGTH.size
+    return payload[offset:offset + length], offset + length
+
+
+def pack_mask(mask):
+    h, w = mask.shape
+    return MASK_HEADER.pack(h, w) + np.packbits(mask, axis=None).tobytes()
+
+
+def unpack_mask(payload):
+    h, w = MASK_HEADER.unpack_from(payload)
+    bits = np.frombuffer(payload, dtype=np.uint8, offset=MASK_HEADER.size)
+    return np.unpackbits(bits, count=h * w).reshape(h, w).astype(bool)
+
+
+def _as_list(array):
+    return None if array is None else np.asarray(array).tolist()
+
+
+def pack_request(image, options, data=b""):
+    return pack_image(image) + _pack_blob(json.dumps(options).encode("utf-8")) + data
+
+
+def unpack_request(payload):
+    """(ImageRef, options dict, trailing bytes)"""
+    image, offset = _unpack_image(payload)
+    options, offset = _unpack_blob(payload, offset)
+    return image, json.loads(options), payload[offset:]
+
+
+def pack_prompts(image, prompts):
+    mask_input = prompts.get("mask_input")
+    options = {
+        "points": _as_list(prompts.get("points")),
+        "labels": _as_list(prompts.get("labels")),
+        "boxes": _as_list(prompts.get("boxes")),
+        "multimask_output": bool(prompts.get("multimask_output")),
+    }
+    data = b"" if mask_input is None else np.asarray(mask_input, dtype=np.float16).tobytes()
+    return pack_request(image, options, data)
+
+
+def unpack_prompts(payload):
+    """(ImageRef, prompts) with prompts shaped as parse_prompts() returns them."""
+    image, options, data = unpack_request(payload)
+
+    def array(key, dtype, shape):
+        value = options.get(key)
+        return None if value is None else np.asarray(value, dtype=dtype).reshape(shape)
+
+    prompts = {
+        "points": array("points", np.float32, (-1, 2)),
+        "labels": array("labels", np.int64, (-1,)),
+        "boxes": array("boxes", np.float32, (-1, 4)),
+        "mask_input": (
+            np.frombuffer(data, dtype=np.float16)
+            .reshape(1, LOW_RES_MASK_SIZE, LOW_RES_MASK_SIZE).astype(np.float32)
+            if data else None
+        ),
+        "multimask_output": bool(options.get("multimask_output")),
+    }
+    return image, prompts
+
+
+def pack_result(meta, mask=None, data=b""):
+    return (
+        _pack_blob(json.dumps(meta).encode("utf-8"))
+        + _pack_blob(data)
+        + (pack_mask(mask) if mask is not None else b"")
+    )
+
+
+def unpack_result(payload):
+    """(meta dict, raw bytes, mask or None)"""
+    meta, offset = _unpack_blob(payload, 0)
+    data, offset = _unpack_blob(payload, offset)
+    mask = unpack_mask(payload[offset:]) if offset < len(payload) else None
+    return json.loads(meta), data, mask
+
+
+# --------------------------------------------------
+# Server
+# --------------------------------------------------
+def presegment_local(image):
+    """Full-image pre-segmentation on this process's scheduler."""
+    def load_image():
+        return read_image_rgb(image, inference_max_side())
+
+    def presegment(predictor):
+        return predict_full_image(predictor, (image.height, image.width))
+
+    return get_scheduler().run(
+        image.checksum,
+        load_image,
+        presegment,
+        queue_timeout=sam.QUEUE_TIMEOUT_SECONDS
+    )
+
+
+def prompt_local(image, prompts):
+    """
+    Prompted prediction on this process's scheduler.
+    Returns (mask, score, low_res_logits).
+    """
+    def load_image():
+        return read_image_rgb(image, inference_max_side())
+
+    def predict(predictor):
+        return predict_from_prompts(
+            predictor,
+            target_size=(image.height, image.width),
+            **prompts
+        )
+
+    return get_scheduler().run(
+        image.checksum,
+        load_image,
+        predict,
+        queue_timeout=sam.QUEUE_TIMEOUT_SECONDS
+    )
+
+
+def presegment_tiled_local(image, region):
+    """Tiled pre-segmentation on this process's scheduler -> (mask, region)."""
+    return presegment_tiled(
+        get_scheduler(),
+        image.checksum,
+        RegionReader(image.file_path, image.checksum),
+        region
+    )
+
+
+def predict_tiled_local(image, prompts):
+    """Tiled prompted prediction on this process's scheduler -> (mask, score, region)."""
+    return predict_tiled(
+        get_scheduler(),
+        image.checksum,
+        RegionReader(image.file_path, image.checksum),
+        points=prompts["points"],
+        labels=prompts["labels"],
+        boxes=prompts["boxes"],
+        multimask_output=prompts["multimask_output"]
+    )
+
+
+def _region(value):
+    return None if value is None else tuple(value)
+
+
+def server_health():
+    status = sam.model_status()
+    status["scheduler"] = get_scheduler().stats()
+    status["decoded_image_cache"] = decoded_cache.stats()
+    status["pid"] = os.getpid()
+    return status
+
+
+class InferenceRequestHandler(socketserver.BaseRequestHandler):
+    """Serves requests on one connection until the client closes it."""
+
+    def handle(self):
+        while True:
+            try:
+                frame = recv_frame(self.request)
+            except (ConnectionError, ProtocolError) as e:
+                logger.warning("Dropping inference client: %s", e)
+                return
+            if frame is None:
+                return
+
+            status, payload = self.dispatch(*frame)
+            try:
+                send_frame(self.request, status, payload)
+            except OSError:
+                return
+
+    def dispatch(self, op, payload):
+        try:
+            if op == OP_HEALTH:
+                return STATUS_OK, json.dumps(server_health(), default=str).encode("utf-8")
+
+            if op == OP_PRESEGMENT:
+                return STATUS_OK, pack_mask(presegment_local(unpack_image(payload)))
+
+            if op == OP_PROMPT:
+                mask, score, logits = prompt_local(*unpack_prompts(payload))
+                logits = b"" if logits is None else np.asarray(logits, dtype=np.float16).tobytes()
+                return STATUS_OK, pack_result({"score": score}, mask, logits)
+
+            if op == OP_PRESEGMENT_TILED:
+                image, options, _ = unpack_request(payload)
+                mask, region = presegment_tiled_local(image, _region(options.get("region")))
+                return STATUS_OK, pack_result({"region": list(region)}, mask)
+
+            if op == OP_PROMPT_TILED:
+                mask, score, region = predict_tiled_local(*unpack_prompts(payload))
+                meta = {"score": score, "region": list(region) if region else None}
+                return STATUS_OK, pack_result(meta, mask)
+
+            return STATUS_ERROR, f"Unknown op {op}".encode("utf-8")
+
+        except sam.InferenceBusy as e:
+            return STATUS_BUSY, RETRY_AFTER.pack(e.retry_after)
+        except RegionTooLarge as e:
+            return STATUS_INVALID, str(e).encode("utf-8")
+        except Exception as e:
+            logger.exception("Inference server request failed (op %s)", op)
+            return STATUS_ERROR, str(e).encode("utf-8")
+
+
+if UNIX_SOCKETS_SUPPORTED:
+    class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def __init__(self, socket_path):
+            remove_stale_socket(socket_path)
+            super().__init__(socket_path, InferenceRequestHandler)
+            os.chmod(socket_path, 0o660)
+            self.socket_path = socket_path
+
+        def server_close(self):
+            super().server_close()
+            try:
+                os.unlink(self.socket_path)
+            except FileNotFoundError:
+                pass
+else:
+    # No Unix sockets on this platform: web workers run inference in-process
+    InferenceServer = None
+
+
+def remove_stale_socket(socket_path):
+    """Unlink a socket file left by a dead server; refuse if one is live."""
+    if not os.path.exists(socket_path):
+        return
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    probe.settimeout(CONNECT_TIMEOUT_SECONDS)
+    try:
+        probe.connect(socket_path)
+    except OSError:
+        os.unlink(socket_path)
+    else:
+        raise RuntimeError(f"An inference server is already listening on {socket_path}")
+    finally:
+        probe.close()
+
+
+# --------------------------------------------------
+# Client
+# --------------------------------------------------
+class InferenceClient:
+    """
+    One connection per thread, reused across requests and reopened
+    after a failure. A reused connection that turns out to be dead
+    (the server restarted since) is retried once on a fresh one before
+    the server is reported unavailable.
+    """
+
+    def __init__(self, socket_path, timeout=REQUEST_TIMEOUT_SECONDS):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def health(self):
+        return json.loads(self._call(OP_HEALTH))
+
+    def presegment(self, image):
+        """Bool mask at the image's original size."""
+        with stage("inference_server"):
+            return unpack_mask(self._call(OP_PRESEGMENT, pack_image(image)))
+
+    def prompt(self, image, prompts):
+        """(mask, score, low_res_logits or None)"""
+        with stage("inference_server"):
+            meta, logits, mask = unpack_result(
+                self._call(OP_PROMPT, pack_prompts(image, prompts))
+            )
+        if logits:
+            logits = (
+                np.frombuffer(logits, dtype=np.float16)
+                .reshape(1, LOW_RES_MASK_SIZE, LOW_RES_MASK_SIZE).astype(np.float32)
+            )
+        else:
+            logits = None
+        return mask, meta["score"], logits
+
+    def presegment_tiled(self, image, region):
+        """(mask, region)"""
+        options = {"region": list(region)}
+        with stage("inference_server"):
+            meta, _, mask = unpack_result(
+                self._call(
+                    OP_PRESEGMENT_TILED,
+                    pack_request(image, options),
+                    timeout=TILED_REQUEST_TIMEOUT_SECONDS
+                )
+            )
+        return mask, _region(meta["region"])
+
+    def predict_tiled(self, image, prompts):
+        """(mask, score, region); (None, 0.0, None) if no tile got a prompt"""
+        with stage("inference_server"):
+            meta, _, mask = unpack_result(
+                self._call(
+                    OP_PROMPT_TILED,
+                    pack_prompts(image, prompts),
+                    timeout=TILED_REQUEST_TIMEOUT_SECONDS
+                )
+            )
+        return mask, meta["score"], _region(meta["region"])
+
+    def close(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is not None:
+            self._local.sock = None
+            sock.close()
+
+    def _connect(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is not None:
+            return sock
+
+        if not UNIX_SOCKETS_SUPPORTED:
+            raise InferenceServerUnavailable("Unix sockets are not supported on this platform")
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(CONNECT_TIMEOUT_SECONDS)
+        try:
+            sock.connect(self.socket_path)
+        except OSError as e:
+            sock.close()
+            raise InferenceServerUnavailable(str(e)) from e
+
+        sock.settimeout(self.timeout)
+        self._local.sock = sock
+        return sock
+
+    def _call(self, op, payload=b"", timeout=None):
+        reused = getattr(self._local, "sock", None) is not None
+        try:
+            status, payload = self._exchange(op, payload, timeout)
+        except InferenceServerUnavailable:
+            if not reused:
+                raise
+            # Requests are read-only, so resending one is safe
+            status, payload = self._exchange(op, payload, timeout)
+
+        if status == STATUS_OK:
+            return payload
+        if status == STATUS_BUSY:
+            (retry_after,) = RETRY_AFTER.unpack(payload)
+            raise sam.InferenceBusy("Inference server is busy", retry_after=retry_after)
+        if status == STATUS_INVALID:
+            raise RegionTooLarge(payload.decode("utf-8", "replace"))
+        raise RuntimeError(f"Inference server error: {payload.decode('utf-8', 'replace')}")
+
+    def _exchange(self, op, payload, timeout):
+        sock = self._connect()
+        try:
+            sock.settimeout(timeout or self.timeout)
+            send_frame(sock, op, payload)
+            frame = recv_frame(sock)
+        except socket.timeout:
+            # The server is alive but did not answer in time
+            self.close()
+            raise sam.InferenceBusy("Inference server timed out")
+        except (OSError, ProtocolError) as e:
+            self.close()
+            raise InferenceServerUnavailable(str(e)) from e
+
+        if frame is None:
+            self.close()
+            raise InferenceServerUnavailable("Inference server closed the connection")
+        return frame
+
+
+_client = None
+_client_lock = threading.Lock()
+_unavailable_until = 0.0
+
+
+def get_client():
+    """
+    The shared client, or None when no server is configured or it was
+    unreachable less than RETRY_SECONDS ago.
+    """
+    global _client
+
+    if not SERVER_SOCKET or not UNIX_SOCKETS_SUPPORTED:
+        return None
+    if time.monotonic() < _unavailable_until:
+        return None
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = InferenceClient(SERVER_SOCKET)
+    return _client
+
+
+def mark_unavailable(error):
+    global _unavailable_until
+
+    if time.monotonic() >= _unavailable_until:
+        logger.warning(
+            "Inference server at %s unavailable (%s), using in-process "
+            "inference for %ss", SERVER_SOCKET, error, RETRY_SECONDS
+        )
+    _unavailable_until = time.monotonic() + RETRY_SECONDS
+
+
+def _remote_or_local(remote, local, *args):
+    """
+    remote(client, *args) on the inference server when one is
+    listening, otherwise local(*args) in this process. Raises
+    InferenceBusy either way.
+    """
+    client = get_client()
+    if client is not None:
+        try:
+            return remote(client, *args)
+        except InferenceServerUnavailable as e:
+            mark_unavailable(e)
+
+    return local(*args)
+
+
+def presegment(image):
+    """Full-image pre-segmentation -> bool mask."""
+    return _remote_or_local(InferenceClient.presegment, presegment_local, image)
+
+
+def prompt(image, prompts):
+    """Prompted prediction -> (mask, score, low_res_logits)."""
+    return _remote_or_local(InferenceClient.prompt, prompt_local, image, prompts)
+
+
+def presegment_tiled_image(image, region):
+    """Tiled pre-segmentation of `region` -> (mask, region)."""
+    return _remote_or_local(
+        InferenceClient.presegment_tiled, presegment_tiled_local, image, region
+    )
+
+
+def predict_tiled_image(image, prompts):
+    """Tiled prompted prediction -> (mask, score, region)."""
+    return _remote_or_local(InferenceClient.predict_tiled, predict_tiled_local, image, prompts)
+
+
+def server_status():
+    """Health of the configured server, for the status endpoint."""
+    if not SERVER_SOCKET:
+        return None
+    if not UNIX_SOCKETS_SUPPORTED:
+        return {
+            "socket": SERVER_SOCKET,
+            "available": False,
+            "error": "Unix sockets are not supported on this platform",
+        }
+
+    client = InferenceClient(SERVER_SOCKET, timeout=CONNECT_TIMEOUT_SECONDS * 4)
+    try:
+        health = client.health()
+    except (InferenceServerUnavailable, sam.InferenceBusy, RuntimeError) as e:
+        return {"socket": SERVER_SOCKET, "available": False, "error": str(e)}
+    finally:
+        client.close()
+
+    return {"socket": SERVER_SOCKET, "available": True, **health}
@@ -0,0 +1,578 @@
+"""
+Tiled SAM inference for images too large to run in one pass
+(whole-slide, aerial).
+
+The image is covered by overlapping TILE_SIZE windows read region by
+region (see RegionReader for what that costs per format). Every window
+is an independent SAM image with its own embedding-cache entry, so it
+goes through the normal scheduler (batching, admission control, cache)
+like any other image.
+Prompts are routed to the windows they touch and the per-window masks
+are stitched back: each pixel is taken from the one window whose core
+(the window minus half the overlap on inner edges) contains it.
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from typing import NamedTuple
+
+import numpy as np
+from django.conf import settings
+from PIL import Image as PILImage, JpegImagePlugin, PngImagePlugin, TiffImagePlugin
+
+from segmentation.ai import sam
+from segmentation.ai.image_io import _ORIENTATION_TRANSFORMS
+from segmentation.ai.inference import predict_from_prompts, predict_full_image
+from segmentation.ai.scheduler import SchedulerBusy
+from segmentation.utils.metrics import stage
+
+logger = logging.getLogger(__name__)
+
+TILE_SIZE = getattr(settings, "SAM_TILE_SIZE", 1024)
+TILE_OVERLAP = getattr(settings, "SAM_TILE_OVERLAP", 128)
+
+# Images with at least this many pixels are segmented tile by tile
+TILED_MIN_PIXELS = getattr(settings, "SAM_TILED_MIN_PIXELS", 6000 * 6000)
+
+# Largest region one tiled request may cover: bounds the tiles run, the
+# stitched mask and the response whatever the image size
+TILED_MAX_REGION_PIXELS = getattr(settings, "SAM_TILED_MAX_REGION_PIXELS", 4096 * 4096)
+
+# Decoded rasters of formats without random access (JPEG, PNG, ...)
+RASTER_CACHE_BYTES = getattr(settings, "SAM_TILE_RASTER_CACHE_BYTES", 20 * 1024 ** 3)
+
+# Pixels converted and copied into a raster at a time
+RASTER_BAND_PIXELS = 16 * 1024 * 1024
+
+# EXIF orientations that swap width and height
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+# Orientation whose transform undoes each orientation's transform
+_INVERSE_ORIENTATIONS = {6: 8, 8: 6}
+
+
+def use_tiled(width, height):
+    return width * height >= TILED_MIN_PIXELS
+
+
+class RegionTooLarge(ValueError):
+    """A tiled request would cover more than TILED_MAX_REGION_PIXELS."""
+
+
+def check_region(region):
+    x0, y0, x1, y1 = region
+    if (x1 - x0) * (y1 - y0) > TILED_MAX_REGION_PIXELS:
+        raise RegionTooLarge(
+            f"region must cover at most {TILED_MAX_REGION_PIXELS} pixels"
+        )
+
+
+# File signature -> PIL plugin class, for the formats ingest accepts
+_LARGE_IMAGE_PLUGINS = (
+    (b'\xff\xd8\xff', JpegImagePlugin.JpegImageFile),
+    (b'\x89PNG\r\n\x1a\n', PngImagePlugin.PngImageFile),
+    (b'II*\x00', TiffImagePlugin.TiffImageFile),
+    (b'MM\x00*', TiffImagePlugin.TiffImageFile),
+    (b'II+\x00', TiffImagePlugin.TiffImageFile),
+    (b'MM\x00+', TiffImagePlugin.TiffImageFile),
+)
+
+
+def open_large(file_path):
+    """
+    Open an image up to settings.MAX_IMAGE_PIXELS (whole-slide /
+    aerial images) instead of PIL's default decompression-bomb limit.
+
+    The format's plugin class is instantiated directly, which skips
+    PILImage.open()'s global check, and the pixel count is checked here
+    instead: PILImage.MAX_IMAGE_PIXELS is never changed, so upload
+    validation and previews keep PIL's default guard. Other formats go
+    through PILImage.open() with the default limit.
+    """
+    with open(file_path, 'rb') as f:
+        prefix = f.read(8)
+
+    for signature, plugin in _LARGE_IMAGE_PLUGINS:
+        if prefix.startswith(signature):
+            img = plugin(file_path)
+            break
+    else:
+        return PILImage.open(file_path)
+
+    width, height = img.size
+    limit = getattr(settings, "MAX_IMAGE_PIXELS", PILImage.MAX_IMAGE_PIXELS)
+    if limit and width * height > limit:
+        img.close()
+        raise PILImage.DecompressionBombError(
+            f"Image size ({width * height} pixels) exceeds limit of {limit} pixels"
+        )
+    return img
+
+
+def raster_dir():
+    return getattr(
+        settings,
+        "SAM_TILE_RASTER_DIR",
+        os.path.join(settings.MEDIA_ROOT, "cache", "sam_rasters")
+    )
+
+
+# --------------------------------------------------
+# Tile grid
+# --------------------------------------------------
+class Tile(NamedTuple):
+    # Window given to SAM, image pixels
+    x0: int
+    y0: int
+    x1: int
+    y1: int
+    # Part of the window this tile owns when stitching
+    cx0: int
+    cy0: int
+    cx1: int
+    cy1: int
+
+    def key(self, image_key):
+        """Embedding-cache key of this window."""
+        return f"{image_key}@{self.x0}_{self.y0}_{self.x1}_{self.y1}"
+
+    def contains(self, x, y):
+        return self.x0 <= x < self.x1 and self.y0 <= y < self.y1
+
+    def core_intersects(self, region):
+        x0, y0, x1, y1 = region
+        return self.cx0 < x1 and self.cx1 > x0 and self.cy0 < y1 and self.cy1 > y0
+
+
+def _spans(length, size, overlap):
+    """[(start, end, core_start, core_end)] along one axis."""
+    if length <= size:
+        return [(0, length, 0, length)]
+
+    stride = max(1, size - overlap)
+    starts = list(range(0, length - size, stride)) + [length - size]
+    ends = [start + size for start in starts]
+
+    # Cut each overlap in the middle
+    cuts = [0] + [
+        (starts[i + 1] + ends[i]) // 2 for i in range(len(starts) - 1)
+    ] + [length]
+
+    return [
+        (start, end, cuts[i], cuts[i + 1])
+        for i, (start, end) in enumerate(zip(starts, ends))
+    ]
+
+
+def tile_grid(width, height, size=TILE_SIZE, overlap=TILE_OVERLAP):
+    return [
+        Tile(x0, y0, x1, y1, cx0, cy0, cx1, cy1)
+        for y0, y1, cy0, cy1 in _spans(height, size, overlap)
+        for x0, x1, cx0, cx1 in _spans(width, size, overlap)
+    ]
+
+
+def route_prompts(tiles, points=None, labels=None, boxes=None):
+    """
+    Split image-coordinate prompts into per-tile prompts in window
+    coordinates. A point goes to every window containing it, a box is
+    clipped to every window it overlaps. Windows left with background
+    points only are skipped.
+
+    Objects are only segmented in windows that a prompt reaches: use a
+    box for objects larger than a tile.
+
+    Returns:
+        [(tile, {"points", "labels", "boxes"})]
+    """
+    routed = []
+
+    for tile in tiles:
+        offset = np.array([tile.x0, tile.y0], dtype=np.float32)
+        tile_points = tile_labels = tile_boxes = None
+
+        if points is not None:
+            inside = np.array([tile.contains(x, y) for x, y in points], dtype=bool)
+            if inside.any():
+                tile_points = points[inside] - offset
+                tile_labels = labels[inside]
+
+        if boxes is not None:
+            clipped = np.stack([
+                np.maximum(boxes[:, 0], tile.x0),
+                np.maximum(boxes[:, 1], tile.y0),
+                np.minimum(boxes[:, 2], tile.x1),
+                np.minimum(boxes[:, 3], tile.y1),
+            ], axis=1)
+            keep = (clipped[:, 2] > clipped[:, 0]) & (clipped[:, 3] > clipped[:, 1])
+            if keep.any():
+                tile_boxes = clipped[keep] - np.tile(offset, 2)
+
+        if tile_boxes is None and (tile_labels is None or not tile_labels.any()):
+            continue
+
+        routed.append((tile, {
+            "points": tile_points,
+            "labels": tile_labels,
+            "boxes": tile_boxes,
+        }))
+
+    return routed
+
+
+def stitch(results, region):
+    """
+    results: [(tile, window mask)] -> bool mask covering `region`
+    (x0, y0, x1, y1), each pixel taken from the tile owning it.
+    """
+    rx0, ry0, rx1, ry1 = region
+    out = np.zeros((ry1 - ry0, rx1 - rx0), dtype=bool)
+
+    for tile, mask in results:
+        x0 = max(tile.cx0, rx0)
+        y0 = max(tile.cy0, ry0)
+        x1 = min(tile.cx1, rx1)
+        y1 = min(tile.cy1, ry1)
+        if x1 <= x0 or y1 <= y0:
+            continue
+
+        out[y0 - ry0:y1 - ry0, x0 - rx0:x1 - rx0] = mask[
+            y0 - tile.y0:y1 - tile.y0,
+            x0 - tile.x0:x1 - tile.x0
+        ]
+
+    return out
+
+
+def covering_region(tiles):
+    """Bounding box of the tiles' cores."""
+    return (
+        min(tile.cx0 for tile in tiles),
+        min(tile.cy0 for tile in tiles),
+        max(tile.cx1 for tile in tiles),
+        max(tile.cy1 for tile in tiles),
+    )
+
+
+# --------------------------------------------------
+# Region reads
+# --------------------------------------------------
+class RegionReader:
+    """
+    Reads RGB windows of an image file without decoding all of it.
+
+    Uncompressed 8-bit striped TIFFs whose strips are contiguous are
+    memory-mapped and windows are sliced straight out of the file.
+    Everything else (JPEG, PNG, compressed or tiled TIFF) is decoded
+    once into a memory-mapped raster under SAM_TILE_RASTER_DIR, shared
+    by later reads, requests and processes; see open_raster for the
+    memory that first decode needs.
+
+    width / height are after EXIF orientation, the coordinates windows
+    are read in. Safe to use from several threads.
+    """
+
+    def __init__(self, file_path, image_key):
+        self.file_path = file_path
+        self.image_key = image_key
+
+        with open_large(file_path) as img:
+            self.width, self.height = img.size
+            if img.getexif().get(0x0112, 1) in _TRANSPOSED_ORIENTATIONS:
+                self.width, self.height = self.height, self.width
+            layout = _raw_tiff_layout(img)
+
+        self._pixels = None
+        if layout is not None:
+            offset, shape = layout
+            self._pixels = np.memmap(file_path, dtype=np.uint8, mode='r', offset=offset, shape=shape)
+
+        self._raster = None
+        self._raster_lock = threading.Lock()
+
+    @property
+    def windowed(self):
+        return self._pixels is not None
+
+    def read(self, x0, y0, x1, y1):
+        with stage("imread"):
+            if self.windowed:
+                window = self._pixels[y0:y1, x0:x1]
+                if window.shape[2] == 1:
+                    return np.repeat(window, 3, axis=2)
+                return np.ascontiguousarray(window[:, :, :3])
+            return np.ascontiguousarray(self._get_raster()[y0:y1, x0:x1])
+
+    def _get_raster(self):
+        if self._raster is None:
+            with self._raster_lock:
+                if self._raster is None:
+                    self._raster = open_raster(self.file_path, self.image_key)
+        return self._raster
+
+
+def _tag_tuple(value):
+    if value is None:
+        return ()
+    return tuple(value) if isinstance(value, (tuple, list)) else (value,)
+
+
+def _raw_tiff_layout(img):
+    """
+    (file offset, (h, w, samples)) of a TIFF whose pixels are stored
+    uncompressed, 8 bits per sample, interleaved, top-down, in
+    contiguous strips; None for anything else.
+    """
+    if not isinstance(img, TiffImagePlugin.TiffImageFile):
+        return None
+
+    tags = img.tag_v2
+    samples = tags.get(277, 1)
+    if (
+        tags.get(259, 1) != 1           # compression
+        or tags.get(284, 1) != 1        # planar configuration
+        or tags.get(274, 1) != 1        # orientation
+        or tags.get(262) not in (1, 2)  # black-is-zero gray, RGB
+        or 322 in tags                  # tiled layout
+        or samples not in (1, 3, 4)
+        or any(bits != 8 for bits in _tag_tuple(tags.get(258, 8)))
+    ):
+        return None
+
+    offsets = _tag_tuple(tags.get(273))
+    counts = _tag_tuple(tags.get(279))
+    if not offsets or len(offsets) != len(counts):
+        return None
+    if any(offsets[i] + counts[i] != offsets[i + 1] for i in range(len(offsets) - 1)):
+        return None
+
+    width, height = img.size
+    if sum(counts) < width * height * samples:
+        return None
+    return offsets[0], (height, width, samples)
+
+
+# One lock per raster, so decoding one huge image does not hold up
+# opening any other
+_raster_locks = {}
+_raster_locks_guard = threading.Lock()
+
+
+def _raster_create_lock(image_key):
+    with _raster_locks_guard:
+        return _raster_locks.setdefault(image_key, threading.Lock())
+
+
+def raster_path(image_key):
+    return os.path.join(raster_dir(), image_key[:2], f"{image_key}.npy")
+
+
+def open_raster(file_path, image_key):
+    """
+    Memory-mapped (h, w, 3) uint8 RGB raster of file_path (EXIF
+    orientation applied), decoding and caching it on first use.
+
+    JPEG and PNG cannot be decoded region by region, so that first
+    decode holds the whole image in memory once (PIL's decoded copy,
+    at its own mode's bytes per pixel). Conversion to RGB and
+    orientation are then done in row bands of about RASTER_BAND_PIXELS
+    straight into the memory-mapped file, with no further whole-image
+    copies.
+    """
+    path = raster_path(image_key)
+
+    with _raster_create_lock(image_key):
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.npy"
+            _write_raster(file_path, tmp_path)
+            os.replace(tmp_path, path)
+            _evict_rasters(keep=path)
+        else:
+            os.utime(path)
+
+    return np.load(path, mmap_mode='r')
+
+
+def _write_raster(file_path, out_path):
+    with open_large(file_path) as img:
+        orientation = img.getexif().get(0x0112, 1)
+        width, height = img.size
+        img.load()
+
+        shape = (width, height) if orientation in _TRANSPOSED_ORIENTATIONS else (height, width)
+        raster = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.uint8, shape=shape + (3,))
+
+        # A view of the raster in the file's own (unoriented) layout,
+        # so decoded rows can be written as they are
+        undo = _ORIENTATION_TRANSFORMS.get(_INVERSE_ORIENTATIONS.get(orientation, orientation))
+        target = undo(raster) if undo is not None else raster
+
+        band_rows = max(1, RASTER_BAND_PIXELS // width)
+        for top in range(0, height, band_rows):
+            bottom = min(height, top + band_rows)
+            target[top:bottom] = np.asarray(img.crop((0, top, width, bottom)).convert("RGB"))
+
+        raster.flush()
+        del target, raster
+
+
+def _evict_rasters(keep):
+    """Drop least recently used rasters beyond RASTER_CACHE_BYTES."""
+    entries = []
+    for root, _, files in os.walk(raster_dir()):
+        for name in files:
+            if not name.endswith('.npy') or '.tmp' in name:
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= RASTER_CACHE_BYTES:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except FileNotFoundError:
+            pass
+
+
+# --------------------------------------------------
+# Tiled inference
+# --------------------------------------------------
+def run_tiles(scheduler, image_key, reader, tile_jobs, window=None,
+              queue_timeout=sam.QUEUE_TIMEOUT_SECONDS):
+    """
+    Run `run(predictor)` for every (tile, run) on the scheduler, each
+    tile as its own embedding-cache entry. At most `window` tiles are
+    queued at once so a big image does not starve other requests.
+
+    Raises SchedulerBusy if not even the first tile can be queued, or
+    if a queued tile has not started after queue_timeout seconds (the
+    other queued tiles are then cancelled), like scheduler.run().
+
+    Returns:
+        [(tile, result)]
+    """
+    window = window or max(1, scheduler.workers * scheduler.max_batch_size)
+    pending = list(tile_jobs)
+    pending.reverse()
+    in_flight = {}
+    deadlines = {}
+    results = []
+
+    while pending or in_flight:
+        while pending and len(in_flight) < window:
+            tile, run = pending[-1]
+            try:
+                future = scheduler.submit(
+                    tile.key(image_key),
+                    lambda tile=tile: reader.read(tile.x0, tile.y0, tile.x1, tile.y1),
+                    run
+                )
+            except SchedulerBusy:
+                if not in_flight:
+                    raise
+                break
+            pending.pop()
+            in_flight[future] = tile
+            deadlines[future] = (
+                time.monotonic() + queue_timeout if queue_timeout is not None else float('inf')
+            )
+
+        first_deadline = min(deadlines[future] for future in in_flight)
+        timeout = None if first_deadline == float('inf') else max(0, first_deadline - time.monotonic())
+
+        done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            deadlines.pop(future)
+            results.append((in_flight.pop(future), future.result()))
+
+        now = time.monotonic()
+        expired = [future for future in in_flight if deadlines[future] <= now]
+        if [future for future in expired if future.cancel()]:
+            for future in in_flight:
+                future.cancel()
+            raise SchedulerBusy("Timed out waiting in the inference queue")
+
+        # Already running: wait for them without a deadline
+        for future in expired:
+            deadlines[future] = float('inf')
+
+    return results
+
+
+def presegment_tiled(scheduler, image_key, reader, region):
+    """
+    Full-image pre-segmentation of every tile overlapping `region`
+    (x0, y0, x1, y1), the viewport. Returns (mask, region).
+
+    Raises RegionTooLarge beyond TILED_MAX_REGION_PIXELS.
+    """
+    check_region(region)
+    tiles = [
+        tile for tile in tile_grid(reader.width, reader.height)
+        if tile.core_intersects(region)
+    ]
+
+    results = run_tiles(
+        scheduler,
+        image_key,
+        reader,
+        [(tile, predict_full_image) for tile in tiles]
+    )
+    return stitch(results, region), region
+
+
+def predict_tiled(scheduler, image_key, reader, *, points, labels, boxes, multimask_output=False):
+    """
+    Prompted prediction on a tiled image.
+
+    Returns:
+        (mask, score, region) - mask covers `region`, the bounding box
+        of the tiles the prompts reached; score is the tile average.
+        (None, 0.0, None) if no tile received a usable prompt.
+
+    Raises RegionTooLarge if the prompts reach tiles covering more than
+    TILED_MAX_REGION_PIXELS (e.g. a box around most of the image).
+    """
+    routed = route_prompts(
+        tile_grid(reader.width, reader.height),
+        points=points,
+        labels=labels,
+        boxes=boxes
+    )
+    if not routed:
+        return None, 0.0, None
+    check_region(covering_region([tile for tile, _ in routed]))
+
+    def make_run(tile_prompts):
+        def run(predictor):
+            mask, score, _ = predict_from_prompts(
+                predictor,
+                multimask_output=multimask_output,
+                **tile_prompts
+            )
+            return mask, score
+        return run
+
+    results = run_tiles(
+        scheduler,
+        image_key,
+        reader,
+        [(tile, make_run(tile_prompts)) for tile, tile_prompts in routed]
+    )
+
+    region = covering_region([tile for tile, _ in results])
+    mask = stitch([(tile, mask) for tile, (mask, _) in results], region)
+    score = float(np.mean([score for _, (_, score) in results]))
+    return mask, score, region
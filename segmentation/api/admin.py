@@ -3,8 +3,11 @@ from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
-from segmentation.models import Project, Dataset
-from segmentation.services.batch_upload import process_batch_upload
+from django.core.paginator import Paginator
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from segmentation.models import Project, Dataset, Batch, BatchImage
+from segmentation.services.batch_upload import queue_batch_upload
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from segmentation.api.auth import CsrfExemptSessionAuthentication
@@ -14,7 +17,8 @@ from rest_framework.authentication import BasicAuthentication
 @method_decorator(csrf_exempt, name='dispatch')
 class AdminBatchUploadAPIView(APIView):
     """
-    Admin API to upload image ZIP and trigger batch processing
+    Admin API to upload image ZIP and trigger batch processing.
+    Returns 202 with the batch id; poll status_url for progress.
     """
     authentication_classes = (
         CsrfExemptSessionAuthentication,
@@ -29,6 +33,7 @@ class AdminBatchUploadAPIView(APIView):
             project_id = request.data.get('project_id')
             zip_file = request.FILES.get('zip_file')
             priority = request.data.get('priority', 'MEDIUM')
+            precompute_embeddings = request.data.get('precompute_embeddings')
 
             if not all([project_id, zip_file]):
                 return Response(
@@ -38,14 +43,33 @@ class AdminBatchUploadAPIView(APIView):
 
             project = Project.objects.get(id=project_id)
 
-            result = process_batch_upload(
+            # Only the archive is stored here; ingestion runs on django-q
+            batch, error = queue_batch_upload(
                 zip_file=zip_file,
                 project=project,
                 uploaded_by=request.user,
-                priority=priority
+                priority=priority,
+                precompute_embeddings=(
+                    None if precompute_embeddings is None
+                    else str(precompute_embeddings).lower() in ('1', 'true', 'yes')
+                )
             )
 
-            return Response(result, status=status.HTTP_200_OK)
+            if batch is None:
+                return Response(
+                    {"status": "failed", "error": error},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            return Response(
+                {
+                    "batch_id": batch.batch_id,
+                    "status": batch.status,
+                    "total_images": batch.total_images,
+                    "status_url": reverse('batch-status', args=[batch.batch_id]),
+                },
+                status=status.HTTP_202_ACCEPTED
+            )
 
         except Project.DoesNotExist:
             return Response(
@@ -64,3 +88,109 @@ class AdminBatchUploadAPIView(APIView):
                 {"error": str(e)},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
+
+
+def visible_batches(user):
+    """Admins see every batch, anyone else only their own uploads."""
+    if user.is_superuser or user.role == 'ADMIN':
+        return Batch.objects.all()
+    return Batch.objects.filter(uploaded_by=user)
+
+
+class BatchStatusAPIView(APIView):
+    """
+    Progress of a batch upload: status, completion percentage, counters,
+    per-stage timings (seconds) and the first failed files; every file is
+    listed under files_url. Only the uploader and admins can see a batch.
+    """
+    authentication_classes = (
+        CsrfExemptSessionAuthentication,
+        BasicAuthentication,
+    )
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, batch_id):
+        batch = get_object_or_404(visible_batches(request.user), batch_id=batch_id)
+
+        return Response({
+            "batch_id": batch.batch_id,
+            "project_id": batch.project_id,
+            "dataset_id": batch.dataset_id,
+            "status": batch.status,
+            "completion_percentage": batch.completion_percentage(),
+            "total_images": batch.total_images,
+            "images_extracted": batch.images_extracted,
+            "images_duplicate": batch.images_duplicate,
+            "images_failed": batch.images_failed,
+            "total_tasks_created": batch.total_tasks_created,
+            "assigned_tasks": batch.assigned_tasks,
+            "unassigned_tasks": batch.unassigned_tasks,
+            "embeddings_total": batch.embeddings_total,
+            "embeddings_done": batch.embeddings_done,
+            "embedding_percentage": batch.embedding_percentage(),
+            "stage_timings": batch.stage_timings,
+            "failures": batch.failures,
+            "files_url": reverse('batch-files', args=[batch.batch_id]),
+            "error": batch.error_message,
+            "created_at": batch.created_at,
+            "completed_at": batch.completed_at,
+        })
+
+
+class BatchFilesAPIView(APIView):
+    """
+    Per-file outcome of a batch upload, one row per archive member, in
+    archive order and paginated.
+
+    Query params: status (PENDING / STORED / DUPLICATE / FAILED),
+    page, page_size (default 100, max 1000). Only the uploader and
+    admins can see a batch.
+    """
+    authentication_classes = (
+        CsrfExemptSessionAuthentication,
+        BasicAuthentication,
+    )
+
+    permission_classes = [IsAuthenticated]
+
+    DEFAULT_PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 1000
+
+    def get(self, request, batch_id):
+        batch = get_object_or_404(visible_batches(request.user), batch_id=batch_id)
+
+        files = BatchImage.objects.filter(batch=batch).only(
+            'id', 'original_filename', 'status', 'image_id', 'error_message'
+        )
+
+        file_status = request.query_params.get('status')
+        if file_status:
+            files = files.filter(status=file_status.upper())
+
+        try:
+            page_size = int(request.query_params.get('page_size', self.DEFAULT_PAGE_SIZE))
+        except ValueError:
+            page_size = self.DEFAULT_PAGE_SIZE
+        page_size = max(1, min(page_size, self.MAX_PAGE_SIZE))
+
+        page = Paginator(files, page_size).get_page(request.query_params.get('page'))
+
+        return Response({
+            "batch_id": batch.batch_id,
+            "count": page.paginator.count,
+            "page": page.number,
+            "page_size": page_size,
+            "num_pages": page.paginator.num_pages,
+            "has_next": page.has_next(),
+            "results": [
+                {
+                    "id": row.id,
+                    "filename": row.original_filename,
+                    "status": row.status,
+                    "image_id": row.image_id,
+                    "error": row.error_message,
+                }
+                for row in page
+            ],
+        })
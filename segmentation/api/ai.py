@@ -1,18 +1,109 @@
-import cv2
 import numpy as np
 import base64
+from functools import wraps
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
 
 from segmentation.models import SegmentationTask
-from segmentation.ai.sam import predictor
+from segmentation.ai.image_io import decoded_cache
+from segmentation.ai import server
+from segmentation.ai.inference import LOW_RES_MASK_SIZE
+from segmentation.ai.sam import InferenceBusy, model_status
+from segmentation.ai.scheduler import get_scheduler
+from segmentation.ai.tiling import RegionTooLarge, check_region, use_tiled
+from segmentation.utils.masks import encode_mask, requested_mask_format
+from segmentation.utils.metrics import (
+    StageTimings,
+    activate,
+    note_image_size,
+    registry,
+    server_timing_enabled,
+    stage,
+)
+
+
+def encode_logits(low_res_logits):
+    """(1, 256, 256) float logits -> base64 float16 bytes"""
+    data = np.ascontiguousarray(low_res_logits, dtype=np.float16).tobytes()
+    return base64.b64encode(data).decode("utf-8")
+
+
+def decode_logits(encoded):
+    data = base64.b64decode(encoded)
+    logits = np.frombuffer(data, dtype=np.float16)
+    return logits.reshape(1, LOW_RES_MASK_SIZE, LOW_RES_MASK_SIZE).astype(np.float32)
+
+
+def busy_response(error):
+    """503 with Retry-After, so clients back off instead of piling up."""
+    return Response(
+        {"error": "AI service is busy, please retry", "retry_after": error.retry_after},
+        status=503,
+        headers={"Retry-After": str(error.retry_after)}
+    )
+
+
+def instrumented(operation):
+    """
+    Time every stage of the wrapped view (including work done on
+    scheduler threads) into the `operation` histograms; with
+    SAM_SERVER_TIMING the stages are also sent as a Server-Timing header.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            timings = StageTimings()
+            with activate(timings), stage("total"):
+                response = method(self, request, *args, **kwargs)
+
+            if response.status_code == 200:
+                timings.record(operation)
+            if server_timing_enabled():
+                response["Server-Timing"] = timings.server_timing()
+            return response
+        return wrapper
+    return decorator
+
+
+def wants_tiled(value, image):
+    """?tiled=1 / 0 forces the mode, otherwise it follows the image size."""
+    if value is None:
+        return use_tiled(image.width, image.height)
+    return str(value).lower() in ("1", "true", "yes")
+
+
+def parse_region(value, image):
+    """ "x0,y0,x1,y1" -> tuple clipped to the image, None if not given """
+    if not value:
+        return None
+
+    try:
+        x0, y0, x1, y1 = (int(float(v)) for v in value.split(","))
+    except ValueError:
+        raise ValueError("region must be x0,y0,x1,y1")
+
+    x0, x1 = max(0, x0), min(image.width, x1)
+    y0, y1 = max(0, y0), min(image.height, y1)
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError("region is empty or outside the image")
+    return x0, y0, x1, y1
 
 
 class AIPreSegmentationAPIView(APIView):
+    """
+    ?mask_format=rle returns a COCO RLE dict instead of a PNG data URL.
+
+    Very large images are segmented in overlapping tiles (?tiled=1/0
+    overrides the size-based choice). Tiled mode needs
+    ?region=x0,y0,x1,y1, the viewport, of at most
+    SAM_TILED_MAX_REGION_PIXELS; only the tiles covering it are run and
+    the response says which region the mask covers.
+    """
     permission_classes = [IsAuthenticated]
 
+    @instrumented("presegment")
     def get(self, request, task_id):
         task = get_object_or_404(
             SegmentationTask,
@@ -20,28 +111,220 @@ class AIPreSegmentationAPIView(APIView):
             assigned_to=request.user
         )
 
-        # Load image
-        image = cv2.imread(task.image.file_path)
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        image = task.image
+        note_image_size(image.height, image.width)
+
+        try:
+            mask_format = requested_mask_format(request.query_params.get("mask_format"))
+            tiled = wants_tiled(request.query_params.get("tiled"), image)
+            region = parse_region(request.query_params.get("region"), image)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=400)
+
+        if tiled:
+            if region is None:
+                return Response(
+                    {"error": "region=x0,y0,x1,y1 is required for tiled images"},
+                    status=400
+                )
+            try:
+                check_region(region)
+                mask, region = server.presegment_tiled_image(image, region)
+            except RegionTooLarge as e:
+                return Response({"error": str(e)}, status=400)
+            except InferenceBusy as e:
+                return busy_response(e)
+
+            return Response({
+                "mask": encode_mask(mask, mask_format),
+                "mask_format": mask_format,
+                "tiled": True,
+                "region": list(region)
+            })
+
+        # On the inference server when one is running, else on this
+        # process's scheduler; the encoder is skipped when the embedding
+        # for this image is already cached
+        try:
+            mask = server.presegment(image)
+        except InferenceBusy as e:
+            return busy_response(e)
+
+        return Response({
+            "mask": encode_mask(mask, mask_format),
+            "mask_format": mask_format
+        })
+
 
-        # 🔥 REQUIRED STEP (THIS WAS MISSING)
-        predictor.set_image(image)
+class AIPromptAPIView(APIView):
+    """
+    Interactive refinement: decode a mask from point / box prompts
+    against the cached image embedding.
 
-        # Use full-image box prompt
-        h, w, _ = image.shape
-        input_box = np.array([0, 0, w, h])
+    Body:
+        points:     [[x, y], ...]          image coordinates
+        labels:     [1, 0, ...]            1 = include, 0 = exclude
+        box:        [x0, y0, x1, y1]       optional
+        boxes:      [[x0, y0, x1, y1], ..] optional, merged result
+        mask_input: low_res_logits from the previous response (optional)
+        multimask:  bool, let SAM pick the best of 3 candidates
+        mask_format: "png" (default) or "rle"
+        tiled:      bool, overrides the size-based tiled mode
 
-        masks, scores, _ = predictor.predict(
-            box=input_box,
-            multimask_output=False
+    Only the first click on an image pays for the encoder; every
+    following click runs the mask decoder only.
+
+    In tiled mode prompts are routed to the tiles they touch; the mask
+    covers only those tiles ("region" in the response, at most
+    SAM_TILED_MAX_REGION_PIXELS) and mask_input is not supported.
+    """
+    permission_classes = [IsAuthenticated]
+
+    @instrumented("prompt")
+    def post(self, request, task_id):
+        task = get_object_or_404(
+            SegmentationTask,
+            id=task_id,
+            assigned_to=request.user
         )
 
-        mask = masks[0].astype(np.uint8) * 255
+        try:
+            prompts = self.parse_prompts(request.data)
+            mask_format = requested_mask_format(request.data.get("mask_format"))
+        except (TypeError, ValueError) as e:
+            return Response({"error": str(e)}, status=400)
+
+        image = task.image
+        note_image_size(image.height, image.width)
+
+        if wants_tiled(request.data.get("tiled"), image):
+            return self.post_tiled(image, prompts, mask_format)
+
+        # Like pre-segmentation: on the inference server when one is
+        # running, else on this process's scheduler
+        try:
+            mask, score, low_res_logits = server.prompt(image, prompts)
+        except InferenceBusy as e:
+            return busy_response(e)
+
+        return Response({
+            "mask": encode_mask(mask, mask_format),
+            "mask_format": mask_format,
+            "score": round(score, 4),
+            "low_res_logits": (
+                encode_logits(low_res_logits)
+                if low_res_logits is not None else None
+            ),
+        })
+
+    def post_tiled(self, image, prompts, mask_format):
+        if prompts["mask_input"] is not None:
+            return Response(
+                {"error": "mask_input is not supported for tiled images"},
+                status=400
+            )
+
+        try:
+            mask, score, region = server.predict_tiled_image(image, prompts)
+        except RegionTooLarge as e:
+            return Response({"error": str(e)}, status=400)
+        except InferenceBusy as e:
+            return busy_response(e)
+
+        if mask is None:
+            return Response(
+                {"error": "No box or foreground point inside the image"},
+                status=400
+            )
+
+        return Response({
+            "mask": encode_mask(mask, mask_format),
+            "mask_format": mask_format,
+            "score": round(score, 4),
+            "low_res_logits": None,
+            "tiled": True,
+            "region": list(region),
+        })
+
+    @staticmethod
+    def parse_prompts(data):
+        points = data.get("points") or None
+        labels = data.get("labels")
+        boxes = data.get("boxes") or None
+        box = data.get("box")
+        mask_input = data.get("mask_input")
+
+        if box and boxes:
+            raise ValueError("Send either box or boxes, not both")
+        if box:
+            boxes = [box]
+
+        if points is not None:
+            points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+            if labels is None:
+                labels = [1] * len(points)
+            labels = np.asarray(labels, dtype=np.int64).reshape(-1)
+            if len(labels) != len(points):
+                raise ValueError("points and labels must have the same length")
+        else:
+            labels = None
+
+        if boxes is not None:
+            boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+
+        if points is None and boxes is None:
+            raise ValueError("At least one point or box is required")
+
+        if mask_input:
+            if boxes is not None and len(boxes) > 1:
+                raise ValueError("mask_input cannot be combined with multiple boxes")
+            try:
+                mask_input = decode_logits(mask_input)
+            except Exception:
+                raise ValueError("Invalid mask_input")
+        else:
+            mask_input = None
+
+        return {
+            "points": points,
+            "labels": labels,
+            "boxes": boxes,
+            "mask_input": mask_input,
+            "multimask_output": bool(data.get("multimask", False)),
+        }
 
-        # Encode mask to base64 PNG
-        _, buffer = cv2.imencode(".png", mask)
-        mask_base64 = base64.b64encode(buffer).decode("utf-8")
 
+class AIModelStatusAPIView(APIView):
+    """
+    Readiness probe for the SAM model.
+    Returns 503 until the model is loaded; never triggers a load itself
+    (run `manage.py sam_warmup` or the first inference request for that).
+    Authenticated users only: it exposes scheduler and server internals.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        status = model_status()
+        status["scheduler"] = get_scheduler().stats()
+        status["decoded_image_cache"] = decoded_cache.stats()
+        status["inference_server"] = server.server_status()
+
+        remote = status["inference_server"]
+        ready = status["loaded"] or bool(remote and remote["available"] and remote["loaded"])
+        return Response(status, status=200 if ready else 503)
+
+
+class AIMetricsAPIView(APIView):
+    """
+    Per-stage latency histograms (ms) and image size histograms
+    (megapixels) of the AI endpoints since process start.
+    Authenticated users only.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
         return Response({
-            "mask": f"data:image/png;base64,{mask_base64}"
+            "operations": registry.snapshot(),
+            "scheduler": get_scheduler().stats(),
+            "decoded_image_cache": decoded_cache.stats(),
         })
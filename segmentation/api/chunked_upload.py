@@ -0,0 +1,161 @@
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.authentication import BasicAuthentication
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from segmentation.api.auth import CsrfExemptSessionAuthentication
+from segmentation.models import Project, UploadSession
+from segmentation.services.chunked_upload import (
+    UploadError,
+    abort_upload,
+    complete_upload,
+    initiate_upload,
+    store_part,
+)
+
+
+def session_payload(session):
+    return {
+        "upload_id": session.upload_id,
+        "status": session.status,
+        "file_name": session.file_name,
+        "total_size": session.total_size,
+        "part_size": session.part_size,
+        "total_parts": session.total_parts,
+        "received_parts": len(session.parts),
+        "missing_parts": session.missing_parts(),
+        "batch_id": session.batch.batch_id if session.batch_id else None,
+    }
+
+
+class ChunkedUploadAPIView(APIView):
+    authentication_classes = (
+        CsrfExemptSessionAuthentication,
+        BasicAuthentication,
+    )
+
+    permission_classes = [IsAuthenticated]
+
+    def get_session(self, request, upload_id):
+        return get_object_or_404(
+            UploadSession.objects.select_related('batch'),
+            upload_id=upload_id,
+            uploaded_by=request.user
+        )
+
+
+class ChunkedUploadInitiateAPIView(ChunkedUploadAPIView):
+    """
+    Start a resumable upload.
+
+    Body: project_id, file_name, total_size (bytes), part_size (optional)
+    """
+
+    def post(self, request):
+        project = get_object_or_404(Project, id=request.data.get('project_id'))
+
+        try:
+            session = initiate_upload(
+                project=project,
+                uploaded_by=request.user,
+                file_name=request.data.get('file_name') or 'upload.zip',
+                total_size=int(request.data.get('total_size') or 0),
+                part_size=int(request.data['part_size']) if request.data.get('part_size') else None
+            )
+        except (TypeError, ValueError):
+            return Response(
+                {"error": "total_size and part_size must be integers"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        except UploadError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(session_payload(session), status=status.HTTP_201_CREATED)
+
+
+class ChunkedUploadDetailAPIView(ChunkedUploadAPIView):
+    """State of an upload (which parts to re-send), or DELETE to abort."""
+
+    def get(self, request, upload_id):
+        return Response(session_payload(self.get_session(request, upload_id)))
+
+    def delete(self, request, upload_id):
+        abort_upload(self.get_session(request, upload_id))
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class ChunkedUploadPartAPIView(ChunkedUploadAPIView):
+    """
+    PUT the raw bytes of one part (application/octet-stream) with its
+    hex SHA256 in the X-Part-SHA256 header. Re-sending a part replaces it.
+    """
+
+    def put(self, request, upload_id, part_number):
+        session = self.get_session(request, upload_id)
+
+        # No body at all (Content-Length 0 or missing)
+        if request.stream is None:
+            return Response({"error": "Part body is empty"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            content_length = int(request.META.get('CONTENT_LENGTH') or 0) or None
+        except ValueError:
+            content_length = None
+
+        # request.stream: the body is read straight off the socket, never
+        # through the parsers / upload handlers
+        try:
+            record = store_part(
+                session,
+                part_number,
+                request.stream,
+                request.headers.get('X-Part-SHA256'),
+                content_length=content_length
+            )
+        except UploadError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({"part_number": part_number, **record})
+
+
+class ChunkedUploadCompleteAPIView(ChunkedUploadAPIView):
+    """
+    Queue the uploaded archive for batch processing, like a regular
+    batch upload. Body: priority, precompute_embeddings (optional).
+    """
+
+    def post(self, request, upload_id):
+        session = self.get_session(request, upload_id)
+        precompute_embeddings = request.data.get('precompute_embeddings')
+
+        try:
+            batch, error = complete_upload(
+                session,
+                priority=request.data.get('priority', 'MEDIUM'),
+                precompute_embeddings=(
+                    None if precompute_embeddings is None
+                    else str(precompute_embeddings).lower() in ('1', 'true', 'yes')
+                )
+            )
+        except UploadError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if batch is None:
+            return Response(
+                {"status": "failed", "error": error},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        return Response(
+            {
+                "upload_id": session.upload_id,
+                "batch_id": batch.batch_id,
+                "status": batch.status,
+                "total_images": batch.total_images,
+                "status_url": reverse('batch-status', args=[batch.batch_id]),
+            },
+            status=status.HTTP_202_ACCEPTED
+        )
@@ -1,4 +1,3 @@
-import base64
 import json
 import os
 from django.conf import settings
@@ -8,8 +7,9 @@ from django.utils.dateparse import parse_datetime
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from segmentation.utils.masks import mask_upload_to_png
 from segmentation.models import SegmentationTask, TaskReview
-from segmentation.utils.media import media_path_to_url
+from segmentation.utils.media import media_path_to_url, thumbnail_url
 
 
 class QADashboardAPIView(APIView):
@@ -29,6 +29,7 @@ class QADashboardAPIView(APIView):
                 "task_id": task.id,
                 "image_name": task.image.file_name,
                 "image_path": media_path_to_url(task.image.file_path),
+                "thumbnail_url": thumbnail_url(task.image),
                 "priority": task.priority,
                 "status": task.status,
                 "assigned_to": task.assigned_to.username if task.assigned_to else "Unknown",
@@ -58,8 +59,11 @@ class QADecisionAPIView(APIView):
         # 2. SAVE THE MASK (Images are overwritten)
         # ---------------------------------------------------
         try:
-            header, encoded = mask_data.split(",", 1)
-            mask_bytes = base64.b64decode(encoded)
+            mask_bytes = mask_upload_to_png(
+                mask_data,
+                request.data.get("mask_format"),
+                image_size=(task.image.height, task.image.width)
+            )
         except ValueError:
             return Response({"error": "Invalid mask data format"}, status=400)
 
@@ -4,10 +4,11 @@ from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from segmentation.models import SegmentationTask
-from segmentation.utils.media import media_path_to_url
+from segmentation.utils.media import media_path_to_url, preview_urls, thumbnail_url
 import json
 import os
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
 
 
 class MyTasksAPIView(APIView):
@@ -28,6 +29,7 @@ class MyTasksAPIView(APIView):
                 "task_id": task.id,
                 "image_name": task.image.file_name,
                 "image_path": media_path_to_url(task.image.file_path),
+                "thumbnail_url": thumbnail_url(task.image),
                 "status": task.status,
                 "priority": task.priority,
                 "created_at": task.created_at
@@ -84,6 +86,8 @@ class TaskDetailAPIView(APIView):
             "assigned_to": task.assigned_to.username if task.assigned_to else "Unassigned",
             "image_name": task.image.file_name,
             "image_path": media_path_to_url(task.image.file_path),
+            "preview_urls": preview_urls(task.image),
+            "tiles_url": reverse('image-tiles', args=[task.image_id]),
             "mask_path": mask_url,
             "metadata": metadata_content,
             "status": task.status,
@@ -1,4 +1,3 @@
-import base64
 import json
 import os
 from django.conf import settings
@@ -7,6 +6,7 @@ from django.shortcuts import get_object_or_404
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from segmentation.utils.masks import mask_upload_to_png
 from segmentation.models import SegmentationTask
 
 
@@ -32,8 +32,11 @@ class SaveMaskAPIView(APIView):
 
         # 1. Decode Mask
         try:
-            header, encoded = mask_data.split(",", 1)
-            mask_bytes = base64.b64decode(encoded)
+            mask_bytes = mask_upload_to_png(
+                mask_data,
+                request.data.get("mask_format"),
+                image_size=(task.image.height, task.image.width)
+            )
         except ValueError:
             return Response({"error": "Invalid mask data format"}, status=400)
 
@@ -0,0 +1,68 @@
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified
+from django.shortcuts import get_object_or_404
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.views import APIView
+
+from segmentation.models import Image
+from segmentation.services.deepzoom import descriptor, get_tile, tile_settings
+
+# Tile URLs name an Image row, whose file never changes: cache for a year
+TILE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
+def get_image(image_id):
+    return get_object_or_404(
+        Image.objects.only('id', 'file_path', 'checksum', 'previews'),
+        id=image_id
+    )
+
+
+def not_modified(request, etag):
+    return etag in request.headers.get('If-None-Match', '')
+
+
+class ImageTilesDescriptorAPIView(APIView):
+    """Deep Zoom descriptor (.dzi XML) of an image."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, image_id):
+        image = get_image(image_id)
+        tile_size, overlap, _ = tile_settings()
+        etag = f'"{image.checksum}-{tile_size}-{overlap}"'
+
+        if not_modified(request, etag):
+            response = HttpResponseNotModified()
+        else:
+            try:
+                response = HttpResponse(descriptor(image), content_type='application/xml')
+            except OSError:
+                raise Http404("Image file not found")
+
+        response['ETag'] = etag
+        response['Cache-Control'] = TILE_CACHE_CONTROL
+        return response
+
+
+class ImageTileAPIView(APIView):
+    """One JPEG tile; its level is rendered into the tile cache on first use."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, image_id, level, col, row):
+        image = get_image(image_id)
+        tile_size, overlap, _ = tile_settings()
+        etag = f'"{image.checksum}-{tile_size}-{overlap}-{level}-{col}-{row}"'
+
+        if not_modified(request, etag):
+            response = HttpResponseNotModified()
+        else:
+            try:
+                path = get_tile(image, level, col, row)
+            except ValueError as e:
+                raise Http404(str(e))
+            except OSError:
+                raise Http404("Image file not found")
+            response = FileResponse(open(path, 'rb'), content_type='image/jpeg')
+
+        response['ETag'] = etag
+        response['Cache-Control'] = TILE_CACHE_CONTROL
+        return response
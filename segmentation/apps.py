@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class SegmentationConfig(AppConfig):
     name = 'segmentation'
+
+    def ready(self):
+        # Cheap: reads settings only, torch is not imported here
+        from segmentation.ai.sam import log_admission_settings
+        log_admission_settings()
@@ -0,0 +1,90 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from segmentation.models import Batch, Dataset
+from segmentation.services.auto_segmentation import (
+    AUTO_SEGMENT_WORKERS,
+    auto_segment_dataset,
+    queue_auto_segmentation,
+    tasks_needing_draft,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Write SAM draft masks for every task of a dataset that has no "
+        "mask yet (resumes: tasks with a mask_path are skipped)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'target',
+            help="Batch.batch_id, or a dataset code (use --project if ambiguous)"
+        )
+        parser.add_argument('--project', help="Project code of the dataset")
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=AUTO_SEGMENT_WORKERS,
+            help="Inference worker threads"
+        )
+        parser.add_argument('--limit', type=int, help="Only process the first N images")
+        parser.add_argument(
+            '--background',
+            action='store_true',
+            help="Queue the run on the django-q cluster instead"
+        )
+
+    def get_dataset(self, options):
+        batch = (
+            Batch.objects
+            .select_related('dataset__project')
+            .filter(batch_id=options['target'])
+            .first()
+        )
+        if batch:
+            return batch.dataset
+
+        datasets = Dataset.objects.select_related('project').filter(code=options['target'])
+        if options['project']:
+            datasets = datasets.filter(project__code=options['project'])
+
+        datasets = list(datasets[:2])
+        if not datasets:
+            raise CommandError(f"No batch or dataset found: {options['target']}")
+        if len(datasets) > 1:
+            raise CommandError(
+                f"Dataset code {options['target']} exists in several projects, "
+                f"pass --project"
+            )
+        return datasets[0]
+
+    def handle(self, *args, **options):
+        dataset = self.get_dataset(options)
+        pending = tasks_needing_draft(dataset).order_by().values('image_id').distinct().count()
+        label = f"{dataset.project.code}/{dataset.code}"
+
+        if options['background']:
+            task_id = queue_auto_segmentation(
+                dataset,
+                workers=options['workers'],
+                limit=options['limit']
+            )
+            self.stdout.write(self.style.SUCCESS(
+                f"{label}: {pending} images queued for auto-segmentation (task {task_id})"
+            ))
+            return
+
+        self.stdout.write(f"{label}: {pending} images without a mask")
+
+        summary = auto_segment_dataset(
+            dataset,
+            workers=options['workers'],
+            limit=options['limit'],
+            progress=self.stdout.write
+        )
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{label}: {summary['tasks_done']} draft masks written "
+            f"({summary['tasks_skipped']} skipped, {summary['failed']} images failed) "
+            f"in {summary['seconds']}s, {summary['images_per_second']} images/s"
+        ))
@@ -0,0 +1,109 @@
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from segmentation.ai.image_io import inference_max_side, read_rgb
+from segmentation.utils.metrics import peak_rss_kb
+
+
+def _run_mode(file_path, max_side, repeat, with_encoder, result_queue):
+    """
+    Runs in a fresh (spawned) child process so the peak RSS reflects
+    only this mode.
+    """
+    import numpy as np
+
+    if with_encoder:
+        from segmentation.ai.sam import new_predictor
+        predictor = new_predictor()
+
+    baseline_kb = peak_rss_kb()
+    timings = []
+    shape = None
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        image = read_rgb(file_path, max_side)
+        if with_encoder:
+            predictor.set_image(image)
+            predictor.reset_image()
+        timings.append(time.perf_counter() - start)
+        shape = image.shape
+        del image
+
+    peak_kb = peak_rss_kb()
+
+    result_queue.put({
+        "decoded_shape": shape,
+        "median_ms": round(float(np.median(timings)) * 1000, 1),
+        "min_ms": round(min(timings) * 1000, 1),
+        "peak_rss_mb": round(peak_kb / 1024, 1) if peak_kb is not None else None,
+        "peak_rss_delta_mb": (
+            round((peak_kb - baseline_kb) / 1024, 1) if peak_kb is not None else None
+        ),
+    })
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare full-resolution vs reduced-resolution image decoding "
+        "for SAM inference (latency and peak RSS, one process per mode)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('image', help="Path to a (large) JPEG/PNG")
+        parser.add_argument(
+            '--max-side',
+            type=int,
+            default=None,
+            help="Reduced decode long side (default: SAM_INFERENCE_MAX_SIDE or 1024)"
+        )
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument(
+            '--with-encoder',
+            action='store_true',
+            help="Include the SAM image encoder in each timed iteration"
+        )
+
+    def handle(self, *args, **options):
+        max_side = options['max_side'] or inference_max_side() or 1024
+        context = multiprocessing.get_context('spawn')
+
+        results = {}
+        for label, mode_max_side in (('full', None), (f'reduced@{max_side}', max_side)):
+            result_queue = context.Queue()
+            process = context.Process(
+                target=_run_mode,
+                args=(
+                    options['image'],
+                    mode_max_side,
+                    options['repeat'],
+                    options['with_encoder'],
+                    result_queue,
+                )
+            )
+            process.start()
+            process.join()
+
+            if process.exitcode != 0:
+                raise CommandError(f"{label} run failed (exit code {process.exitcode})")
+
+            results[label] = result_queue.get()
+
+        for label, result in results.items():
+            self.stdout.write(
+                f"{label:>16}: {result['median_ms']:>8} ms median "
+                f"({result['min_ms']} min), peak RSS {result['peak_rss_mb']} MB "
+                f"(+{result['peak_rss_delta_mb']} MB), decoded {result['decoded_shape']}"
+            )
+
+        full, reduced = results.values()
+        if reduced['median_ms']:
+            summary = f"speedup x{full['median_ms'] / reduced['median_ms']:.1f}"
+            if full['peak_rss_delta_mb'] is not None:
+                summary += (
+                    f", peak RSS delta "
+                    f"{full['peak_rss_delta_mb'] - reduced['peak_rss_delta_mb']:+.1f} MB"
+                )
+            self.stdout.write(self.style.SUCCESS(summary))
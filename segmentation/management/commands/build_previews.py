@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from segmentation.models import Batch, Image
+from segmentation.services.deepzoom import write_all_levels
+from segmentation.services.previews import generate_dataset_previews
+
+
+class Command(BaseCommand):
+    help = (
+        "Build (or rebuild) the preview pyramid for the images of a batch, "
+        "e.g. for datasets uploaded before previews existed; --tiles also "
+        "pre-generates every Deep Zoom tile instead of cutting them on demand"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('batch_id', help="Batch.batch_id, e.g. upload_20240115_143022")
+        parser.add_argument('--workers', type=int, default=None)
+        parser.add_argument('--tiles', action='store_true', help="Also write all Deep Zoom tiles")
+
+    def handle(self, *args, **options):
+        try:
+            batch = Batch.objects.select_related('project', 'dataset').get(
+                batch_id=options['batch_id']
+            )
+        except Batch.DoesNotExist:
+            raise CommandError(f"Batch not found: {options['batch_id']}")
+
+        result = generate_dataset_previews(
+            batch.dataset,
+            workers=options['workers']
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"{batch.batch_id}: previews for {result['generated']} images, "
+            f"{result['failed']} failed"
+        ))
+
+        if options['tiles']:
+            tiles = 0
+            for image in Image.objects.filter(dataset=batch.dataset).only(
+                'id', 'file_path', 'checksum', 'previews'
+            ).iterator():
+                try:
+                    tiles += write_all_levels(image)
+                except (OSError, ValueError) as e:
+                    self.stderr.write(f"Image {image.id}: {e}")
+            self.stdout.write(self.style.SUCCESS(f"{tiles} tiles written"))
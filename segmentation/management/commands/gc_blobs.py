@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand
+
+from segmentation.services.blob_store import DEFAULT_GC_GRACE_SECONDS, collect_garbage
+from segmentation.services.chunked_upload import expire_uploads, upload_expiry_seconds
+
+
+class Command(BaseCommand):
+    help = (
+        "Recount blob references and delete image files (with their "
+        "previews and tiles) that no Image uses any more; abort chunked "
+        "uploads left unfinished"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--grace-hours',
+            type=float,
+            default=DEFAULT_GC_GRACE_SECONDS / 3600,
+            help="Keep unreferenced files touched more recently than this"
+        )
+        parser.add_argument(
+            '--upload-expiry-hours',
+            type=float,
+            default=None,
+            help="Abort chunked uploads idle for longer than this "
+                 "(default: CHUNKED_UPLOAD_EXPIRY_SECONDS)"
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help="Only report what would be deleted"
+        )
+
+    def handle(self, *args, **options):
+        expiry_hours = options['upload_expiry_hours']
+        expired = expire_uploads(
+            max_age_seconds=(
+                expiry_hours * 3600 if expiry_hours is not None else upload_expiry_seconds()
+            ),
+            dry_run=options['dry_run']
+        )
+        self.stdout.write(
+            f"{'Would abort' if options['dry_run'] else 'Aborted'} "
+            f"{expired['sessions']} stale chunked uploads "
+            f"({expired['bytes'] / (1024 * 1024):.1f} MB)"
+        )
+
+        result = collect_garbage(
+            grace_seconds=options['grace_hours'] * 3600,
+            dry_run=options['dry_run']
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"{'Would delete' if options['dry_run'] else 'Deleted'} "
+            f"{result['blobs']} unreferenced blobs and {result['orphans']} "
+            f"unregistered files ({result['bytes'] / (1024 * 1024):.1f} MB freed)"
+        ))
+        if result['restored']:
+            self.stdout.write(
+                f"Re-created {result['restored']} missing blob rows for files still in use"
+            )
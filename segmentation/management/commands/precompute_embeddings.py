@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from segmentation.models import Batch
+from segmentation.services.embedding_precompute import queue_embedding_precompute
+
+
+class Command(BaseCommand):
+    help = (
+        "Queue SAM embedding precompute for a batch (resumes: images "
+        "already in the embedding cache are skipped), or show progress"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('batch_id', help="Batch.batch_id, e.g. upload_20240115_143022")
+        parser.add_argument(
+            '--status',
+            action='store_true',
+            help="Only print precompute progress for the batch"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            batch = Batch.objects.get(batch_id=options['batch_id'])
+        except Batch.DoesNotExist:
+            raise CommandError(f"Batch not found: {options['batch_id']}")
+
+        if not options['status']:
+            result = queue_embedding_precompute(batch)
+            self.stdout.write(
+                f"{result['queued']} images queued in {result['tasks']} tasks "
+                f"({result['already_done']}/{result['total']} already cached)"
+            )
+            batch.refresh_from_db()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{batch.batch_id}: {batch.embeddings_done}/{batch.embeddings_total} "
+            f"embeddings ({batch.embedding_percentage()}%), "
+            f"{batch.embeddings_failed} failed"
+        ))
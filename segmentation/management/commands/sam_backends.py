@@ -0,0 +1,237 @@
+import json
+import multiprocessing
+import queue
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from segmentation.ai.image_io import inference_max_side, read_rgb
+from segmentation.utils.metrics import peak_rss_kb
+
+BACKEND_CHOICES = ('eager', 'int8', 'torchscript', 'onnx')
+
+
+def synthetic_images(count, seed=0):
+    """Smooth random blobs, so masks have some structure to compare."""
+    import cv2
+
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        noise = rng.integers(0, 255, (24, 32, 3), dtype=np.uint8)
+        images.append(cv2.resize(noise, (1024, 768), interpolation=cv2.INTER_CUBIC))
+    return images
+
+
+def mask_iou(a, b):
+    union = np.logical_or(a, b).sum()
+    if union == 0:
+        return 1.0
+    return float(np.logical_and(a, b).sum() / union)
+
+
+def _mb(kb):
+    return None if kb is None else round(kb / 1024, 1)
+
+
+def _run_backend(backend, image_paths, synthetic, repeat, result_queue):
+    """
+    Child process: load one backend, encode + decode every image.
+    Masks are returned bit-packed for the parent's IoU comparison.
+    """
+    try:
+        from segment_anything import SamPredictor
+        from segmentation.ai.inference import predict_from_prompts, predict_full_image
+        from segmentation.ai.sam import build_sam
+
+        rss_before_kb = peak_rss_kb()
+        start = time.perf_counter()
+        predictor = SamPredictor(build_sam(backend))
+        load_seconds = time.perf_counter() - start
+        rss_loaded_kb = peak_rss_kb()
+
+        if image_paths:
+            images = [read_rgb(path, inference_max_side()) for path in image_paths]
+        else:
+            images = synthetic_images(synthetic)
+
+        encode_ms = []
+        decode_ms = []
+        masks = []
+
+        for image in images:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                predictor.set_image(image)
+                encode_ms.append((time.perf_counter() - start) * 1000)
+
+            h, w = image.shape[:2]
+            start = time.perf_counter()
+            full = predict_full_image(predictor)
+            point, _, _ = predict_from_prompts(
+                predictor,
+                points=np.array([[w / 2, h / 2]], dtype=np.float32),
+                labels=np.array([1])
+            )
+            decode_ms.append((time.perf_counter() - start) * 1000 / 2)
+
+            masks.append((full.shape, np.packbits(full), np.packbits(point)))
+
+        result_queue.put({
+            "backend": backend,
+            "load_seconds": round(load_seconds, 2),
+            "encode_ms_median": round(float(np.median(encode_ms)), 1),
+            "encode_ms_min": round(float(np.min(encode_ms)), 1),
+            "decode_ms_median": round(float(np.median(decode_ms)), 1),
+            "model_rss_mb": (
+                _mb(rss_loaded_kb - rss_before_kb) if rss_before_kb is not None else None
+            ),
+            "peak_rss_mb": _mb(peak_rss_kb()),
+            "masks": masks,
+        })
+    except Exception as e:
+        result_queue.put({"backend": backend, "error": f"{type(e).__name__}: {e}"})
+
+
+class Command(BaseCommand):
+    help = (
+        "Export SAM to ONNX / TorchScript, or benchmark backends "
+        "(encoder latency, memory) with a mask-IoU parity check against fp32"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=('export', 'benchmark'))
+        parser.add_argument(
+            '--backends',
+            nargs='+',
+            choices=BACKEND_CHOICES,
+            default=list(BACKEND_CHOICES)
+        )
+        parser.add_argument('--images', nargs='+', help="Image files to benchmark on")
+        parser.add_argument(
+            '--synthetic',
+            type=int,
+            default=3,
+            help="Number of synthetic images when --images is not given"
+        )
+        parser.add_argument('--repeat', type=int, default=2, help="Encoder runs per image")
+        parser.add_argument(
+            '--min-iou',
+            type=float,
+            default=None,
+            help="Fail if any backend's mean mask IoU vs eager is below this"
+        )
+        parser.add_argument('--json', help="Write results to this file")
+        parser.add_argument('--force', action='store_true', help="Re-export even if up to date")
+
+    def handle(self, *args, **options):
+        if options['action'] == 'export':
+            return self.export(options)
+        return self.benchmark(options)
+
+    def export(self, options):
+        from segmentation.ai import sam
+        from segmentation.ai.backends import export_model
+
+        for backend in options['backends']:
+            if backend not in ('torchscript', 'onnx'):
+                continue
+            model = sam.build_sam('eager', device='cpu')
+            paths = export_model(
+                model,
+                backend,
+                model_type=sam.MODEL_TYPE,
+                checkpoint=sam.SAM_CHECKPOINT,
+                force=options['force']
+            )
+            for path in paths.values():
+                self.stdout.write(self.style.SUCCESS(f"{backend}: {path}"))
+
+    @staticmethod
+    def wait_for_result(backend, process, result_queue):
+        # Read before join(): the masks can exceed the pipe buffer
+        while True:
+            try:
+                return result_queue.get(timeout=1)
+            except queue.Empty:
+                if not process.is_alive():
+                    return {
+                        "backend": backend,
+                        "error": f"process exited with code {process.exitcode}"
+                    }
+
+    def benchmark(self, options):
+        backends = list(options['backends'])
+        if 'eager' not in backends:
+            backends.insert(0, 'eager')
+
+        # One process per backend: clean RSS numbers, and a crashing
+        # backend (e.g. missing onnxruntime) does not take down the rest.
+        # spawn works everywhere and starts without the parent's memory
+        context = multiprocessing.get_context('spawn')
+        results = {}
+
+        for backend in backends:
+            result_queue = context.Queue()
+            process = context.Process(
+                target=_run_backend,
+                args=(
+                    backend,
+                    options['images'],
+                    options['synthetic'],
+                    options['repeat'],
+                    result_queue,
+                )
+            )
+            process.start()
+            results[backend] = self.wait_for_result(backend, process, result_queue)
+            process.join()
+
+        reference = results['eager']
+        if 'error' in reference:
+            raise CommandError(f"eager backend failed: {reference['error']}")
+
+        reference_masks = reference['masks']
+        failed_parity = []
+        report = []
+
+        for backend, result in results.items():
+            if 'error' in result:
+                self.stdout.write(self.style.ERROR(f"{backend:>12}: {result['error']}"))
+                report.append({"backend": backend, "error": result['error']})
+                continue
+
+            ious = []
+            for (shape, full, point), (_, ref_full, ref_point) in zip(
+                result.pop('masks'), reference_masks
+            ):
+                size = shape[0] * shape[1]
+                for packed, ref_packed in ((full, ref_full), (point, ref_point)):
+                    ious.append(mask_iou(
+                        np.unpackbits(packed, count=size).astype(bool),
+                        np.unpackbits(ref_packed, count=size).astype(bool)
+                    ))
+
+            result["iou_mean"] = round(float(np.mean(ious)), 4)
+            result["iou_min"] = round(float(np.min(ious)), 4)
+            report.append(result)
+
+            self.stdout.write(
+                f"{backend:>12}: encode {result['encode_ms_median']:>8} ms "
+                f"(min {result['encode_ms_min']}), decode {result['decode_ms_median']} ms, "
+                f"model +{result['model_rss_mb']} MB, peak {result['peak_rss_mb']} MB, "
+                f"IoU vs fp32 {result['iou_mean']} (min {result['iou_min']})"
+            )
+
+            if options['min_iou'] is not None and result['iou_mean'] < options['min_iou']:
+                failed_parity.append(backend)
+
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump(report, f, indent=4)
+
+        if failed_parity:
+            raise CommandError(
+                f"Mask IoU below {options['min_iou']}: {', '.join(failed_parity)}"
+            )
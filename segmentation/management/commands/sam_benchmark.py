@@ -0,0 +1,113 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from segmentation.ai.benchmark import (
+    DEFAULT_SIZES,
+    SCENARIOS,
+    compare,
+    parse_size,
+    run_benchmark,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the SAM inference path on synthetic images: per-stage "
+        "p50/p95 latency and peak memory, burst throughput, JSON output"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            nargs='+',
+            default=[f"{w}x{h}" for w, h in DEFAULT_SIZES],
+            help="Image sizes as WIDTHxHEIGHT"
+        )
+        parser.add_argument(
+            '--scenarios',
+            nargs='+',
+            choices=SCENARIOS,
+            default=list(SCENARIOS)
+        )
+        parser.add_argument('--iterations', type=int, default=10, help="Timed runs per size")
+        parser.add_argument('--warmup', type=int, default=2, help="Untimed runs per size")
+        parser.add_argument(
+            '--burst',
+            type=int,
+            default=8,
+            help="Jobs submitted at once for the throughput figure (0 skips it)"
+        )
+        parser.add_argument('--workers', type=int, help="Scheduler worker threads")
+        parser.add_argument(
+            '--tiny',
+            action='store_true',
+            help="Use a tiny randomly initialised SAM instead of the checkpoint"
+        )
+        parser.add_argument('--json', help="Write results to this file")
+        parser.add_argument(
+            '--baseline',
+            help="Results file of an earlier run to compare total p50 against"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [parse_size(value) for value in options['sizes']]
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options['iterations'] < 1:
+            raise CommandError("--iterations must be at least 1")
+
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+
+        report = run_benchmark(
+            sizes=sizes,
+            scenarios=options['scenarios'],
+            iterations=options['iterations'],
+            warmup=options['warmup'],
+            burst=options['burst'],
+            workers=options['workers'],
+            tiny=options['tiny'],
+            progress=lambda label: self.stderr.write(f"running {label}")
+        )
+
+        meta = report['meta']
+        self.stdout.write(
+            f"SAM {meta['model']} ({meta['backend']}, {meta['device']}) at "
+            f"{meta['revision'] or 'unknown revision'}, {meta['workers']} workers, "
+            f"{meta['torch_threads']} torch threads, {meta['cpu_count']} CPUs"
+        )
+
+        for result in report['results']:
+            self.stdout.write(f"\n{result['scenario']} {result['size']}")
+            for name, s in result['stages_ms'].items():
+                memory = (
+                    f", peak +{s['peak_memory_mb']} MB"
+                    if s['peak_memory_mb'] is not None else ""
+                )
+                self.stdout.write(
+                    f"  {name:>18}: p50 {s['p50']:>9} ms  p95 {s['p95']:>9} ms{memory}"
+                )
+            if result['throughput']:
+                throughput = result['throughput']
+                self.stdout.write(
+                    f"  {'throughput':>18}: {throughput['per_second']}/s "
+                    f"({throughput['jobs']} jobs, {throughput['failed']} failed)"
+                )
+
+        self.stdout.write(f"\npeak RSS {meta['peak_rss_mb']} MB")
+
+        if baseline:
+            self.stdout.write(
+                f"\ntotal p50 vs {baseline.get('meta', {}).get('revision') or options['baseline']}"
+            )
+            for scenario, size, old, new, ratio in compare(report, baseline):
+                self.stdout.write(f"  {scenario} {size}: {old} -> {new} ms (x{ratio})")
+
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump(report, f, indent=4)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['json']}"))
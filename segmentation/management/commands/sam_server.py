@@ -0,0 +1,58 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand, CommandError
+
+from segmentation.ai.sam import model_status, warm_up
+from segmentation.ai.server import SERVER_SOCKET, InferenceServer
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the SAM inference server on a Unix socket; web workers send "
+        "it their AI requests instead of loading the model themselves"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--socket',
+            default=SERVER_SOCKET,
+            help="Unix socket path (default: settings.SAM_SERVER_SOCKET)"
+        )
+
+    def handle(self, *args, **options):
+        socket_path = options['socket']
+        if not socket_path:
+            raise CommandError("No socket path: pass --socket or set SAM_SERVER_SOCKET")
+
+        if InferenceServer is None:
+            raise CommandError("Unix sockets are not supported on this platform")
+
+        if not model_status()["checkpoint_exists"]:
+            raise CommandError(f"SAM checkpoint not found: {model_status()['checkpoint']}")
+
+        status = warm_up()
+        self.stdout.write(
+            f"SAM {status['model_type']} loaded on {status['device']} "
+            f"in {status['load_seconds']}s"
+        )
+
+        try:
+            server = InferenceServer(socket_path)
+        except (OSError, RuntimeError) as e:
+            raise CommandError(str(e))
+
+        # serve_forever() must be stopped from another thread
+        def stop(signum, frame):
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        self.stdout.write(self.style.SUCCESS(f"Inference server listening on {socket_path}"))
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+        self.stdout.write("Inference server stopped")
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from segmentation.ai.sam import model_status, warm_up
+
+
+class Command(BaseCommand):
+    help = "Load the SAM model ahead of traffic and report readiness"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--encode',
+            action='store_true',
+            help="Also run one dummy image through the image encoder"
+        )
+
+    def handle(self, *args, **options):
+        status = model_status()
+
+        if not status["checkpoint_exists"]:
+            raise CommandError(
+                f"SAM checkpoint not found: {status['checkpoint']}"
+            )
+
+        status = warm_up(run_encoder=options['encode'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"SAM {status['model_type']} ready on {status['device']} "
+            f"(loaded in {status['load_seconds']}s)"
+        ))
+
+        admission = status["admission"]
+        self.stdout.write(
+            f"{admission['max_concurrent_inferences']} concurrent inferences x "
+            f"{admission['torch_threads']} torch threads "
+            f"({admission['torch_interop_threads']} inter-op) on "
+            f"{admission['cpu_count']} CPUs, queue timeout "
+            f"{admission['queue_timeout_seconds']}s"
+        )
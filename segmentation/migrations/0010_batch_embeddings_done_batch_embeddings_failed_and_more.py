@@ -0,0 +1,28 @@
+# Generated by Django 5.2 on 2026-10-17 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmentation', '0009_taskreview_duration_taskreview_end_time_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='batch',
+            name='embeddings_done',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='batch',
+            name='embeddings_failed',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='batch',
+            name='embeddings_total',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2 on 2026-10-17 16:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmentation', '0010_batch_embeddings_done_batch_embeddings_failed_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='batch',
+            name='error_message',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='batch',
+            name='failures',
+            field=models.JSONField(blank=True, default=list, help_text='First failed files ({filename, error})'),
+        ),
+        migrations.AddField(
+            model_name='batch',
+            name='images_duplicate',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='batch',
+            name='stage_timings',
+            field=models.JSONField(blank=True, default=dict, help_text='Seconds per pipeline stage, filled in as stages finish'),
+        ),
+    ]
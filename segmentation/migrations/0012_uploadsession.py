@@ -0,0 +1,34 @@
+# Generated by Django 5.2 on 2026-10-17 16:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmentation', '0011_batch_background_progress'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('upload_id', models.CharField(max_length=32, unique=True)),
+                ('file_name', models.CharField(max_length=255)),
+                ('total_size', models.BigIntegerField(help_text='Archive size in bytes')),
+                ('part_size', models.PositiveIntegerField(help_text='Bytes per part (last part may be shorter)')),
+                ('total_parts', models.PositiveIntegerField()),
+                ('parts', models.JSONField(blank=True, default=dict, help_text='Received parts: {part number: {size, sha256}}')),
+                ('status', models.CharField(choices=[('OPEN', 'Open'), ('COMPLETED', 'Completed'), ('ABORTED', 'Aborted')], default='OPEN', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('batch', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='upload_sessions', to='segmentation.batch')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to='segmentation.project')),
+                ('uploaded_by', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='upload_sessions', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
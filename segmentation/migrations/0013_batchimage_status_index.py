@@ -0,0 +1,26 @@
+# Generated by Django 5.2 on 2026-10-17 17:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmentation', '0012_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='batchimage',
+            options={'ordering': ['id']},
+        ),
+        migrations.AlterField(
+            model_name='batchimage',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'Pending'), ('EXTRACTED', 'Extracted'), ('STORED', 'Stored'), ('DUPLICATE', 'Duplicate'), ('FAILED', 'Failed')], default='PENDING', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='batchimage',
+            index=models.Index(fields=['batch', 'status'], name='segmentatio_batch_i_613b1a_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-17 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmentation', '0013_batchimage_status_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='previews',
+            field=models.JSONField(blank=True, default=dict, help_text='Downscaled JPEG paths by longest side ({"256": path, ...})'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2 on 2026-10-17 19:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmentation', '0014_image_previews'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('checksum', models.CharField(max_length=64, unique=True)),
+                ('file_path', models.CharField(max_length=500)),
+                ('file_size', models.BigIntegerField(help_text='File size in bytes')),
+                ('ref_count', models.PositiveIntegerField(default=0, help_text='Image rows referencing this file (recounted by gc_blobs)')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['ref_count', 'updated_at'], name='segmentatio_ref_cou_d2ae84_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2 on 2026-10-17 21:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_segmenter(apps, schema_editor):
+    """Existing tasks: owned by their assignee, else the dataset creator."""
+    SegmentationTask = apps.get_model('segmentation', 'SegmentationTask')
+
+    tasks = SegmentationTask.objects.filter(segmenter__isnull=True).select_related('image__dataset')
+    for task in tasks.iterator():
+        task.segmenter_id = task.assigned_to_id or task.image.dataset.created_by_id
+        task.save(update_fields=['segmenter'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmentation', '0015_blob'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='segmentationtask',
+            name='segmenter',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='owned_segmentation_tasks', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(fill_segmenter, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='segmentationtask',
+            name='segmenter',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='owned_segmentation_tasks', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
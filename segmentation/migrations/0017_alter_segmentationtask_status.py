@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-17 21:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('segmentation', '0016_segmentationtask_segmenter'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='segmentationtask',
+            name='status',
+            field=models.CharField(choices=[('ASSIGNED', 'Assigned'), ('IN_PROGRESS', 'In Progress'), ('QC_REVIEW', 'QC Review'), ('QA_REVIEW', 'QA Review'), ('COMPLETED', 'Completed')], default='PENDING', max_length=20),
+        ),
+    ]
@@ -123,6 +123,12 @@ class Image(models.Model):
         help_text="SHA256 checksum for duplicate detection"
     )
 
+    previews = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text="Downscaled JPEG paths by longest side ({\"256\": path, ...})"
+    )
+
     status = models.CharField(
         max_length=20,
         choices=IMAGE_STATUS_CHOICES,
@@ -356,6 +362,25 @@ class Batch(models.Model):
     assigned_tasks = models.PositiveIntegerField(default=0)
     unassigned_tasks = models.PositiveIntegerField(default=0)
 
+    # SAM embedding precompute progress (optional ingest stage)
+    embeddings_total = models.PositiveIntegerField(default=0)
+    embeddings_done = models.PositiveIntegerField(default=0)
+    embeddings_failed = models.PositiveIntegerField(default=0)
+
+    # Background processing progress
+    images_duplicate = models.PositiveIntegerField(default=0)
+    stage_timings = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text="Seconds per pipeline stage, filled in as stages finish"
+    )
+    failures = models.JSONField(
+        default=list,
+        blank=True,
+        help_text="First failed files ({filename, error})"
+    )
+    error_message = models.TextField(null=True, blank=True)
+
     created_at = models.DateTimeField(auto_now_add=True)
     completed_at = models.DateTimeField(null=True, blank=True)
 
@@ -367,15 +392,48 @@ class Batch(models.Model):
             return 0
         return round((self.images_extracted / self.total_images) * 100, 2)
 
+    def embedding_percentage(self):
+        if self.embeddings_total == 0:
+            return 0
+        return round((self.embeddings_done / self.embeddings_total) * 100, 2)
+
     def __str__(self):
         return self.batch_id
 
 
+class Blob(models.Model):
+    """
+    One file in the content-addressed image store. Image rows point at
+    it through file_path / checksum; ref_count is how many do.
+    """
+    checksum = models.CharField(max_length=64, unique=True)
+
+    file_path = models.CharField(max_length=500)
+    file_size = models.BigIntegerField(help_text="File size in bytes")
+
+    ref_count = models.PositiveIntegerField(
+        default=0,
+        help_text="Image rows referencing this file (recounted by gc_blobs)"
+    )
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['ref_count', 'updated_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.checksum[:12]} ({self.ref_count} refs)"
+
+
 class BatchImage(models.Model):
     IMAGE_STATUS_CHOICES = [
         ('PENDING', 'Pending'),
         ('EXTRACTED', 'Extracted'),
         ('STORED', 'Stored'),
+        ('DUPLICATE', 'Duplicate'),
         ('FAILED', 'Failed'),
     ]
 
@@ -405,10 +463,79 @@ class BatchImage(models.Model):
 
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['batch', 'status']),
+        ]
+        ordering = ['id']
+
     def __str__(self):
         return f"{self.original_filename} ({self.status})"
 
 
+class UploadSession(models.Model):
+    """
+    A resumable chunked ZIP upload: parts are written into the archive
+    on disk as they arrive and it is queued for ingest on completion.
+    """
+    UPLOAD_STATUS_CHOICES = [
+        ('OPEN', 'Open'),
+        ('COMPLETED', 'Completed'),
+        ('ABORTED', 'Aborted'),
+    ]
+
+    upload_id = models.CharField(max_length=32, unique=True)
+
+    project = models.ForeignKey(
+        'segmentation.Project',
+        on_delete=models.CASCADE,
+        related_name='upload_sessions'
+    )
+
+    uploaded_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.PROTECT,
+        related_name='upload_sessions'
+    )
+
+    file_name = models.CharField(max_length=255)
+    total_size = models.BigIntegerField(help_text="Archive size in bytes")
+    part_size = models.PositiveIntegerField(help_text="Bytes per part (last part may be shorter)")
+    total_parts = models.PositiveIntegerField()
+
+    parts = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text="Received parts: {part number: {size, sha256}}"
+    )
+
+    status = models.CharField(
+        max_length=20,
+        choices=UPLOAD_STATUS_CHOICES,
+        default='OPEN'
+    )
+
+    batch = models.ForeignKey(
+        'segmentation.Batch',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='upload_sessions'
+    )
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def missing_parts(self):
+        return [
+            n for n in range(1, self.total_parts + 1)
+            if str(n) not in self.parts
+        ]
+
+    def __str__(self):
+        return f"{self.upload_id} ({self.status})"
+
+
 
 class TaskReview(models.Model):
     REVIEW_TYPE_CHOICES = [
@@ -0,0 +1,229 @@
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django_q.tasks import async_task
+
+from segmentation.ai.image_io import inference_max_side, read_rgb
+from segmentation.ai.inference import predict_full_image
+from segmentation.ai.scheduler import (
+    DEFAULT_BATCH_WAIT_MS,
+    DEFAULT_MAX_BATCH_SIZE,
+    InferenceScheduler,
+)
+from segmentation.models import Dataset, SegmentationTask
+
+logger = logging.getLogger(__name__)
+
+# Inference worker threads for offline runs
+AUTO_SEGMENT_WORKERS = getattr(settings, "SAM_AUTO_SEGMENT_WORKERS", 2)
+
+# Log throughput every N images
+PROGRESS_EVERY = 25
+
+# Only tasks nobody has opened yet get a draft
+DRAFT_TASK_STATUSES = ('PENDING', 'ASSIGNED')
+
+
+def task_annotation_dir(task):
+    """Same layout SaveMaskAPIView writes to."""
+    dataset = task.image.dataset
+    return os.path.join(
+        settings.MEDIA_ROOT,
+        'projects',
+        dataset.project.code,
+        'datasets',
+        dataset.code,
+        'annotations',
+        f'task_{task.id}'
+    )
+
+
+def tasks_needing_draft(dataset):
+    """
+    Tasks of a dataset without a mask yet. A task gets its mask_path as
+    soon as its draft is written, so this is also the resume point of
+    an interrupted run.
+    """
+    return (
+        SegmentationTask.objects
+        .filter(image__dataset=dataset, status__in=DRAFT_TASK_STATUSES)
+        .filter(Q(mask_path__isnull=True) | Q(mask_path=''))
+        .select_related('image', 'image__dataset', 'image__dataset__project')
+        .order_by('image_id', 'id')
+    )
+
+
+def write_draft_mask(task, png_bytes):
+    """
+    Write mask.png atomically and point the task at it, unless a
+    segmenter saved a mask in the meantime.
+
+    The file is moved into place before the row is updated, with the
+    row locked: a run killed in between leaves mask_path empty, so the
+    task is simply segmented again on resume.
+    """
+    task_dir = task_annotation_dir(task)
+    os.makedirs(task_dir, exist_ok=True)
+
+    mask_path = os.path.join(task_dir, 'mask.png')
+    tmp_path = f"{mask_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(png_bytes)
+
+    try:
+        with transaction.atomic():
+            draft = bool(list(
+                SegmentationTask.objects
+                .select_for_update()
+                .filter(pk=task.pk)
+                .filter(Q(mask_path__isnull=True) | Q(mask_path=''))
+                .values_list('pk', flat=True)
+            ))
+            if draft:
+                os.replace(tmp_path, mask_path)
+                SegmentationTask.objects.filter(pk=task.pk).update(mask_path=mask_path)
+    finally:
+        # Skipped, or the move / update failed
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return draft
+
+
+def auto_segment_dataset(dataset, workers=AUTO_SEGMENT_WORKERS, limit=None, progress=None):
+    """
+    Run SAM full-image pre-segmentation over every task of a dataset
+    that has no mask yet and save the result as its draft mask.
+
+    Images are decoded and encoded by a private InferenceScheduler
+    (`workers` threads sharing one model), with at most one queue's
+    worth of images in flight.
+
+    Returns:
+        {
+            "images": int,
+            "tasks_done": int,
+            "tasks_skipped": int,
+            "failed": int,
+            "seconds": float,
+            "images_per_second": float
+        }
+    """
+    tasks_by_image = {}
+    for task in tasks_needing_draft(dataset):
+        tasks_by_image.setdefault(task.image_id, []).append(task)
+
+    image_ids = list(tasks_by_image)
+    if limit is not None:
+        image_ids = image_ids[:limit]
+
+    workers = max(1, workers)
+    max_in_flight = workers * DEFAULT_MAX_BATCH_SIZE * 2
+    scheduler = InferenceScheduler(
+        workers=workers,
+        max_queue_depth=max_in_flight,
+        max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+        max_wait_ms=DEFAULT_BATCH_WAIT_MS
+    )
+
+    summary = {
+        "images": len(image_ids),
+        "tasks_done": 0,
+        "tasks_skipped": 0,
+        "failed": 0,
+    }
+    in_flight = {}
+    processed = 0
+    start = time.perf_counter()
+
+    def submit(image_id):
+        image = tasks_by_image[image_id][0].image
+
+        def run(predictor):
+            mask = predict_full_image(predictor, (image.height, image.width))
+            ok, buffer = cv2.imencode(".png", mask.astype(np.uint8) * 255)
+            if not ok:
+                raise ValueError("Could not encode mask")
+            return buffer.tobytes()
+
+        future = scheduler.submit(
+            image.checksum,
+            lambda: read_rgb(image.file_path, inference_max_side()),
+            run
+        )
+        in_flight[future] = image_id
+
+    def report():
+        elapsed = time.perf_counter() - start
+        rate = processed / elapsed if elapsed else 0.0
+        message = (
+            f"{processed}/{len(image_ids)} images, "
+            f"{rate:.2f} images/s, {summary['failed']} failed"
+        )
+        logger.info("Auto-segmentation %s: %s", dataset.code, message)
+        if progress:
+            progress(message)
+
+    pending = iter(image_ids)
+    for image_id in pending:
+        submit(image_id)
+        if len(in_flight) >= max_in_flight:
+            break
+
+    try:
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                image_id = in_flight.pop(future)
+                tasks = tasks_by_image[image_id]
+                processed += 1
+
+                try:
+                    png_bytes = future.result()
+                    for task in tasks:
+                        if write_draft_mask(task, png_bytes):
+                            summary["tasks_done"] += 1
+                        else:
+                            summary["tasks_skipped"] += 1
+                except Exception:
+                    logger.exception("Auto-segmentation failed for image %s", image_id)
+                    summary["failed"] += 1
+
+                if processed % PROGRESS_EVERY == 0:
+                    report()
+
+                next_id = next(pending, None)
+                if next_id is not None:
+                    submit(next_id)
+    finally:
+        scheduler.shutdown()
+
+    elapsed = time.perf_counter() - start
+    summary["seconds"] = round(elapsed, 2)
+    summary["images_per_second"] = round(processed / elapsed, 2) if elapsed else 0.0
+    report()
+    return summary
+
+
+def queue_auto_segmentation(dataset, workers=AUTO_SEGMENT_WORKERS, limit=None):
+    """Run auto_segment_dataset on the django-q cluster."""
+    return async_task(
+        'segmentation.services.auto_segmentation.run_auto_segmentation',
+        dataset.pk,
+        workers,
+        limit,
+        group=f"auto_segment_{dataset.project.code}_{dataset.code}"
+    )
+
+
+def run_auto_segmentation(dataset_pk, workers, limit=None):
+    """django-q task entry point."""
+    dataset = Dataset.objects.select_related('project').get(pk=dataset_pk)
+    return auto_segment_dataset(dataset, workers=workers, limit=limit)
@@ -1,220 +1,311 @@
+import heapq
+import logging
+import shutil
 import zipfile
 import os
-from PIL import Image as PILImage
 from segmentation.models import Image
-import uuid
-import shutil
 from django.conf import settings
-import hashlib
-from django.core.files.storage import default_storage
 from segmentation.models import SegmentationTask
-from django.db.models import F
 from segmentation.models import ProjectEmployeeMapping
 import time
+import uuid
 from django.utils import timezone
-from segmentation.models import Batch
+from segmentation.models import Batch, BatchImage
 from segmentation.models import Dataset
 from django.db import transaction
 from django.db.models import F
+from segmentation.services.blob_store import refresh_ref_counts, register_blobs
+from segmentation.services.embedding_precompute import queue_embedding_precompute
+from segmentation.services.previews import generate_dataset_previews
+from segmentation.services.zip_ingest import image_members, ingest_zip
+from segmentation.utils.media import blob_root
+from django_q.tasks import async_task
 
-# Allowed image formats
-ALLOWED_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+logger = logging.getLogger(__name__)
 
 # Max ZIP size: 500 MB
 MAX_ZIP_SIZE = 500 * 1024 * 1024  
 
+# Image rows per duplicate lookup / bulk insert
+DEFAULT_IMAGE_BULK_BATCH_SIZE = 500
+
+# Failed files kept on the Batch for the status endpoint
+FAILURE_SAMPLE_SIZE = 100
+
 
-def validate_zip_file(zip_file):
+def validate_zip_file(zip_file, max_size=MAX_ZIP_SIZE):
     """
-    Validates uploaded ZIP file.
+    Validates uploaded ZIP file (upload or path): size and central
+    directory only.
+    Members are checked while they are ingested (see zip_ingest), so
+    nothing is decompressed here.
     Returns:
         (is_valid, result_dict)
     """
 
     # 1. File size check
-    if zip_file.size > MAX_ZIP_SIZE:
+    size = (
+        os.path.getsize(zip_file) if isinstance(zip_file, (str, os.PathLike))
+        else zip_file.size
+    )
+    if size > max_size:
         return False, {
-            "error": "ZIP file exceeds 500MB limit"
+            "error": f"ZIP file exceeds {max_size // (1024 * 1024)}MB limit"
         }
 
-    # 2. ZIP integrity check
+    # 2. ZIP structure check
     try:
         with zipfile.ZipFile(zip_file) as zf:
-            bad_file = zf.testzip()
-            if bad_file:
-                return False, {
-                    "error": f"Corrupted file found: {bad_file}"
-                }
+            total_files = len(image_members(zf))
     except zipfile.BadZipFile:
         return False, {
             "error": "Invalid ZIP file"
         }
 
-    valid_images = []
-    failed_images = []
-
-    # 3. Validate image files inside ZIP
-    with zipfile.ZipFile(zip_file) as zf:
-        for file_name in zf.namelist():
+    return True, {
+        "total_files": total_files,
+    }
 
-            # Ignore folders
-            if file_name.endswith('/'):
-                continue
 
-            # Extension check
-            if not file_name.lower().endswith(ALLOWED_EXTENSIONS):
-                failed_images.append({
-                    "filename": file_name,
-                    "error": "Unsupported file format"
-                })
-                continue
+def image_bulk_batch_size():
+    return getattr(settings, 'IMAGE_BULK_BATCH_SIZE', DEFAULT_IMAGE_BULK_BATCH_SIZE)
 
-            # Try opening image
-            try:
-                with zf.open(file_name) as img_file:
-                    img = PILImage.open(img_file)
-                    width, height = img.size
-
-                    if width < 256 or height < 256:
-                        failed_images.append({
-                            "filename": file_name,
-                            "error": "Image dimensions below 256x256"
-                        })
-                        continue
-
-                    valid_images.append({
-                        "filename": file_name,
-                        "width": width,
-                        "height": height
-                    })
-
-            except Exception:
-                failed_images.append({
-                    "filename": file_name,
-                    "error": "Unreadable image file"
-                })
 
-    return True, {
-        "total_files": len(valid_images) + len(failed_images),
-        "valid_images": valid_images,
-        "failed_images": failed_images,
-        "valid_count": len(valid_images),
-        "failed_count": len(failed_images),
-    }
+def _register_chunk(dataset, stored, seen_checksums, batch_size):
+    """
+    Create Image rows for one chunk of ingested files: one checksum__in
+    query for duplicates, then bulk_create, plus one insert of new Blob
+    rows and one ref_count refresh. Files live in the blob store, so
+    duplicates only skip the row; their file is the one already
+    referenced.
 
+    seen_checksums maps checksum -> Image id for earlier chunks of the
+    same upload and is updated with this chunk.
 
-def extract_zip_to_temp(zip_file, batch_id=None):
-    """
-    Extracts ZIP file to a temporary directory.
     Returns:
-        temp_dir_path
+        [(result, image_id, created)], one per stored result
     """
+    known = dict(
+        Image.objects
+        .filter(dataset=dataset, checksum__in={r["checksum"] for r in stored})
+        .values_list('checksum', 'id')
+    )
+    known.update(seen_checksums)
+
+    new_images = {}
+    # Index in `stored` of the result each new Image was made from
+    creators = {}
+
+    for index, result in enumerate(stored):
+        checksum = result["checksum"]
+        if checksum in known or checksum in new_images:
+            continue
+
+        creators[checksum] = index
+        new_images[checksum] = Image(
+            dataset=dataset,
+            file_name=result["file_name"],
+            file_path=result["file_path"],
+            width=result["width"],
+            height=result["height"],
+            file_size=result["file_size"],
+            checksum=checksum,
+            status='UPLOADED'
+        )
+
+    with transaction.atomic():
+        register_blobs(stored)
+        Image.objects.bulk_create(new_images.values(), batch_size=batch_size)
+        refresh_ref_counts(new_images.keys())
 
-    # Generate batch id if not provided
-    if not batch_id:
-        batch_id = f"upload_{uuid.uuid4().hex[:8]}"
+    seen_checksums.update(
+        (checksum, image.pk) for checksum, image in new_images.items()
+    )
 
-    temp_root = os.path.join(settings.MEDIA_ROOT, 'temp')
-    temp_dir = os.path.join(temp_root, f'unzip_{batch_id}')
+    outcomes = []
+    for index, result in enumerate(stored):
+        checksum = result["checksum"]
+        if checksum in new_images:
+            outcomes.append((result, new_images[checksum].pk, creators[checksum] == index))
+        else:
+            outcomes.append((result, known[checksum], False))
+    return outcomes
 
-    # Ensure clean temp directory
-    if os.path.exists(temp_dir):
-        shutil.rmtree(temp_dir)
 
-    os.makedirs(temp_dir, exist_ok=True)
+def create_batch_images(batch, zip_file, batch_size):
+    """
+    One PENDING BatchImage per archive member, bulk-created in chunks.
+    Rows from an earlier attempt at the same batch are replaced.
 
-    with zipfile.ZipFile(zip_file) as zf:
-        zf.extractall(temp_dir)
+    Returns:
+        {archive member name: [BatchImage, ...]} (a list, as names can
+        repeat inside a ZIP)
+    """
+    BatchImage.objects.filter(batch=batch).delete()
 
-    return temp_dir
+    with zipfile.ZipFile(zip_file) as zf:
+        names = [info.filename for info in image_members(zf)]
+    if hasattr(zip_file, 'seek'):
+        zip_file.seek(0)
 
+    records = {}
+    for start in range(0, len(names), batch_size):
+        chunk = names[start:start + batch_size]
+        rows = BatchImage.objects.bulk_create([
+            BatchImage(batch=batch, original_filename=name[:500], status='PENDING')
+            for name in chunk
+        ])
+        for name, row in zip(chunk, rows):
+            records.setdefault(name, []).append(row)
 
-def calculate_checksum(file_path):
-    """Calculate SHA256 checksum of a file"""
-    sha256 = hashlib.sha256()
-    with open(file_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(8192), b''):
-            sha256.update(chunk)
-    return sha256.hexdigest()
+    return records
 
 
-def save_images_to_dataset(temp_dir, project, dataset):
+def save_images_to_dataset(zip_file, project, dataset, batch_size=None, progress=None, batch=None):
     """
-    Move images from temp directory to final dataset folder
-    and create Image records.
+    Stream images from the ZIP into the blob store and create Image
+    records, batch_size (IMAGE_BULK_BATCH_SIZE) at a time: per chunk
+    one duplicate lookup and one bulk insert, so the query count does
+    not grow per image.
+
+    With a batch, every archive member also gets a BatchImage row:
+    created PENDING up front, then bulk-updated chunk by chunk to
+    STORED / DUPLICATE / FAILED as its outcome is known.
+
+    progress(created, duplicates, failed), if given, is called after
+    every chunk with the running totals.
 
     Returns:
         {
             "created": int,
             "duplicates": int,
+            "blobs_reused": int,   # files already in the store, not written again
             "failed": list
         }
     """
 
+    batch_size = batch_size or image_bulk_batch_size()
+
     created_count = 0
     duplicate_count = 0
+    reused_count = 0
     failed_images = []
 
-    final_dir = os.path.join(
-        project.storage_path,
-        'datasets',
-        dataset.code,
-        'original_images'
-    )
+    # Checksum -> Image id registered by earlier chunks of this upload
+    seen_checksums = {}
+    pending = []
+
+    records = create_batch_images(batch, zip_file, batch_size) if batch else None
+    # BatchImage rows with their outcome, waiting for the next bulk_update
+    finished = []
+
+    def record(filename, status, image_id=None, error=None):
+        if records is None:
+            return
+        row = records[filename].pop(0)
+        row.status = status
+        row.image_id = image_id
+        row.error_message = error
+        finished.append(row)
+
+    def fail(filename, error):
+        failed_images.append({
+            "filename": filename,
+            "error": error
+        })
+        record(filename, 'FAILED', error=error)
+
+    def flush():
+        nonlocal created_count, duplicate_count
+
+        if pending:
+            try:
+                outcomes = _register_chunk(
+                    dataset, pending, seen_checksums, batch_size
+                )
+            except Exception as e:
+                # Blob files stay; gc_blobs removes them if unreferenced
+                for result in pending:
+                    fail(result["filename"], str(e))
+            else:
+                for result, image_id, created in outcomes:
+                    if created:
+                        created_count += 1
+                    else:
+                        duplicate_count += 1
+                    record(
+                        result["filename"],
+                        'STORED' if created else 'DUPLICATE',
+                        image_id=image_id
+                    )
 
-    os.makedirs(final_dir, exist_ok=True)
+            pending.clear()
 
-    for root, _, files in os.walk(temp_dir):
-        for file_name in files:
+        if finished:
+            BatchImage.objects.bulk_update(
+                finished,
+                ['status', 'image', 'error_message'],
+                batch_size=batch_size
+            )
+            finished.clear()
 
-            src_path = os.path.join(root, file_name)
-            dest_path = os.path.join(final_dir, file_name)
+        if progress:
+            progress(created_count, duplicate_count, len(failed_images))
 
-            try:
-                checksum = calculate_checksum(src_path)
-
-                # Duplicate check (same dataset)
-                if Image.objects.filter(
-                    dataset=dataset,
-                    checksum=checksum
-                ).exists():
-                    duplicate_count += 1
-                    continue
-
-                # Read image properties
-                with PILImage.open(src_path) as img:
-                    width, height = img.size
-
-                file_size = os.path.getsize(src_path)
-
-                # Move file
-                shutil.move(src_path, dest_path)
-
-                # Create DB record
-                Image.objects.create(
-                    dataset=dataset,
-                    file_name=file_name,
-                    file_path=dest_path,
-                    width=width,
-                    height=height,
-                    file_size=file_size,
-                    checksum=checksum,
-                    status='UPLOADED'
-                )
+    for result in ingest_zip(zip_file, blob_root()):
 
-                created_count += 1
+        if "error" in result:
+            fail(result["filename"], result["error"])
+        else:
+            reused_count += not result["new_blob"]
+            pending.append(result)
 
-            except Exception as e:
-                failed_images.append({
-                    "filename": file_name,
-                    "error": str(e)
-                })
+        if len(pending) + len(finished) >= batch_size:
+            flush()
+
+    flush()
 
     return {
         "created": created_count,
         "duplicates": duplicate_count,
+        "blobs_reused": reused_count,
         "failed": failed_images
     }
+
+
+def plan_assignments(segmenters, count):
+    """
+    Pick a segmenter for each of `count` items, in memory.
+
+    Min-heap on negated remaining capacity: every item goes to the
+    segmenter with the most room left (ties: earlier in `segmenters`),
+    and a segmenter at capacity leaves the heap. Workloads are updated
+    on the mapping objects as assignments are made.
+
+    Returns:
+        list of ProjectEmployeeMapping, one per assigned item; shorter
+        than count when capacity runs out
+    """
+    heap = [
+        (seg.current_workload - seg.capacity, position, seg)
+        for position, seg in enumerate(segmenters)
+        if seg.current_workload < seg.capacity
+    ]
+    heapq.heapify(heap)
+
+    assignments = []
+    while heap and len(assignments) < count:
+        negative_remaining, position, seg = heapq.heappop(heap)
+
+        assignments.append(seg)
+        seg.current_workload += 1
+
+        if negative_remaining + 1 < 0:
+            heapq.heappush(heap, (negative_remaining + 1, position, seg))
+
+    return assignments
+
+
 def create_segmentation_tasks(*, images, project, priority='MEDIUM'):
     """
     Create and assign segmentation tasks for images.
@@ -223,10 +314,13 @@ def create_segmentation_tasks(*, images, project, priority='MEDIUM'):
     - segmenter is mandatory
     - assigned_to starts as segmenter
     - status starts as ASSIGNED
+
+    Assignment is planned in memory, then written with one bulk_create
+    of tasks and one bulk_update of workloads, so the segmenter locks
+    are held for a fixed number of queries whatever the batch size.
     """
 
-    tasks_created = 0
-    unassigned_images = []
+    images = list(images)
 
     with transaction.atomic():
 
@@ -236,6 +330,7 @@ def create_segmentation_tasks(*, images, project, priority='MEDIUM'):
         segmenters = list(
             ProjectEmployeeMapping.objects
             .select_for_update()
+            .select_related('user')
             .filter(
                 project=project,
                 role_in_project='SEGMENTER',
@@ -248,43 +343,37 @@ def create_segmentation_tasks(*, images, project, priority='MEDIUM'):
         if not segmenters:
             raise Exception("No available segmenters to create tasks")
 
-        seg_count = len(segmenters)
-        seg_index = 0
-
         # --------------------------------------------------
-        # 2. Create tasks
+        # 2. Plan assignments (no queries)
         # --------------------------------------------------
-        for image in images:
-            assigned = False
-
-            for _ in range(seg_count):
-                seg = segmenters[seg_index]
-
-                if seg.current_workload < seg.capacity:
-                    SegmentationTask.objects.create(
-                        image=image,
-                        segmenter=seg.user,      # 🔒 permanent owner
-                        assigned_to=seg.user,    # 👷 current worker
-                        status='ASSIGNED',
-                        priority=priority
-                    )
-
-                    seg.current_workload += 1
-                    seg.save(update_fields=['current_workload'])
-
-                    tasks_created += 1
-                    assigned = True
+        assignments = plan_assignments(segmenters, len(images))
+
+        tasks = [
+            SegmentationTask(
+                image=image,
+                segmenter=seg.user,      # 🔒 permanent owner
+                assigned_to=seg.user,    # 👷 current worker
+                status='ASSIGNED',
+                priority=priority
+            )
+            for image, seg in zip(images, assignments)
+        ]
 
-                    seg_index = (seg_index + 1) % seg_count
-                    break
+        # --------------------------------------------------
+        # 3. Write tasks + workloads
+        # --------------------------------------------------
+        SegmentationTask.objects.bulk_create(tasks)
 
-                seg_index = (seg_index + 1) % seg_count
+        assigned_segmenters = {seg.pk: seg for seg in assignments}
+        ProjectEmployeeMapping.objects.bulk_update(
+            assigned_segmenters.values(),
+            ['current_workload']
+        )
 
-            if not assigned:
-                unassigned_images.append(image.id)
+    unassigned_images = [image.id for image in images[len(assignments):]]
 
     return {
-        "tasks_created": tasks_created,
+        "tasks_created": len(tasks),
         "unassigned_images": unassigned_images,
         "unassigned_count": len(unassigned_images)
     }
@@ -359,42 +448,62 @@ def auto_assign_tasks(project, tasks):
         "unassigned_task_ids": unassigned_tasks
     }
 
-def process_batch_upload(
+def new_batch_id():
+    """
+    Timestamp for readability plus a random suffix: uploads finishing
+    in the same second must not share an archive path or Batch row.
+    """
+    return f"upload_{timezone.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+
+
+def upload_dir():
+    path = os.path.join(settings.MEDIA_ROOT, 'uploads')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def persist_upload(uploaded_file, batch_id):
+    """
+    Keep the uploaded ZIP under MEDIA_ROOT/uploads for the background
+    job. Uploads Django already spooled to disk are moved, not copied.
+
+    Returns:
+        archive path
+    """
+    archive_path = os.path.join(upload_dir(), f"{batch_id}.zip")
+
+    if hasattr(uploaded_file, 'temporary_file_path'):
+        shutil.move(uploaded_file.temporary_file_path(), archive_path)
+    else:
+        with open(archive_path, 'wb') as f:
+            for chunk in uploaded_file.chunks():
+                f.write(chunk)
+
+    return archive_path
+
+
+def create_batch(
     *,
     zip_file,
     project,
     uploaded_by,
-    priority='MEDIUM'
+    original_zip_path=None,
+    batch_id=None,
+    max_size=MAX_ZIP_SIZE
 ):
     """
-    COMPLETE BATCH UPLOAD PIPELINE
+    Validate the ZIP and create its Dataset + PENDING Batch.
 
-    LOCKED DESIGN:
-    - 1 ZIP = 1 Dataset = 1 Batch
-    - Tasks are CREATED + ASSIGNED in one step
-    - segmenter is mandatory
+    Returns:
+        (batch, None) or (None, error message)
     """
+    start = time.time()
+    batch_id = batch_id or new_batch_id()
 
-    start_time = time.time()
-
-    # --------------------------------------------------
-    # 1. GENERATE BATCH ID
-    # --------------------------------------------------
-    batch_id = f"upload_{timezone.now().strftime('%Y%m%d_%H%M%S')}"
-
-    # --------------------------------------------------
-    # 2. VALIDATE ZIP
-    # --------------------------------------------------
-    is_valid, validation_result = validate_zip_file(zip_file)
+    is_valid, validation_result = validate_zip_file(zip_file, max_size)
     if not is_valid:
-        return {
-            "status": "failed",
-            "error": validation_result.get("error", "ZIP validation failed")
-        }
+        return None, validation_result.get("error", "ZIP validation failed")
 
-    # --------------------------------------------------
-    # 3. CREATE DATASET (SYSTEM OWNED)
-    # --------------------------------------------------
     dataset_storage_path = os.path.join(
         settings.MEDIA_ROOT,
         'projects',
@@ -403,82 +512,147 @@ def process_batch_upload(
         batch_id
     )
 
-    dataset = Dataset.objects.create(
-        project=project,
-        name=f"Dataset {batch_id}",
-        code=batch_id,
-        status='ACTIVE',
-        storage_path=dataset_storage_path,
-        created_by=uploaded_by
-    )
+    with transaction.atomic():
+        dataset = Dataset.objects.create(
+            project=project,
+            name=f"Dataset {batch_id}",
+            code=batch_id,
+            status='ACTIVE',
+            storage_path=dataset_storage_path,
+            created_by=uploaded_by
+        )
 
-    # --------------------------------------------------
-    # 4. CREATE BATCH
-    # --------------------------------------------------
-    batch = Batch.objects.create(
-        project=project,
-        dataset=dataset,
-        batch_id=batch_id,
-        uploaded_by=uploaded_by,
-        original_zip_path=zip_file.name,
-        total_images=validation_result["total_files"],
-        status='PROCESSING'
-    )
+        batch = Batch.objects.create(
+            project=project,
+            dataset=dataset,
+            batch_id=batch_id,
+            uploaded_by=uploaded_by,
+            original_zip_path=original_zip_path or zip_file.name,
+            total_images=validation_result["total_files"],
+            status='PENDING',
+            stage_timings={"validate": round(time.time() - start, 3)}
+        )
 
-    # --------------------------------------------------
-    # 5. EXTRACT ZIP
-    # --------------------------------------------------
-    temp_dir = extract_zip_to_temp(
-        zip_file=zip_file,
-        batch_id=batch.batch_id
-    )
+    return batch, None
 
-    # --------------------------------------------------
-    # 6. SAVE IMAGES
-    # --------------------------------------------------
-    image_result = save_images_to_dataset(
-        temp_dir=temp_dir,
-        project=project,
-        dataset=dataset
+
+def _record_stage(batch, stage, seconds, **fields):
+    """Persist a finished stage's timing (and counters) right away."""
+    batch.stage_timings[stage] = round(seconds, 3)
+    for name, value in fields.items():
+        setattr(batch, name, value)
+
+    Batch.objects.filter(pk=batch.pk).update(
+        stage_timings=batch.stage_timings,
+        **fields
     )
 
-    batch.images_extracted = image_result["created"]
-    batch.images_failed = len(image_result["failed"])
-    batch.save(update_fields=['images_extracted', 'images_failed'])
 
-    # --------------------------------------------------
-    # 7. CREATE + ASSIGN TASKS (SINGLE SOURCE OF TRUTH)
-    # --------------------------------------------------
-    images = Image.objects.filter(dataset=dataset)
+def run_batch_pipeline(batch, *, zip_file=None, priority='MEDIUM', precompute_embeddings=None):
+    """
+    Ingest a PENDING batch: store images, build their previews, create
+    + assign tasks and optionally queue embedding precompute. Counters
+    and stage timings are written to the Batch as each stage finishes,
+    so the status endpoint can follow along. On error the batch is
+    marked FAILED and the exception re-raised.
 
-    task_result = create_segmentation_tasks(
-        images=images,
-        project=project,
-        priority=priority
-    )
+    zip_file defaults to the archive at batch.original_zip_path.
+
+    Returns:
+        summary dict (the synchronous upload response)
+    """
+    dataset = batch.dataset
+    project = batch.project
+
+    Batch.objects.filter(pk=batch.pk).update(status='PROCESSING')
+    batch.status = 'PROCESSING'
 
-    batch.total_tasks_created = task_result["tasks_created"]
-    batch.assigned_tasks = task_result["tasks_created"]
-    batch.unassigned_tasks = task_result["unassigned_count"]
+    try:
+        # --------------------------------------------------
+        # 1. STREAM + SAVE IMAGES (single pass over the ZIP)
+        # --------------------------------------------------
+        start = time.time()
+
+        def ingest_progress(created, duplicates, failed):
+            Batch.objects.filter(pk=batch.pk).update(
+                images_extracted=created,
+                images_duplicate=duplicates,
+                images_failed=failed
+            )
+
+        image_result = save_images_to_dataset(
+            zip_file=zip_file or batch.original_zip_path,
+            project=project,
+            dataset=dataset,
+            progress=ingest_progress,
+            batch=batch
+        )
 
-    batch.save(update_fields=[
-        'total_tasks_created',
-        'assigned_tasks',
-        'unassigned_tasks'
-    ])
+        _record_stage(
+            batch,
+            'ingest',
+            time.time() - start,
+            images_extracted=image_result["created"],
+            images_duplicate=image_result["duplicates"],
+            images_failed=len(image_result["failed"]),
+            failures=image_result["failed"][:FAILURE_SAMPLE_SIZE]
+        )
+
+        # --------------------------------------------------
+        # 2. PREVIEW PYRAMID (thumbnails for list views)
+        # --------------------------------------------------
+        start = time.time()
+        preview_result = generate_dataset_previews(dataset)
+        _record_stage(batch, 'previews', time.time() - start)
+
+        # --------------------------------------------------
+        # 3. CREATE + ASSIGN TASKS (SINGLE SOURCE OF TRUTH)
+        # --------------------------------------------------
+        start = time.time()
+        images = Image.objects.filter(dataset=dataset)
+
+        task_result = create_segmentation_tasks(
+            images=images,
+            project=project,
+            priority=priority
+        )
+
+        _record_stage(
+            batch,
+            'tasks',
+            time.time() - start,
+            total_tasks_created=task_result["tasks_created"],
+            assigned_tasks=task_result["tasks_created"],
+            unassigned_tasks=task_result["unassigned_count"]
+        )
+
+        # --------------------------------------------------
+        # 4. QUEUE SAM EMBEDDING PRECOMPUTE (OPTIONAL)
+        # --------------------------------------------------
+        if precompute_embeddings is None:
+            precompute_embeddings = getattr(settings, 'SAM_PRECOMPUTE_ON_UPLOAD', False)
+
+        embeddings_queued = 0
+        if precompute_embeddings:
+            start = time.time()
+            embeddings_queued = queue_embedding_precompute(batch)["queued"]
+            _record_stage(batch, 'embeddings_queue', time.time() - start)
+
+    except Exception as e:
+        Batch.objects.filter(pk=batch.pk).update(
+            status='FAILED',
+            error_message=str(e),
+            completed_at=timezone.now()
+        )
+        raise
 
     # --------------------------------------------------
-    # 8. FINALIZE BATCH
+    # 5. FINALIZE BATCH
     # --------------------------------------------------
     batch.status = 'COMPLETED'
     batch.completed_at = timezone.now()
     batch.save(update_fields=['status', 'completed_at'])
 
-    end_time = time.time()
-
-    # --------------------------------------------------
-    # 9. RESPONSE
-    # --------------------------------------------------
     return {
         "batch_id": batch.batch_id,
         "project_id": project.id,
@@ -488,10 +662,187 @@ def process_batch_upload(
         "failed_count": batch.images_failed,
         "failed_images": image_result["failed"],
         "duplicates_found": image_result["duplicates"],
+        "blobs_reused": image_result["blobs_reused"],
         "total_tasks_created": batch.total_tasks_created,
         "assigned_tasks": batch.assigned_tasks,
         "unassigned_tasks": batch.unassigned_tasks,
-        "extraction_time_seconds": round(end_time - start_time, 2),
+        "extraction_time_seconds": round(sum(batch.stage_timings.values()), 2),
+        "stage_timings": batch.stage_timings,
         "storage_location": dataset.storage_path,
-        "preview_generated": True
+        "embeddings_queued": embeddings_queued,
+        "previews_generated": preview_result["generated"]
     }
+
+
+def process_batch_upload(
+    *,
+    zip_file,
+    project,
+    uploaded_by,
+    priority='MEDIUM',
+    precompute_embeddings=None
+):
+    """
+    COMPLETE BATCH UPLOAD PIPELINE, synchronously
+
+    LOCKED DESIGN:
+    - 1 ZIP = 1 Dataset = 1 Batch
+    - Tasks are CREATED + ASSIGNED in one step
+    - segmenter is mandatory
+
+    precompute_embeddings (default: settings.SAM_PRECOMPUTE_ON_UPLOAD)
+    queues SAM embedding precompute for the new images on django-q.
+
+    The upload API uses queue_batch_upload() instead.
+    """
+    batch, error = create_batch(
+        zip_file=zip_file,
+        project=project,
+        uploaded_by=uploaded_by
+    )
+    if batch is None:
+        return {
+            "status": "failed",
+            "error": error
+        }
+
+    return run_batch_pipeline(
+        batch,
+        zip_file=zip_file,
+        priority=priority,
+        precompute_embeddings=precompute_embeddings
+    )
+
+
+def queue_batch_upload(
+    *,
+    zip_file,
+    project,
+    uploaded_by,
+    priority='MEDIUM',
+    precompute_embeddings=None
+):
+    """
+    Persist the upload, create a PENDING batch and run the pipeline on
+    the django-q cluster.
+
+    Returns:
+        (batch, None) or (None, error message)
+    """
+    batch_id = new_batch_id()
+
+    return queue_batch_archive(
+        archive_path=persist_upload(zip_file, batch_id),
+        batch_id=batch_id,
+        project=project,
+        uploaded_by=uploaded_by,
+        priority=priority,
+        precompute_embeddings=precompute_embeddings
+    )
+
+
+def _remove_archive(archive_path):
+    try:
+        os.remove(archive_path)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        logger.warning("Could not remove uploaded archive %s", archive_path)
+
+
+def queue_batch_archive(
+    *,
+    archive_path,
+    batch_id,
+    project,
+    uploaded_by,
+    priority='MEDIUM',
+    precompute_embeddings=None,
+    max_size=MAX_ZIP_SIZE,
+    keep_archive_on_error=False
+):
+    """
+    Create a PENDING batch for an archive already stored on disk and
+    queue its pipeline. The archive is removed if the batch cannot be
+    created, whether validation fails or an error is raised; with
+    keep_archive_on_error it is left in place on an error, for the
+    caller to retry.
+
+    Returns:
+        (batch, None) or (None, error message)
+    """
+    try:
+        batch, error = create_batch(
+            zip_file=archive_path,
+            project=project,
+            uploaded_by=uploaded_by,
+            original_zip_path=archive_path,
+            batch_id=batch_id,
+            max_size=max_size
+        )
+    except Exception:
+        if not keep_archive_on_error:
+            _remove_archive(archive_path)
+        raise
+
+    if batch is None:
+        _remove_archive(archive_path)
+        return None, error
+
+    async_task(
+        'segmentation.services.batch_upload.run_batch_upload',
+        batch.pk,
+        priority,
+        precompute_embeddings,
+        group=f"batch_upload_{project.code}"
+    )
+    return batch, None
+
+
+def run_batch_upload(batch_pk, priority='MEDIUM', precompute_embeddings=None):
+    """
+    django-q task entry point. The archive is removed once the pipeline
+    has run, whether it completed or failed.
+
+    django-q only retries a task whose attempt was killed (Q_CLUSTER
+    timeout) or lost with its worker, so a retry that finds the batch
+    still PROCESSING marks it FAILED instead of leaving it stuck: the
+    first attempt may have created tasks already, and running the
+    pipeline again would assign them twice.
+    """
+    with transaction.atomic():
+        batch = (
+            Batch.objects
+            .select_for_update()
+            .select_related('project', 'dataset')
+            .get(pk=batch_pk)
+        )
+        status = batch.status
+        if status == 'PENDING':
+            batch.status = 'PROCESSING'
+            batch.save(update_fields=['status'])
+        elif status == 'PROCESSING':
+            batch.status = 'FAILED'
+            batch.error_message = (
+                "Processing was interrupted (timed out or the worker stopped); "
+                "upload the archive again"
+            )
+            batch.completed_at = timezone.now()
+            batch.save(update_fields=['status', 'error_message', 'completed_at'])
+
+    if status != 'PENDING':
+        logger.warning("Batch %s is %s, not processing it again", batch.batch_id, status)
+        _remove_archive(batch.original_zip_path)
+        return None
+
+    try:
+        summary = run_batch_pipeline(
+            batch,
+            priority=priority,
+            precompute_embeddings=precompute_embeddings
+        )
+    finally:
+        _remove_archive(batch.original_zip_path)
+
+    summary.pop("failed_images")
+    return summary
@@ -0,0 +1,234 @@
+"""
+Content-addressed store for original images.
+
+Every image file is kept once per SHA256, whatever dataset or upload
+it arrived with (see zip_ingest and segmentation.utils.media.blob_path):
+
+    BLOB_STORE_ROOT/<checksum[:2]>/<checksum[2:4]>/<checksum>.<ext>
+
+Image.file_path points into the store, so uploading the same images
+again, to any dataset, adds database rows but no files. Each file has a
+Blob row whose ref_count is the number of Image rows using it: counts
+are refreshed for every chunk registered at ingest, and recounted from
+the Image table by collect_garbage() before anything is deleted, so an
+image removed by any route (admin, cascades, shell) can never take a
+file that is still referenced with it.
+
+Races with a concurrent ingest are settled per file: collect_garbage()
+locks the Blob row (first re-creating a missing one), re-checks the
+Image table, then renames the file out of the store before its final
+mtime check. An ingest that reused
+the file touched it before the rename (fresh mtime: the file is put
+back), or finds it gone and stores its own copy.
+"""
+import os
+import shutil
+import time
+import uuid
+
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from segmentation.models import Blob, Image
+from segmentation.services.deepzoom import tile_settings
+from segmentation.services.previews import preview_path, preview_sizes, previews_dir
+from segmentation.services.zip_ingest import TEMP_DIR
+from segmentation.utils.media import blob_root
+
+# Unreferenced files younger than this are left alone: an ingest may
+# have just written or reused them and not registered its Image yet
+DEFAULT_GC_GRACE_SECONDS = 24 * 3600
+
+
+def register_blobs(stored):
+    """Blob rows for newly ingested files (existing ones are kept)."""
+    blobs = {}
+    for result in stored:
+        blobs.setdefault(result["checksum"], Blob(
+            checksum=result["checksum"],
+            file_path=result["file_path"],
+            file_size=result["file_size"]
+        ))
+    Blob.objects.bulk_create(blobs.values(), ignore_conflicts=True)
+
+
+def refresh_ref_counts(checksums=None):
+    """
+    Set ref_count from the Image table in one UPDATE, for the given
+    checksums or every blob.
+    """
+    references = (
+        Image.objects
+        .filter(checksum=OuterRef('checksum'))
+        .order_by()
+        .values('checksum')
+        .annotate(count=Count('id'))
+        .values('count')
+    )
+
+    blobs = Blob.objects.all()
+    if checksums is not None:
+        blobs = blobs.filter(checksum__in=checksums)
+    return blobs.update(ref_count=Coalesce(Subquery(references), 0))
+
+
+def _remove_derived(checksum):
+    """Previews and Deep Zoom tiles of a deleted blob."""
+    for size in preview_sizes():
+        try:
+            os.remove(preview_path(previews_dir(), size, checksum))
+        except FileNotFoundError:
+            pass
+
+    _, _, tile_root = tile_settings()
+    shutil.rmtree(os.path.join(tile_root, checksum[:2], checksum), ignore_errors=True)
+
+
+def _remove(path):
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    return size
+
+
+def _remove_unused(path, expired, temp_dir):
+    """
+    Delete `path` if it is still expired once moved out of the store.
+
+    Returns:
+        bytes freed, or None if the file was touched and put back
+    """
+    os.makedirs(temp_dir, exist_ok=True)
+    trash = os.path.join(temp_dir, f"{os.path.basename(path)}.{uuid.uuid4().hex[:8]}.gc")
+    try:
+        os.rename(path, trash)
+    except FileNotFoundError:
+        return 0
+
+    if not expired(trash):
+        os.replace(trash, path)
+        return None
+    return _remove(trash)
+
+
+def _store_files(root):
+    """(path, checksum) of every blob file on disk, one fan-out directory at a time."""
+    for first in sorted(os.listdir(root)):
+        if len(first) != 2 or not os.path.isdir(os.path.join(root, first)):
+            continue
+        for second in sorted(os.listdir(os.path.join(root, first))):
+            directory = os.path.join(root, first, second)
+            if os.path.isdir(directory):
+                yield [
+                    (os.path.join(directory, name), name.split('.', 1)[0])
+                    for name in os.listdir(directory)
+                ]
+
+
+def collect_garbage(grace_seconds=DEFAULT_GC_GRACE_SECONDS, dry_run=False):
+    """
+    Delete blob files no Image references any more, with their
+    previews and tiles. Also removes files left without a Blob row
+    (ingests that died before registering) and stale partial writes;
+    such a file that Images do use gets its Blob row back instead.
+
+    Returns:
+        {"blobs": int, "orphans": int, "restored": int, "bytes": int}
+    """
+    root = blob_root()
+    cutoff = time.time() - grace_seconds
+    result = {"blobs": 0, "orphans": 0, "restored": 0, "bytes": 0}
+
+    if not os.path.isdir(root):
+        return result
+
+    refresh_ref_counts()
+
+    def expired(path):
+        try:
+            return os.path.getmtime(path) < cutoff
+        except FileNotFoundError:
+            return False
+
+    temp_dir = os.path.join(root, TEMP_DIR)
+
+    # Unreferenced blobs
+    candidates = Blob.objects.filter(ref_count=0).values_list('pk', 'checksum', 'file_path')
+    for pk, checksum, file_path in list(candidates):
+        if not expired(file_path) and os.path.exists(file_path):
+            continue
+
+        if dry_run:
+            result["blobs"] += 1
+            continue
+
+        # The recount above is stale by now: decide against live rows,
+        # holding the Blob row so ingest's ref_count refresh waits
+        with transaction.atomic():
+            blob = Blob.objects.select_for_update().filter(pk=pk).first()
+            if blob is None or Image.objects.filter(checksum=checksum).exists():
+                continue
+
+            removed = _remove_unused(file_path, expired, temp_dir)
+            if removed is None:
+                continue
+
+            blob.delete()
+
+        result["blobs"] += 1
+        result["bytes"] += removed
+        _remove_derived(checksum)
+
+    # Files without a Blob row
+    for files in _store_files(root):
+        registered = set(
+            Blob.objects
+            .filter(checksum__in=[checksum for _, checksum in files])
+            .values_list('checksum', flat=True)
+        )
+        for path, checksum in files:
+            if checksum in registered or not expired(path):
+                continue
+            if dry_run:
+                result["orphans"] += 1
+                continue
+
+            try:
+                file_size = os.path.getsize(path)
+            except FileNotFoundError:
+                continue
+
+            # Settled like an unreferenced blob: give the file its row
+            # back and lock it, so an ingest registering the same
+            # checksum waits, then decide against live Image rows
+            with transaction.atomic():
+                Blob.objects.bulk_create(
+                    [Blob(checksum=checksum, file_path=path, file_size=file_size)],
+                    ignore_conflicts=True
+                )
+                blob = Blob.objects.select_for_update().get(checksum=checksum)
+                if Image.objects.filter(checksum=checksum).exists():
+                    refresh_ref_counts([checksum])
+                    result["restored"] += 1
+                    continue
+
+                removed = _remove_unused(path, expired, temp_dir)
+                if removed is None:
+                    continue
+                blob.delete()
+
+            result["orphans"] += 1
+            result["bytes"] += removed
+            _remove_derived(checksum)
+
+    # Partial writes and files moved out above
+    if os.path.isdir(temp_dir) and not dry_run:
+        for name in os.listdir(temp_dir):
+            path = os.path.join(temp_dir, name)
+            if expired(path):
+                result["bytes"] += _remove(path)
+
+    return result
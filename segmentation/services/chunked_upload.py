@@ -0,0 +1,266 @@
+"""
+Resumable chunked ZIP uploads.
+
+    1. initiate:  UploadSession with total size and part size; the
+                  archive file is preallocated at its final size
+    2. parts:     PUT numbered parts, each with its SHA256; a part is
+                  streamed to a temp file, verified and only then copied
+                  into the archive at (n - 1) * part_size, and can be
+                  re-sent any number of times
+    3. complete:  the finished archive is renamed into place and handed
+                  to the batch pipeline
+
+Part bodies never pass through Django's upload handlers, and no request
+handles more than one part's bytes, so server memory and request time
+stay constant whatever the archive size.
+
+Sessions left OPEN are aborted, and their preallocated archive removed,
+by expire_uploads() (run by `manage.py gc_blobs`) once no part has
+arrived for CHUNKED_UPLOAD_EXPIRY_SECONDS.
+"""
+import hashlib
+import os
+import shutil
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from segmentation.models import UploadSession
+from segmentation.services.batch_upload import new_batch_id, queue_batch_archive, upload_dir
+
+DEFAULT_PART_SIZE = 16 * 1024 * 1024
+MAX_PART_SIZE = 256 * 1024 * 1024
+
+# Archives accepted through chunked uploads: 20 GB
+DEFAULT_MAX_UPLOAD_BYTES = 20 * 1024 * 1024 * 1024
+
+# Read / copy size for part bodies
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# OPEN sessions without a new part for this long are aborted
+DEFAULT_UPLOAD_EXPIRY_SECONDS = 7 * 24 * 3600
+
+
+class UploadError(Exception):
+    """Rejected upload request; the message is returned to the client."""
+
+
+def max_upload_bytes():
+    return getattr(settings, "CHUNKED_UPLOAD_MAX_BYTES", DEFAULT_MAX_UPLOAD_BYTES)
+
+
+def upload_expiry_seconds():
+    return getattr(settings, "CHUNKED_UPLOAD_EXPIRY_SECONDS", DEFAULT_UPLOAD_EXPIRY_SECONDS)
+
+
+def parts_dir(session):
+    return os.path.join(upload_dir(), 'parts', session.upload_id)
+
+
+def part_path(session, part_number):
+    return os.path.join(parts_dir(session), f"{part_number:06d}.part")
+
+
+def session_archive_path(session):
+    """The archive being filled in, part by part."""
+    return os.path.join(parts_dir(session), "archive.zip")
+
+
+def expected_part_size(session, part_number):
+    if part_number < session.total_parts:
+        return session.part_size
+    return session.total_size - session.part_size * (session.total_parts - 1)
+
+
+def initiate_upload(*, project, uploaded_by, file_name, total_size, part_size=None):
+    part_size = part_size or DEFAULT_PART_SIZE
+
+    if total_size <= 0:
+        raise UploadError("total_size must be positive")
+    if total_size > max_upload_bytes():
+        raise UploadError(
+            f"Archive exceeds the {max_upload_bytes() // (1024 * 1024)}MB limit"
+        )
+    if not 0 < part_size <= MAX_PART_SIZE:
+        raise UploadError(f"part_size must be between 1 and {MAX_PART_SIZE} bytes")
+
+    session = UploadSession.objects.create(
+        upload_id=uuid.uuid4().hex,
+        project=project,
+        uploaded_by=uploaded_by,
+        file_name=os.path.basename(file_name)[:255],
+        total_size=total_size,
+        part_size=part_size,
+        total_parts=-(-total_size // part_size),
+    )
+    os.makedirs(parts_dir(session), exist_ok=True)
+    with open(session_archive_path(session), 'wb') as f:
+        f.truncate(total_size)
+    return session
+
+
+def store_part(session, part_number, stream, sha256, content_length=None):
+    """
+    Stream one part body to disk and verify its size and SHA256.
+    Only then is it copied into the archive, replacing any earlier copy
+    of the same part.
+
+    Returns:
+        {"size": int, "sha256": str}
+    """
+    if session.status != 'OPEN':
+        raise UploadError(f"Upload is {session.status.lower()}")
+    if not 1 <= part_number <= session.total_parts:
+        raise UploadError(f"Part number must be between 1 and {session.total_parts}")
+    if not sha256:
+        raise UploadError("Part SHA256 is required")
+
+    expected = expected_part_size(session, part_number)
+    if content_length is not None and content_length != expected:
+        raise UploadError(f"Part {part_number} must be {expected} bytes")
+
+    target = part_path(session, part_number)
+    temp = f"{target}.{uuid.uuid4().hex[:8]}.tmp"
+    digest = hashlib.sha256()
+    size = 0
+
+    try:
+        with open(temp, 'wb') as f:
+            while size <= expected:
+                chunk = stream.read(min(COPY_BUFFER_SIZE, expected + 1 - size))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+
+        if size != expected:
+            raise UploadError(f"Part {part_number} must be {expected} bytes, got {size}")
+        if digest.hexdigest() != sha256.lower():
+            raise UploadError(f"Part {part_number} checksum mismatch")
+
+        record = {"size": size, "sha256": digest.hexdigest()}
+
+        # Parts may arrive in parallel: copy and record under a row lock,
+        # so the archive bytes of a re-sent part always match its record
+        with transaction.atomic():
+            locked = UploadSession.objects.select_for_update().get(pk=session.pk)
+            if locked.status != 'OPEN':
+                raise UploadError(f"Upload is {locked.status.lower()}")
+
+            with open(temp, 'rb') as part, open(session_archive_path(session), 'r+b') as out:
+                out.seek((part_number - 1) * session.part_size)
+                shutil.copyfileobj(part, out, COPY_BUFFER_SIZE)
+
+            locked.parts[str(part_number)] = record
+            locked.save(update_fields=['parts', 'updated_at'])
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+    session.parts = locked.parts
+    return record
+
+
+def complete_upload(session, *, priority='MEDIUM', precompute_embeddings=None):
+    """
+    Queue the batch pipeline on the finished archive. If that raises,
+    the session is reopened with its parts intact so complete can be
+    retried.
+
+    Returns:
+        (batch, None) or (None, error message)
+    """
+    with transaction.atomic():
+        session = UploadSession.objects.select_for_update().get(pk=session.pk)
+
+        if session.status != 'OPEN':
+            raise UploadError(f"Upload is {session.status.lower()}")
+
+        missing = session.missing_parts()
+        if missing:
+            raise UploadError(f"Missing parts: {missing[:20]}")
+
+        # Claim the session so a repeated complete cannot queue twice
+        session.status = 'COMPLETED'
+        session.save(update_fields=['status', 'updated_at'])
+
+    batch_id = new_batch_id()
+    archive_path = os.path.join(upload_dir(), f"{batch_id}.zip")
+
+    try:
+        if os.path.getsize(session_archive_path(session)) != session.total_size:
+            raise UploadError("Archive size does not match total_size")
+
+        os.replace(session_archive_path(session), archive_path)
+        try:
+            batch, error = queue_batch_archive(
+                archive_path=archive_path,
+                batch_id=batch_id,
+                project=session.project,
+                uploaded_by=session.uploaded_by,
+                priority=priority,
+                precompute_embeddings=precompute_embeddings,
+                max_size=max_upload_bytes(),
+                keep_archive_on_error=True
+            )
+        except Exception:
+            os.replace(archive_path, session_archive_path(session))
+            raise
+    except Exception:
+        UploadSession.objects.filter(pk=session.pk).update(status='OPEN')
+        raise
+
+    # Queued, or rejected by validation (the archive is already removed)
+    shutil.rmtree(parts_dir(session), ignore_errors=True)
+
+    if batch is not None:
+        UploadSession.objects.filter(pk=session.pk).update(batch=batch)
+    return batch, error
+
+
+def abort_upload(session):
+    UploadSession.objects.filter(pk=session.pk, status='OPEN').update(status='ABORTED')
+    shutil.rmtree(parts_dir(session), ignore_errors=True)
+
+
+def expire_uploads(max_age_seconds=None, dry_run=False):
+    """
+    Abort OPEN sessions that received no part for max_age_seconds
+    (default CHUNKED_UPLOAD_EXPIRY_SECONDS) and remove their
+    preallocated archive and parts.
+
+    Returns:
+        {"sessions": int, "bytes": int}
+    """
+    if max_age_seconds is None:
+        max_age_seconds = upload_expiry_seconds()
+    cutoff = timezone.now() - timedelta(seconds=max_age_seconds)
+    result = {"sessions": 0, "bytes": 0}
+
+    stale = UploadSession.objects.filter(status='OPEN', updated_at__lt=cutoff)
+    for pk in list(stale.values_list('pk', flat=True)):
+        # Under the row lock parts are copied with, re-checking that
+        # none arrived since the query
+        with transaction.atomic():
+            session = stale.select_for_update().filter(pk=pk).first()
+            if session is None:
+                continue
+
+            directory = parts_dir(session)
+            size = sum(
+                entry.stat().st_size for entry in os.scandir(directory) if entry.is_file()
+            ) if os.path.isdir(directory) else 0
+
+            if not dry_run:
+                session.status = 'ABORTED'
+                session.save(update_fields=['status', 'updated_at'])
+                shutil.rmtree(directory, ignore_errors=True)
+
+        result["sessions"] += 1
+        result["bytes"] += size
+
+    return result
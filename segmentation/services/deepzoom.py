@@ -0,0 +1,279 @@
+"""
+Deep Zoom (DZI) tiles for dataset images.
+
+Level max_level is the image at full size (EXIF orientation applied);
+each level below halves it, down to 1x1 at level 0. Tiles are
+TILE_SIZE squares plus TILE_OVERLAP pixels on every inner edge, as
+OpenSeadragon and other DZI viewers expect.
+
+Tiles are cut on demand and kept in an on-disk cache keyed by content:
+
+    TILE_CACHE_ROOT/<checksum[:2]>/<checksum>/<tile size>_<overlap>/<level>/<col>_<row>.jpg
+
+A JPEG cannot be decoded region by region, so the first request for a
+block of TILE_RENDER_BLOCK x TILE_RENDER_BLOCK tiles renders the level
+once (from the smallest preview that is large enough, else the
+original) and writes the tiles of that block; later requests are a file
+read. Levels that fit in one block are written whole. An O_EXCL lock
+file per block keeps concurrent requests from rendering the same block
+twice; it works on every platform and a lock left by a killed process
+is broken after TILE_LOCK_STALE_SECONDS. `manage.py build_previews
+--tiles` writes every level ahead of time.
+"""
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import cv2
+from django.conf import settings
+from PIL import Image as PILImage
+
+from segmentation.ai.image_io import read_file_rgb
+
+DEFAULT_TILE_SIZE = 256
+DEFAULT_TILE_OVERLAP = 1
+TILE_QUALITY = 85
+
+# Tiles per side of the block one on-demand request renders
+DEFAULT_TILE_RENDER_BLOCK = 8
+
+LOCK_POLL_SECONDS = 0.05
+DEFAULT_TILE_LOCK_STALE_SECONDS = 120
+
+DZI_TEMPLATE = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+    'TileSize="{tile_size}" Overlap="{overlap}" Format="jpg">'
+    '<Size Width="{width}" Height="{height}"/></Image>\n'
+)
+
+# EXIF orientations that swap width and height
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def tile_settings():
+    """(tile size, overlap, cache root) from settings."""
+    return (
+        getattr(settings, "TILE_SIZE", DEFAULT_TILE_SIZE),
+        getattr(settings, "TILE_OVERLAP", DEFAULT_TILE_OVERLAP),
+        getattr(settings, "TILE_CACHE_ROOT", None) or os.path.join(settings.MEDIA_ROOT, 'tiles'),
+    )
+
+
+def oriented_size(image):
+    """(width, height) as displayed, i.e. after EXIF orientation."""
+    with PILImage.open(image.file_path) as img:
+        width, height = img.size
+        if img.getexif().get(0x0112, 1) in _TRANSPOSED_ORIENTATIONS:
+            return height, width
+    return width, height
+
+
+def max_level(width, height):
+    return max(0, math.ceil(math.log2(max(width, height))))
+
+
+def level_size(width, height, level):
+    scale = 2 ** (max_level(width, height) - level)
+    return -(-width // scale), -(-height // scale)
+
+
+def descriptor(image):
+    """The .dzi XML for an image."""
+    tile_size, overlap, _ = tile_settings()
+    width, height = oriented_size(image)
+    return DZI_TEMPLATE.format(
+        tile_size=tile_size,
+        overlap=overlap,
+        width=width,
+        height=height
+    )
+
+
+def _level_dir(image, level):
+    tile_size, overlap, root = tile_settings()
+    return os.path.join(
+        root,
+        image.checksum[:2],
+        image.checksum,
+        f"{tile_size}_{overlap}",
+        str(level)
+    )
+
+
+def tile_path(image, level, col, row):
+    return os.path.join(_level_dir(image, level), f"{col}_{row}.jpg")
+
+
+def _level_source(image, level_long_side):
+    """Smallest stored preview covering level_long_side, else the original."""
+    sizes = sorted(int(size) for size in image.previews or {})
+    for size in sizes:
+        if size >= level_long_side:
+            return image.previews[str(size)]
+    return image.file_path
+
+
+def render_level(image, level):
+    """
+    RGB ndarray of one pyramid level, possibly read-only. The decoded
+    source comes from the decoded-image cache, so the blocks of one
+    level rendered by successive requests share a decode when it fits.
+    """
+    width, height = oriented_size(image)
+    level_w, level_h = level_size(width, height, level)
+
+    pixels = read_file_rgb(
+        _level_source(image, max(level_w, level_h)),
+        max(level_w, level_h)
+    )
+    if pixels.shape[:2] != (level_h, level_w):
+        interpolation = cv2.INTER_AREA if pixels.shape[1] > level_w else cv2.INTER_LINEAR
+        pixels = cv2.resize(pixels, (level_w, level_h), interpolation=interpolation)
+    return pixels
+
+
+def _write_tiles(pixels, level_dir, cols, rows):
+    """
+    Cut tiles (col, row) for col in cols, row in rows out of the
+    level image `pixels` and store them. Returns the tile count.
+    """
+    tile_size, overlap, _ = tile_settings()
+    level_w, level_h = pixels.size
+    suffix = f"{os.getpid()}.{threading.get_ident()}.tmp"
+
+    count = 0
+    for row in rows:
+        for col in cols:
+            left, top = col * tile_size, row * tile_size
+            box = (
+                max(0, left - overlap),
+                max(0, top - overlap),
+                min(level_w, left + tile_size + overlap),
+                min(level_h, top + tile_size + overlap),
+            )
+
+            path = os.path.join(level_dir, f"{col}_{row}.jpg")
+            temp = f"{path}.{suffix}"
+            pixels.crop(box).save(temp, 'JPEG', quality=TILE_QUALITY)
+            os.replace(temp, path)
+            count += 1
+
+    return count
+
+
+def write_level(image, level):
+    """Cut and store every tile of a level. Returns the tile count."""
+    tile_size, _, _ = tile_settings()
+    level_dir = _level_dir(image, level)
+    os.makedirs(level_dir, exist_ok=True)
+
+    pixels = PILImage.fromarray(render_level(image, level))
+    level_w, level_h = pixels.size
+
+    return _write_tiles(
+        pixels,
+        level_dir,
+        range(-(-level_w // tile_size)),
+        range(-(-level_h // tile_size))
+    )
+
+
+def _block_span(index, count, block):
+    start = index // block * block
+    return range(start, min(count, start + block))
+
+
+def write_block(image, level, col, row):
+    """
+    Cut and store the TILE_RENDER_BLOCK square of tiles around
+    (col, row). Returns the tile count.
+    """
+    tile_size, _, _ = tile_settings()
+    block = getattr(settings, "TILE_RENDER_BLOCK", DEFAULT_TILE_RENDER_BLOCK)
+
+    pixels = PILImage.fromarray(render_level(image, level))
+    level_w, level_h = pixels.size
+
+    return _write_tiles(
+        pixels,
+        _level_dir(image, level),
+        _block_span(col, -(-level_w // tile_size), block),
+        _block_span(row, -(-level_h // tile_size), block)
+    )
+
+
+@contextmanager
+def _file_lock(path):
+    """
+    Exclusive lock held as long as `path` exists, created with O_EXCL.
+    A lock older than TILE_LOCK_STALE_SECONDS belongs to a dead request
+    and is taken over.
+    """
+    stale_seconds = getattr(settings, "TILE_LOCK_STALE_SECONDS", DEFAULT_TILE_LOCK_STALE_SECONDS)
+
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.stat(path).st_mtime > stale_seconds:
+                    os.remove(path)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(LOCK_POLL_SECONDS)
+
+    try:
+        yield
+    finally:
+        os.close(fd)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def get_tile(image, level, col, row):
+    """
+    Path of a tile, rendering its block on a cache miss.
+
+    Raises ValueError for a level / column / row outside the image.
+    """
+    path = tile_path(image, level, col, row)
+    if os.path.exists(path):
+        return path
+
+    tile_size, _, _ = tile_settings()
+    width, height = oriented_size(image)
+    if not 0 <= level <= max_level(width, height):
+        raise ValueError(f"No level {level}")
+
+    level_w, level_h = level_size(width, height, level)
+    if col < 0 or row < 0 or col * tile_size >= level_w or row * tile_size >= level_h:
+        raise ValueError(f"No tile {col}_{row} at level {level}")
+
+    level_dir = _level_dir(image, level)
+    os.makedirs(level_dir, exist_ok=True)
+
+    block = getattr(settings, "TILE_RENDER_BLOCK", DEFAULT_TILE_RENDER_BLOCK)
+    lock_path = os.path.join(level_dir, f".lock_{col // block}_{row // block}")
+
+    with _file_lock(lock_path):
+        # Another request may have rendered the block while we waited
+        if not os.path.exists(path):
+            write_block(image, level, col, row)
+
+    return path
+
+
+def write_all_levels(image):
+    """Pre-generate the whole pyramid. Returns the tile count."""
+    width, height = oriented_size(image)
+    return sum(
+        write_level(image, level)
+        for level in range(max_level(width, height) + 1)
+    )
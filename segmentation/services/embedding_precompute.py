@@ -0,0 +1,135 @@
+import logging
+
+from django.conf import settings
+from django.db.models import Case, IntegerField, Min, Value, When, F
+from django.db.models.functions import Coalesce
+from django_q.tasks import async_task
+
+from segmentation.ai.image_io import inference_max_side, read_rgb
+from segmentation.ai.sam import embedding_cache, set_image_cached
+from segmentation.models import Batch, Image
+
+logger = logging.getLogger(__name__)
+
+# Images per django-q task
+PRECOMPUTE_CHUNK_SIZE = getattr(settings, "SAM_PRECOMPUTE_CHUNK_SIZE", 16)
+
+# SegmentationTask.priority -> processing order (lower first)
+PRIORITY_RANK = {
+    'URGENT': 0,
+    'HIGH': 1,
+    'MEDIUM': 2,
+    'LOW': 3,
+}
+UNTASKED_RANK = len(PRIORITY_RANK)
+
+
+def images_in_priority_order(dataset):
+    """
+    Images of a dataset ordered by the most urgent task on each image,
+    images without tasks last.
+    """
+    rank = Case(
+        *[
+            When(segmentation_tasks__priority=priority, then=Value(value))
+            for priority, value in PRIORITY_RANK.items()
+        ],
+        output_field=IntegerField()
+    )
+
+    return (
+        Image.objects
+        .filter(dataset=dataset)
+        .annotate(priority_rank=Coalesce(Min(rank), Value(UNTASKED_RANK)))
+        .order_by('priority_rank', 'id')
+    )
+
+
+def queue_embedding_precompute(batch, chunk_size=PRECOMPUTE_CHUNK_SIZE):
+    """
+    Queue SAM embedding precompute for every image in a batch.
+
+    Images whose embedding is already cached are counted as done and
+    skipped, so calling this again after an interrupted run resumes
+    where it stopped.
+
+    Returns:
+        {
+            "total": int,
+            "already_done": int,
+            "queued": int,
+            "tasks": int
+        }
+    """
+    pending = []
+    already_done = 0
+    total = 0
+
+    for image_id, checksum in (
+        images_in_priority_order(batch.dataset)
+        .values_list('id', 'checksum')
+    ):
+        total += 1
+        if embedding_cache.contains(checksum):
+            already_done += 1
+        else:
+            pending.append(image_id)
+
+    Batch.objects.filter(pk=batch.pk).update(
+        embeddings_total=total,
+        embeddings_done=already_done,
+        embeddings_failed=0
+    )
+
+    # Chunks are enqueued in priority order; the broker is FIFO
+    chunks = [
+        pending[i:i + chunk_size]
+        for i in range(0, len(pending), chunk_size)
+    ]
+    for image_ids in chunks:
+        async_task(
+            'segmentation.services.embedding_precompute.precompute_embeddings',
+            batch.id,
+            image_ids,
+            group=f"embeddings_{batch.batch_id}"
+        )
+
+    return {
+        "total": total,
+        "already_done": already_done,
+        "queued": len(pending),
+        "tasks": len(chunks),
+    }
+
+
+def precompute_embeddings(batch_pk, image_ids):
+    """
+    django-q task: encode one chunk of images into the embedding cache,
+    updating the batch progress counters after every image.
+    """
+    images = Image.objects.in_bulk(image_ids)
+
+    for image_id in image_ids:
+        image = images.get(image_id)
+
+        if image is None:
+            Batch.objects.filter(pk=batch_pk).update(
+                embeddings_failed=F('embeddings_failed') + 1
+            )
+            continue
+
+        try:
+            set_image_cached(
+                image.checksum,
+                lambda: read_rgb(image.file_path, inference_max_side())
+            )
+        except Exception:
+            logger.exception("Embedding precompute failed for image %s", image_id)
+            Batch.objects.filter(pk=batch_pk).update(
+                embeddings_failed=F('embeddings_failed') + 1
+            )
+            continue
+
+        Batch.objects.filter(pk=batch_pk).update(
+            embeddings_done=F('embeddings_done') + 1
+        )
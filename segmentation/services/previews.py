@@ -0,0 +1,155 @@
+"""
+Preview pyramid for dataset images, built at ingest.
+
+Each image gets one JPEG per PREVIEW_SIZES entry smaller than the
+image (longest side, in pixels), in the blob store next to the
+originals and, like them, keyed by content:
+
+    BLOB_STORE_ROOT/previews/<size>/<checksum[:2]>/<checksum>.jpg
+
+so images uploaded again reuse the previews already on disk. The
+original is decoded once, at reduced scale for JPEGs (draft()), and
+each level is downscaled from the one above it. Paths are kept on
+Image.previews; list views serve the smallest level instead of the
+original.
+"""
+import logging
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import transaction
+from PIL import Image as PILImage, ImageOps
+
+from segmentation.models import Image
+from segmentation.utils.media import blob_root
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PREVIEW_SIZES = (256, 1024, 2048)
+
+PREVIEW_QUALITY = 85
+
+# Images handed to the pool (and bulk-updated) at a time
+DEFAULT_CHUNK_IMAGES = 500
+
+
+def preview_sizes():
+    return sorted(getattr(settings, "PREVIEW_SIZES", DEFAULT_PREVIEW_SIZES), reverse=True)
+
+
+def preview_workers():
+    return max(1, getattr(settings, "PREVIEW_WORKERS", None) or min(8, os.cpu_count() or 1))
+
+
+def previews_dir():
+    return os.path.join(blob_root(), 'previews')
+
+
+def preview_path(dest_dir, size, checksum):
+    return os.path.join(dest_dir, str(size), checksum[:2], f"{checksum}.jpg")
+
+
+def build_pyramid(file_path, checksum, dest_dir, sizes=None, long_side=None):
+    """
+    Write the preview levels of one image. With long_side (the image's
+    longest side) known, levels already on disk are reused without
+    decoding the image.
+
+    Returns:
+        {str(size): path} for the levels (none when the image is
+        already smaller than every level)
+    """
+    sizes = sorted(sizes or preview_sizes(), reverse=True)
+    built = {}
+
+    if long_side:
+        existing = {
+            str(size): preview_path(dest_dir, size, checksum)
+            for size in sizes if size < long_side
+        }
+        if all(os.path.exists(path) for path in existing.values()):
+            return existing
+
+    with PILImage.open(file_path) as img:
+        levels = [size for size in sizes if size < max(img.size)]
+        if not levels:
+            return built
+
+        # JPEG: let the decoder scale down by up to 8x
+        img.draft('RGB', (levels[0], levels[0]))
+        level = ImageOps.exif_transpose(img).convert('RGB')
+
+    for size in levels:
+        level.thumbnail((size, size), PILImage.LANCZOS)
+
+        path = preview_path(dest_dir, size, checksum)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Another upload of the same image may be writing this level too
+        temp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        level.save(temp, 'JPEG', quality=PREVIEW_QUALITY, optimize=True)
+        os.replace(temp, path)
+
+        built[str(size)] = path
+
+    return built
+
+
+def _build(image, dest_dir, sizes):
+    try:
+        return build_pyramid(
+            image.file_path,
+            image.checksum,
+            dest_dir,
+            sizes,
+            long_side=max(image.width, image.height)
+        )
+    except Exception as e:
+        logger.warning("Preview generation failed for image %s: %s", image.id, e)
+        return None
+
+
+def generate_previews(images, dest_dir, *, workers=None, chunk_images=DEFAULT_CHUNK_IMAGES):
+    """
+    Build the pyramid for every image on a thread pool (Pillow releases
+    the GIL while decoding, resizing and encoding) and store the paths
+    on Image.previews, one bulk_update per chunk.
+
+    Returns:
+        {"generated": int, "failed": int}
+    """
+    images = list(images)
+    sizes = preview_sizes()
+    generated = failed = 0
+
+    with ThreadPoolExecutor(
+        max_workers=workers or preview_workers(),
+        thread_name_prefix="previews"
+    ) as pool:
+        for start in range(0, len(images), chunk_images):
+            chunk = images[start:start + chunk_images]
+            done = []
+
+            for image, previews in zip(
+                chunk,
+                pool.map(lambda image: _build(image, dest_dir, sizes), chunk)
+            ):
+                if previews is None:
+                    failed += 1
+                    continue
+                image.previews = previews
+                done.append(image)
+
+            with transaction.atomic():
+                Image.objects.bulk_update(done, ['previews'])
+            generated += len(done)
+
+    return {"generated": generated, "failed": failed}
+
+
+def generate_dataset_previews(dataset, **kwargs):
+    images = Image.objects.filter(dataset=dataset).only(
+        'id', 'file_path', 'checksum', 'width', 'height'
+    )
+    return generate_previews(images, previews_dir(), **kwargs)
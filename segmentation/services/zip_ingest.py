@@ -0,0 +1,295 @@
+"""
+Single-pass ZIP ingestion.
+
+Every archive member is read exactly once: the decompressed stream is
+hashed (SHA256), sniffed for its image header and written to the
+content-addressed blob store as it goes (see segmentation.utils.media
+.blob_path). No second read for checksums or dimensions, memory use is
+bounded by the chunk size whatever the archive size, and a member whose
+content is already stored costs no disk write at all.
+
+Members are spread over a process or thread pool in chunks; results
+come back in archive order for the database stage. Worker processes
+only run the functions below, so this module must not touch Django at
+import time.
+"""
+import hashlib
+import io
+import multiprocessing
+import os
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from PIL import Image as PILImage
+
+from segmentation.utils.media import blob_path
+
+# Allowed image formats
+ALLOWED_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+MIN_IMAGE_SIDE = 256
+
+# Read size for decompression, hashing and writing
+CHUNK_SIZE = 1024 * 1024
+
+# Give up looking for the image header (JPEG SOF, PNG IHDR) after this
+# many bytes; EXIF blocks with embedded thumbnails can push it far in
+MAX_HEADER_BYTES = 4 * 1024 * 1024
+
+# Members are written here (inside the store, so the final rename is
+# atomic) under this suffix and renamed once complete
+TEMP_DIR = 'tmp'
+PART_SUFFIX = '.part'
+
+# Blob extension by the format PIL detects; the content decides it, so
+# equal bytes always map to the same path
+BLOB_EXTENSIONS = {'JPEG': '.jpg', 'MPO': '.jpg', 'PNG': '.png'}
+
+EXECUTOR_PROCESS = 'process'
+EXECUTOR_THREAD = 'thread'
+
+# Members handed to a worker at a time
+DEFAULT_CHUNK_MEMBERS = 16
+
+
+class MemberRejected(Exception):
+    """A member that is not a usable image; the message goes to the report."""
+
+
+def image_members(zf):
+    """Archive members that are files, in archive order."""
+    return [info for info in zf.infolist() if not info.is_dir()]
+
+
+def _sniff(head):
+    """(width, height, format) once `head` holds the image header, else None."""
+    try:
+        with PILImage.open(io.BytesIO(head)) as img:
+            return (*img.size, img.format)
+    except PILImage.DecompressionBombError:
+        raise MemberRejected("Image dimensions exceed the pixel limit")
+    except Exception:
+        return None
+
+
+def ingest_member(zf, info, store_root):
+    """
+    Stream one member into the blob store under store_root, hashing
+    and sniffing its dimensions on the way. When a blob with the same
+    checksum already exists the copy is dropped (and the blob touched,
+    so garbage collection leaves it alone while it is registered).
+
+    Returns:
+        {"checksum", "width", "height", "file_size", "file_path",
+         "new_blob"}
+
+    Raises MemberRejected; nothing is left in the store in that case.
+    """
+    sha256 = hashlib.sha256()
+    head = bytearray()
+    sniffed = None
+    file_size = 0
+    part_path = os.path.join(store_root, TEMP_DIR, uuid.uuid4().hex + PART_SUFFIX)
+
+    try:
+        with zf.open(info) as src, open(part_path, 'wb') as dst:
+            while True:
+                chunk = src.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+
+                sha256.update(chunk)
+                dst.write(chunk)
+                file_size += len(chunk)
+
+                if sniffed is None and len(head) < MAX_HEADER_BYTES:
+                    head += chunk
+                    sniffed = _sniff(head)
+
+        if sniffed is None:
+            raise MemberRejected("Unreadable image file")
+
+        width, height, image_format = sniffed
+        if width < MIN_IMAGE_SIDE or height < MIN_IMAGE_SIDE:
+            raise MemberRejected(
+                f"Image dimensions below {MIN_IMAGE_SIDE}x{MIN_IMAGE_SIDE}"
+            )
+
+        checksum = sha256.hexdigest()
+        dest_path = blob_path(
+            store_root,
+            checksum,
+            BLOB_EXTENSIONS.get(image_format, f".{image_format.lower()}")
+        )
+
+        try:
+            # Already stored: keep that copy, touched so gc_blobs leaves it
+            os.utime(dest_path)
+            new_blob = False
+            os.remove(part_path)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            os.replace(part_path, dest_path)
+            new_blob = True
+
+    except BaseException as e:
+        try:
+            os.remove(part_path)
+        except FileNotFoundError:
+            pass
+
+        if isinstance(e, zipfile.BadZipFile):
+            # CRC mismatch or broken compressed stream
+            raise MemberRejected(f"Corrupted file: {e}") from e
+        if isinstance(e, (zipfile.LargeZipFile, NotImplementedError)):
+            raise MemberRejected(f"Unsupported ZIP entry: {e}") from e
+        raise
+
+    return {
+        "checksum": checksum,
+        "width": width,
+        "height": height,
+        "file_size": file_size,
+        "file_path": dest_path,
+        "new_blob": new_blob,
+    }
+
+
+def _unique_name(file_name, used):
+    """Flatten folders, keeping equal basenames apart in Image.file_name."""
+    name = file_name
+    stem, ext = os.path.splitext(file_name)
+    n = 1
+    while name in used:
+        name = f"{stem}_{n}{ext}"
+        n += 1
+    used.add(name)
+    return name
+
+
+def plan_members(zf):
+    """
+    [(ZipInfo, file name)] for the image members, plus the failures
+    for members skipped on their name alone.
+    """
+    plan = []
+    failed = []
+    used = set()
+
+    for info in image_members(zf):
+        if not info.filename.lower().endswith(ALLOWED_EXTENSIONS):
+            failed.append({
+                "filename": info.filename,
+                "error": "Unsupported file format"
+            })
+            continue
+
+        plan.append((info, _unique_name(os.path.basename(info.filename), used)))
+
+    return plan, failed
+
+
+def ingest_settings():
+    """(workers, chunk members, executor kind) from settings."""
+    return (
+        max(1, getattr(settings, "INGEST_WORKERS", None) or min(8, os.cpu_count() or 1)),
+        max(1, getattr(settings, "INGEST_CHUNK_MEMBERS", DEFAULT_CHUNK_MEMBERS)),
+        getattr(settings, "INGEST_EXECUTOR", EXECUTOR_PROCESS),
+    )
+
+
+def archive_path(zip_file):
+    """Filesystem path of the archive, or None for in-memory uploads."""
+    if isinstance(zip_file, (str, os.PathLike)):
+        return os.fspath(zip_file)
+    if hasattr(zip_file, "temporary_file_path"):
+        return zip_file.temporary_file_path()
+    return None
+
+
+def _ingest_items(zf, store_root, items):
+    results = []
+    for info, name in items:
+        try:
+            stored = ingest_member(zf, info, store_root)
+        except (MemberRejected, OSError) as e:
+            results.append({"filename": info.filename, "error": str(e)})
+            continue
+
+        results.append({
+            "filename": info.filename,
+            "file_name": name,
+            **stored,
+        })
+    return results
+
+
+def _ingest_chunk(zip_path, store_root, max_image_pixels, items):
+    """Pool task: members of the archive at zip_path, opened per chunk."""
+    # Spawned workers start with PIL's default, not the parent's limit
+    PILImage.MAX_IMAGE_PIXELS = max_image_pixels
+    with zipfile.ZipFile(zip_path) as zf:
+        return _ingest_items(zf, store_root, items)
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _make_executor(kind, workers):
+    # Daemonic processes (django-q workers) cannot start children
+    if kind == EXECUTOR_PROCESS and not multiprocessing.current_process().daemon:
+        # spawn: no forked copies of the web worker's threads, DB
+        # connections or loaded model
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="zip-ingest")
+
+
+def ingest_zip(zip_file, store_root, *, workers=None, chunk_members=None, executor=None):
+    """
+    Stream every image member of zip_file into the blob store at
+    store_root.
+
+    Yields one dict per member: the ingest_member() fields plus
+    "filename" (name in the archive) and "file_name" (flattened, unique
+    within the archive), or "filename" and "error". Members rejected
+    by name come first, then the rest in archive order.
+
+    workers / chunk_members / executor ("process" or "thread") default
+    to INGEST_WORKERS / INGEST_CHUNK_MEMBERS / INGEST_EXECUTOR. Archives
+    without a filesystem path (in-memory uploads) always use threads,
+    sharing one ZipFile; archives that fit in one chunk run inline.
+    """
+    default_workers, default_chunk, default_executor = ingest_settings()
+    workers = workers or default_workers
+    chunk_members = chunk_members or default_chunk
+    executor = executor or default_executor
+
+    os.makedirs(os.path.join(store_root, TEMP_DIR), exist_ok=True)
+    zip_path = archive_path(zip_file)
+
+    with zipfile.ZipFile(zip_file) as zf:
+        plan, failed = plan_members(zf)
+        yield from failed
+
+        if workers == 1 or len(plan) <= chunk_members:
+            yield from _ingest_items(zf, store_root, plan)
+            return
+
+        if zip_path is None:
+            executor, task = EXECUTOR_THREAD, partial(_ingest_items, zf, store_root)
+        else:
+            task = partial(_ingest_chunk, zip_path, store_root, PILImage.MAX_IMAGE_PIXELS)
+
+        chunks = list(_chunks(plan, chunk_members))
+        with _make_executor(executor, min(workers, len(chunks))) as pool:
+            # map() hands results back in submission (archive) order
+            for results in pool.map(task, chunks):
+                yield from results
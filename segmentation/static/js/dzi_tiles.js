@@ -0,0 +1,156 @@
+/*
+ * Deep Zoom tile layer for the annotation canvas.
+ *
+ * Replaces drawing the full original into #imageCanvas: the canvas is
+ * kept the size of the visible part of the scroll container and only
+ * the tiles in view are fetched, from the pyramid level matching the
+ * current zoom. The single-tile overview level is drawn underneath, so
+ * the image shows at once and sharpens as tiles arrive.
+ */
+class DziTileLayer {
+    constructor(canvasEl, wrapperEl, containerEl, dziUrl) {
+        this.canvas = canvasEl;
+        this.ctx = canvasEl.getContext("2d");
+        this.wrapper = wrapperEl;
+        this.container = containerEl;
+        this.dziUrl = dziUrl;
+        this.tilesUrl = dziUrl.replace(/\.dzi$/, "_files/");
+        this.tiles = new Map();
+        this.maxTiles = 400;
+        this.zoom = 1;
+        this.pending = false;
+    }
+
+    async load() {
+        const res = await fetch(this.dziUrl, { credentials: "same-origin" });
+        if (!res.ok) {
+            throw new Error(`Tile descriptor: HTTP ${res.status}`);
+        }
+
+        const xml = new DOMParser().parseFromString(await res.text(), "application/xml");
+        const image = xml.getElementsByTagName("Image")[0];
+        const size = xml.getElementsByTagName("Size")[0];
+
+        this.tileSize = parseInt(image.getAttribute("TileSize"), 10);
+        this.overlap = parseInt(image.getAttribute("Overlap"), 10);
+        this.width = parseInt(size.getAttribute("Width"), 10);
+        this.height = parseInt(size.getAttribute("Height"), 10);
+        this.maxLevel = Math.ceil(Math.log2(Math.max(this.width, this.height)));
+
+        // Largest level that fits in one tile: the overview
+        this.overviewLevel = Math.max(0, Math.min(
+            this.maxLevel,
+            this.maxLevel - Math.ceil(Math.log2(Math.max(this.width, this.height) / this.tileSize))
+        ));
+
+        this.canvas.style.position = "absolute";
+        this.container.addEventListener("scroll", () => this.schedule());
+        window.addEventListener("resize", () => this.schedule());
+
+        return { width: this.width, height: this.height };
+    }
+
+    setZoom(zoom) {
+        this.zoom = zoom;
+        this.schedule();
+    }
+
+    schedule() {
+        if (this.pending) return;
+        this.pending = true;
+        requestAnimationFrame(() => {
+            this.pending = false;
+            this.draw();
+        });
+    }
+
+    levelForZoom() {
+        const scale = this.zoom * (window.devicePixelRatio || 1);
+        const level = this.maxLevel + Math.ceil(Math.log2(scale));
+        return Math.max(this.overviewLevel, Math.min(this.maxLevel, level));
+    }
+
+    levelScale(level) {
+        // Level pixels -> wrapper CSS pixels
+        return this.zoom * Math.pow(2, this.maxLevel - level);
+    }
+
+    tile(level, col, row) {
+        const key = `${level}/${col}_${row}`;
+        let img = this.tiles.get(key);
+
+        if (img) {
+            // Most recently used last
+            this.tiles.delete(key);
+            this.tiles.set(key, img);
+            return img.complete && img.naturalWidth ? img : null;
+        }
+
+        img = new Image();
+        img.onload = () => this.schedule();
+        img.src = `${this.tilesUrl}${key}.jpg`;
+        this.tiles.set(key, img);
+
+        if (this.tiles.size > this.maxTiles) {
+            this.tiles.delete(this.tiles.keys().next().value);
+        }
+        return null;
+    }
+
+    drawLevel(level, view) {
+        const scale = this.levelScale(level);
+        const span = this.tileSize * scale;
+        const levelW = Math.ceil(this.width / Math.pow(2, this.maxLevel - level));
+        const levelH = Math.ceil(this.height / Math.pow(2, this.maxLevel - level));
+
+        const col0 = Math.max(0, Math.floor(view.left / span));
+        const row0 = Math.max(0, Math.floor(view.top / span));
+        const col1 = Math.min(Math.ceil(levelW / this.tileSize) - 1, Math.floor(view.right / span));
+        const row1 = Math.min(Math.ceil(levelH / this.tileSize) - 1, Math.floor(view.bottom / span));
+
+        for (let row = row0; row <= row1; row++) {
+            for (let col = col0; col <= col1; col++) {
+                const img = this.tile(level, col, row);
+                if (!img) continue;
+
+                const x = col * this.tileSize - (col > 0 ? this.overlap : 0);
+                const y = row * this.tileSize - (row > 0 ? this.overlap : 0);
+                this.ctx.drawImage(img, x * scale, y * scale, img.naturalWidth * scale, img.naturalHeight * scale);
+            }
+        }
+    }
+
+    draw() {
+        if (!this.width) return;
+
+        // Visible part of the wrapper, in wrapper CSS pixels
+        const box = this.container.getBoundingClientRect();
+        const wrap = this.wrapper.getBoundingClientRect();
+        const view = {
+            left: Math.max(box.left, wrap.left) - wrap.left,
+            top: Math.max(box.top, wrap.top) - wrap.top,
+            right: Math.min(box.right, wrap.right) - wrap.left,
+            bottom: Math.min(box.bottom, wrap.bottom) - wrap.top,
+        };
+        const viewW = view.right - view.left;
+        const viewH = view.bottom - view.top;
+        if (viewW <= 0 || viewH <= 0) return;
+
+        const dpr = window.devicePixelRatio || 1;
+        this.canvas.style.left = `${view.left}px`;
+        this.canvas.style.top = `${view.top}px`;
+        this.canvas.style.width = `${viewW}px`;
+        this.canvas.style.height = `${viewH}px`;
+        this.canvas.width = Math.ceil(viewW * dpr);
+        this.canvas.height = Math.ceil(viewH * dpr);
+
+        this.ctx.setTransform(dpr, 0, 0, dpr, -view.left * dpr, -view.top * dpr);
+        this.ctx.imageSmoothingQuality = "high";
+
+        const level = this.levelForZoom();
+        this.drawLevel(this.overviewLevel, view);
+        if (level > this.overviewLevel) {
+            this.drawLevel(level, view);
+        }
+    }
+}
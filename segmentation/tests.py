@@ -1,3 +1,1525 @@
-from django.test import TestCase
+import hashlib
+import io
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import Future
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image as PILImage, ImageOps
+
+from accounts.models import User
+from segmentation.models import (
+    Batch,
+    BatchImage,
+    Blob,
+    Dataset,
+    Image,
+    Project,
+    ProjectEmployeeMapping,
+    SegmentationTask,
+    UploadSession,
+)
+from segmentation.ai import image_io, sam, server, tiling
+from segmentation.ai.embedding_cache import EmbeddingCache, ImageEmbedding
+from segmentation.ai.scheduler import InferenceScheduler, SchedulerBusy
+from segmentation.ai.tiling import RegionReader
+from segmentation.services.batch_upload import (
+    create_segmentation_tasks,
+    queue_batch_archive,
+    run_batch_upload,
+    save_images_to_dataset,
+)
+from segmentation.services.blob_store import collect_garbage
+from segmentation.services.chunked_upload import (
+    UploadError,
+    complete_upload,
+    expire_uploads,
+    initiate_upload,
+    session_archive_path,
+    store_part,
+)
+from segmentation.services.deepzoom import get_tile, max_level, tile_path
+from segmentation.services.previews import build_pyramid
+from segmentation.services import auto_segmentation, embedding_precompute, zip_ingest
+from segmentation.services.zip_ingest import TEMP_DIR, MemberRejected, ingest_member, ingest_zip
+from segmentation.ai.inference import output_size, predict_from_prompts, predict_full_image
+from segmentation.utils.masks import decode_rle, encode_rle
+from segmentation.utils.metrics import registry, stage
+
+
+def make_zip(count, seed=0, duplicate_of=None, extra=None):
+    """
+    ZIP of `count` distinct 256x256 JPEGs, plus copies of the given
+    indices and any `extra` {name: bytes} members.
+    """
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        buf = io.BytesIO()
+        pixels = rng.integers(0, 255, (256, 256, 3), dtype=np.uint8)
+        PILImage.fromarray(pixels).save(buf, 'JPEG')
+        images.append(buf.getvalue())
+
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zf:
+        for i, data in enumerate(images):
+            zf.writestr(f'img_{i}.jpg', data)
+        for i in duplicate_of or ():
+            zf.writestr(f'copy_of_{i}.jpg', images[i])
+        for name, data in (extra or {}).items():
+            zf.writestr(name, data)
+    archive.seek(0)
+    return archive
+
+
+@override_settings(INGEST_WORKERS=1)
+class ImageRegistrationTests(TestCase):
+
+    def setUp(self):
+        self.storage = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.storage, ignore_errors=True)
+
+        blob_settings = self.settings(BLOB_STORE_ROOT=self.storage, TILE_CACHE_ROOT=self.storage)
+        blob_settings.enable()
+        self.addCleanup(blob_settings.disable)
+
+        admin = User.objects.create_user('admin', password='x', role='ADMIN')
+        self.project = Project.objects.create(
+            name='Project',
+            code='p1',
+            created_by=admin,
+            storage_path=self.storage
+        )
+        self.admin = admin
+
+    def make_dataset(self, code):
+        return Dataset.objects.create(
+            project=self.project,
+            name=code,
+            code=code,
+            status='ACTIVE',
+            storage_path=self.storage,
+            created_by=self.admin
+        )
+
+    def count_queries(self, archive, dataset, batch_size):
+        with CaptureQueriesContext(connection) as queries:
+            result = save_images_to_dataset(
+                zip_file=archive,
+                project=self.project,
+                dataset=dataset,
+                batch_size=batch_size
+            )
+        return len(queries), result
+
+    def test_query_count_does_not_grow_with_image_count(self):
+        small, small_result = self.count_queries(make_zip(2), self.make_dataset('small'), 100)
+        large, large_result = self.count_queries(make_zip(40, seed=1), self.make_dataset('large'), 100)
+
+        self.assertEqual(small_result["created"], 2)
+        self.assertEqual(large_result["created"], 40)
+        self.assertEqual(small, large)
+
+    def test_query_count_grows_per_batch_not_per_image(self):
+        one_batch, _ = self.count_queries(make_zip(10), self.make_dataset('one'), 10)
+        two_batches, _ = self.count_queries(make_zip(20, seed=1), self.make_dataset('two'), 10)
+
+        self.assertEqual(two_batches, 2 * one_batch)
+
+    def test_duplicates_within_archive_and_across_batches(self):
+        dataset = self.make_dataset('dups')
+        _, result = self.count_queries(make_zip(5, duplicate_of=[0, 4]), dataset, 3)
+
+        self.assertEqual(result["created"], 5)
+        self.assertEqual(result["duplicates"], 2)
+        self.assertEqual(Image.objects.filter(dataset=dataset).count(), 5)
+
+        # Same images uploaded again into the dataset: all duplicates
+        _, result = self.count_queries(make_zip(5), dataset, 3)
+        self.assertEqual(result["created"], 0)
+        self.assertEqual(result["duplicates"], 5)
+
+    def test_batch_images_record_every_member(self):
+        dataset = self.make_dataset('tracked')
+        batch = Batch.objects.create(
+            project=self.project,
+            dataset=dataset,
+            batch_id='tracked',
+            uploaded_by=self.admin,
+            original_zip_path='tracked.zip',
+            total_images=9
+        )
+        archive = make_zip(5, duplicate_of=[1], extra={'notes.txt': b'x', 'bad.jpg': b'x'})
+
+        with CaptureQueriesContext(connection) as queries:
+            save_images_to_dataset(
+                zip_file=archive,
+                project=self.project,
+                dataset=dataset,
+                batch_size=3,
+                batch=batch
+            )
+
+        rows = {row.original_filename: row for row in BatchImage.objects.filter(batch=batch)}
+        self.assertEqual(len(rows), 8)
+        self.assertEqual(
+            sorted(row.status for row in rows.values()),
+            ['DUPLICATE'] + ['FAILED'] * 2 + ['STORED'] * 5
+        )
+        self.assertEqual(rows['copy_of_1.jpg'].image_id, rows['img_1.jpg'].image_id)
+        self.assertEqual(rows['notes.txt'].error_message, 'Unsupported file format')
+
+        # Rows are written per chunk, not per file
+        inserts = [q for q in queries if 'INSERT INTO "segmentation_batchimage"' in q['sql']]
+        self.assertEqual(len(inserts), 3)
+
+    def store_files(self):
+        return sorted(
+            os.path.join(directory, name)
+            for directory, _, names in os.walk(self.storage)
+            for name in names
+            if len(os.path.basename(os.path.dirname(directory))) == 2
+        )
+
+    def test_reupload_to_another_dataset_shares_files(self):
+        first = self.make_dataset('first')
+        _, result = self.count_queries(make_zip(4), first, 10)
+        files = self.store_files()
+
+        self.assertEqual(len(files), 4)
+        self.assertEqual(result["blobs_reused"], 0)
+
+        second = self.make_dataset('second')
+        _, result = self.count_queries(make_zip(4), second, 10)
+
+        self.assertEqual(result["created"], 4)
+        self.assertEqual(result["blobs_reused"], 4)
+        self.assertEqual(self.store_files(), files)
+        self.assertEqual(
+            set(Image.objects.filter(dataset=second).values_list('file_path', flat=True)),
+            set(files)
+        )
+        self.assertEqual(set(Blob.objects.values_list('ref_count', flat=True)), {2})
+
+    def test_garbage_collection_keeps_referenced_files(self):
+        first = self.make_dataset('first')
+        second = self.make_dataset('second')
+        self.count_queries(make_zip(3), first, 10)
+        self.count_queries(make_zip(2), second, 10)
+
+        first.delete()
+        result = collect_garbage(grace_seconds=0)
+
+        # img_2 was only in the first dataset
+        self.assertEqual(result["blobs"], 1)
+        self.assertEqual(len(self.store_files()), 2)
+        self.assertEqual(Blob.objects.count(), 2)
+        for image in Image.objects.all():
+            self.assertTrue(os.path.exists(image.file_path))
+
+    def test_garbage_collection_rechecks_live_images(self):
+        self.count_queries(make_zip(2), self.make_dataset('live'), 10)
+
+        # A count taken before an ingest registered its images
+        Blob.objects.update(ref_count=0)
+        with mock.patch('segmentation.services.blob_store.refresh_ref_counts'):
+            result = collect_garbage(grace_seconds=0)
+
+        self.assertEqual(result["blobs"], 0)
+        self.assertEqual(Blob.objects.count(), 2)
+        self.assertEqual(len(self.store_files()), 2)
+
+    def test_garbage_collection_restores_missing_blob_rows(self):
+        self.count_queries(make_zip(2), self.make_dataset('live'), 10)
+
+        # An ingest that stored its images but died before (or raced
+        # with) registering the Blob rows
+        Blob.objects.all().delete()
+        result = collect_garbage(grace_seconds=0)
+
+        self.assertEqual((result["orphans"], result["restored"]), (0, 2))
+        self.assertEqual(len(self.store_files()), 2)
+        self.assertEqual(
+            sorted(Blob.objects.values_list('ref_count', flat=True)), [1, 1]
+        )
+        for image in Image.objects.all():
+            self.assertTrue(os.path.exists(image.file_path))
+
+
+class ZipIngestTests(TestCase):
+
+    def setUp(self):
+        self.store = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.store, ignore_errors=True)
+        os.makedirs(f'{self.store}/{TEMP_DIR}')
+
+    @staticmethod
+    def jpeg(size=(256, 256), seed=0):
+        buf = io.BytesIO()
+        pixels = np.random.default_rng(seed).integers(0, 255, (size[1], size[0], 3), dtype=np.uint8)
+        PILImage.fromarray(pixels).save(buf, 'JPEG')
+        return buf.getvalue()
+
+    @staticmethod
+    def archive(members, compression=zipfile.ZIP_DEFLATED):
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w', compression) as zf:
+            for name, data in members.items():
+                zf.writestr(name, data)
+        return buf.getvalue()
+
+    def ingest(self, data, name='image.jpg'):
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            return ingest_member(zf, zf.getinfo(name), self.store)
+
+    def leftovers(self):
+        return os.listdir(f'{self.store}/{TEMP_DIR}')
+
+    def test_member_is_read_once_hashed_and_sniffed(self):
+        data = self.jpeg(size=(300, 260))
+        with zipfile.ZipFile(io.BytesIO(self.archive({'image.jpg': data}))) as zf:
+            with mock.patch.object(zf, 'open', wraps=zf.open) as opened:
+                result = ingest_member(zf, zf.getinfo('image.jpg'), self.store)
+
+        self.assertEqual(opened.call_count, 1)
+        self.assertEqual(result["checksum"], hashlib.sha256(data).hexdigest())
+        self.assertEqual((result["width"], result["height"]), (300, 260))
+        self.assertEqual(result["file_size"], len(data))
+        self.assertTrue(result["new_blob"])
+        with open(result["file_path"], 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(self.leftovers(), [])
+
+    def test_small_or_unreadable_images_are_rejected(self):
+        with self.assertRaisesMessage(MemberRejected, 'below 256x256'):
+            self.ingest(self.archive({'image.jpg': self.jpeg(size=(255, 400))}))
+        with self.assertRaisesMessage(MemberRejected, 'Unreadable image file'):
+            self.ingest(self.archive({'image.jpg': b'not an image'}))
+        self.assertEqual(self.leftovers(), [])
+
+    def test_stored_content_is_touched_not_written_again(self):
+        archive = self.archive({'image.jpg': self.jpeg()})
+        first = self.ingest(archive)
+        past = time.time() - 3600
+        os.utime(first["file_path"], (past, past))
+
+        second = self.ingest(archive)
+
+        self.assertFalse(second["new_blob"])
+        self.assertEqual(second["file_path"], first["file_path"])
+        self.assertGreater(os.path.getmtime(first["file_path"]), past + 60)
+        self.assertEqual(self.leftovers(), [])
+
+    def test_corrupt_member_leaves_no_partial_file(self):
+        data = self.jpeg()
+        archive = bytearray(self.archive({'image.jpg': data}, zipfile.ZIP_STORED))
+        # Past the header, so the image sniffs fine and the CRC check fails
+        archive[archive.find(data) + len(data) - 10] ^= 0xFF
+
+        with self.assertRaisesMessage(MemberRejected, 'Corrupted file'):
+            self.ingest(bytes(archive))
+        self.assertEqual(self.leftovers(), [])
+
+    def expected_order(self, archive):
+        with zipfile.ZipFile(archive) as zf:
+            return [name for name in zf.namelist() if name != 'notes.txt']
+
+    def test_pooled_results_come_back_in_archive_order(self):
+        path = f'{self.store}/upload.zip'
+        with open(path, 'wb') as f:
+            f.write(make_zip(7, duplicate_of=[0], extra={'notes.txt': b'x'}).getvalue())
+
+        for executor in ('process', 'thread'):
+            with self.subTest(executor=executor):
+                results = list(ingest_zip(
+                    path, self.store, workers=3, chunk_members=2, executor=executor
+                ))
+
+                # Rejected by name first, then every member in order
+                self.assertEqual(results[0], {"filename": 'notes.txt', "error": 'Unsupported file format'})
+                self.assertEqual([r["filename"] for r in results[1:]], self.expected_order(path))
+                self.assertEqual(results[-1]["checksum"], results[1]["checksum"])
+
+    def test_in_memory_archive_shares_one_zipfile_across_threads(self):
+        archive = make_zip(7)
+
+        with mock.patch.object(zip_ingest.zipfile, 'ZipFile', wraps=zipfile.ZipFile) as opened, \
+                mock.patch.object(zip_ingest, '_make_executor', wraps=zip_ingest._make_executor) as pools:
+            results = list(ingest_zip(
+                archive, self.store, workers=3, chunk_members=2, executor='process'
+            ))
+
+        self.assertEqual(opened.call_count, 1)
+        self.assertEqual(pools.call_args.args, ('thread', 3))
+        self.assertEqual([r["filename"] for r in results], self.expected_order(archive))
+        self.assertTrue(all("checksum" in r for r in results))
+
+
+class TaskAssignmentTests(TestCase):
+
+    def setUp(self):
+        admin = User.objects.create_user('admin', password='x', role='ADMIN')
+        self.project = Project.objects.create(
+            name='Project',
+            code='p1',
+            created_by=admin,
+            storage_path=tempfile.gettempdir()
+        )
+        self.dataset = Dataset.objects.create(
+            project=self.project,
+            name='d1',
+            code='d1',
+            status='ACTIVE',
+            storage_path=tempfile.gettempdir(),
+            created_by=admin
+        )
+        self.mappings = [
+            ProjectEmployeeMapping.objects.create(
+                project=self.project,
+                user=User.objects.create_user(f'seg{i}', password='x'),
+                role_in_project='SEGMENTER',
+                capacity=capacity,
+                current_workload=workload,
+                start_date=timezone.now()
+            )
+            for i, (capacity, workload) in enumerate([(10, 0), (5, 2), (3, 3)])
+        ]
+
+    def make_images(self, count, offset=0):
+        return Image.objects.bulk_create([
+            Image(
+                dataset=self.dataset,
+                file_name=f'{i}.jpg',
+                file_path=f'/tmp/{i}.jpg',
+                width=256,
+                height=256,
+                file_size=1,
+                checksum=f'{i:064d}'
+            )
+            for i in range(offset, offset + count)
+        ])
+
+    def test_query_count_does_not_grow_with_image_count(self):
+        with CaptureQueriesContext(connection) as small:
+            create_segmentation_tasks(images=self.make_images(2), project=self.project)
+        with CaptureQueriesContext(connection) as large:
+            create_segmentation_tasks(images=self.make_images(8, offset=2), project=self.project)
+
+        self.assertEqual(len(small), len(large))
+
+    def test_assignment_respects_capacity(self):
+        result = create_segmentation_tasks(images=self.make_images(15), project=self.project)
+
+        # 10 + 3 free slots; the third segmenter is already full
+        self.assertEqual(result["tasks_created"], 13)
+        self.assertEqual(result["unassigned_count"], 2)
+
+        for mapping in self.mappings:
+            mapping.refresh_from_db()
+        self.assertEqual(
+            [m.current_workload for m in self.mappings],
+            [10, 5, 3]
+        )
+        self.assertEqual(
+            SegmentationTask.objects.filter(segmenter=self.mappings[0].user).count(),
+            10
+        )
+
+
+class ChunkedUploadTests(TestCase):
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        media_settings = self.settings(MEDIA_ROOT=media)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+        self.admin = User.objects.create_user('admin', password='x', role='ADMIN')
+        self.project = Project.objects.create(
+            name='Project',
+            code='p1',
+            created_by=self.admin,
+            storage_path=media
+        )
+
+        self.archive = make_zip(3).getvalue()
+        self.session = initiate_upload(
+            project=self.project,
+            uploaded_by=self.admin,
+            file_name='upload.zip',
+            total_size=len(self.archive),
+            part_size=len(self.archive) // 2 + 1
+        )
+
+    def part(self, number):
+        start = (number - 1) * self.session.part_size
+        return self.archive[start:start + self.session.part_size]
+
+    def send(self, number, data=None, sha256=None):
+        data = self.part(number) if data is None else data
+        return store_part(
+            self.session,
+            number,
+            io.BytesIO(data),
+            sha256 or hashlib.sha256(data).hexdigest()
+        )
+
+    def test_wrong_size_or_checksum_is_rejected(self):
+        with self.assertRaisesMessage(UploadError, 'must be'):
+            self.send(1, self.part(1)[:-1])
+        with self.assertRaisesMessage(UploadError, 'checksum mismatch'):
+            self.send(1, sha256='0' * 64)
+
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.missing_parts(), [1, 2])
+
+    def test_parts_are_written_in_place_and_can_be_resent(self):
+        self.send(2)
+        self.send(1, b'x' * self.session.part_size)
+        self.send(1)
+
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.missing_parts(), [])
+        with open(session_archive_path(self.session), 'rb') as f:
+            self.assertEqual(f.read(), self.archive)
+
+    def test_complete_requires_every_part_and_runs_once(self):
+        self.send(1)
+        with self.assertRaisesMessage(UploadError, 'Missing parts: [2]'):
+            complete_upload(self.session)
+
+        self.send(2)
+        batch, error = complete_upload(self.session)
+        self.assertIsNone(error)
+        self.assertEqual(batch.total_images, 3)
+        self.assertTrue(os.path.exists(batch.original_zip_path))
+
+        with self.assertRaisesMessage(UploadError, 'Upload is completed'):
+            complete_upload(self.session)
+        self.assertEqual(UploadSession.objects.get(pk=self.session.pk).batch, batch)
+
+    def test_part_without_a_body_is_rejected(self):
+        self.client.force_login(self.admin)
+        response = self.client.put(
+            f'/api/admin/uploads/{self.session.upload_id}/parts/1/',
+            b'',
+            content_type='application/octet-stream',
+            HTTP_X_PART_SHA256=hashlib.sha256(b'').hexdigest()
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"error": "Part body is empty"})
+
+    def test_idle_sessions_expire_with_their_archive(self):
+        self.send(1)
+        fresh = initiate_upload(
+            project=self.project, uploaded_by=self.admin, file_name='fresh.zip', total_size=10
+        )
+        UploadSession.objects.filter(pk=self.session.pk).update(
+            updated_at=timezone.now() - timedelta(days=8)
+        )
+
+        self.assertEqual(expire_uploads(dry_run=True)["sessions"], 1)
+        self.assertTrue(os.path.exists(session_archive_path(self.session)))
+
+        result = expire_uploads()
+
+        self.assertEqual(result["sessions"], 1)
+        self.assertGreaterEqual(result["bytes"], len(self.archive))
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.status, 'ABORTED')
+        self.assertFalse(os.path.exists(session_archive_path(self.session)))
+        self.assertTrue(os.path.exists(session_archive_path(fresh)))
+        with self.assertRaisesMessage(UploadError, 'Upload is aborted'):
+            self.send(2)
+
+
+@override_settings(INGEST_WORKERS=1, PREVIEW_WORKERS=1)
+class BatchPipelineTests(TestCase):
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        media_settings = self.settings(MEDIA_ROOT=media, BLOB_STORE_ROOT=media)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+        self.admin = User.objects.create_user('admin', password='x', role='ADMIN')
+        self.uploader = User.objects.create_user('uploader', password='x')
+        self.project = Project.objects.create(
+            name='Project',
+            code='p1',
+            created_by=self.admin,
+            storage_path=media
+        )
+        ProjectEmployeeMapping.objects.create(
+            project=self.project,
+            user=User.objects.create_user('seg', password='x'),
+            role_in_project='SEGMENTER',
+            capacity=10,
+            start_date=timezone.now()
+        )
+
+        self.archive_path = f'{media}/upload.zip'
+        with open(self.archive_path, 'wb') as f:
+            f.write(make_zip(3).getvalue())
+
+    def queue(self, **kwargs):
+        with mock.patch('segmentation.services.batch_upload.async_task') as async_task:
+            batch, error = queue_batch_archive(
+                archive_path=self.archive_path,
+                batch_id='upload_1',
+                project=self.project,
+                uploaded_by=self.uploader,
+                **kwargs
+            )
+        self.assertIsNone(error)
+        _, *args = async_task.call_args.args
+        return batch, args
+
+    def test_queued_batch_runs_once_and_removes_its_archive(self):
+        batch, args = self.queue()
+        self.assertEqual(batch.status, 'PENDING')
+
+        summary = run_batch_upload(*args)
+
+        batch.refresh_from_db()
+        self.assertEqual(batch.status, 'COMPLETED')
+        self.assertEqual(summary["total_tasks_created"], 3)
+        self.assertEqual(SegmentationTask.objects.filter(image__dataset=batch.dataset).count(), 3)
+        self.assertFalse(os.path.exists(self.archive_path))
+
+        # A second delivery of the same task does nothing
+        self.assertIsNone(run_batch_upload(*args))
+        self.assertEqual(SegmentationTask.objects.count(), 3)
+
+    def test_failed_batch_removes_its_archive(self):
+        ProjectEmployeeMapping.objects.all().delete()
+        batch, args = self.queue()
+
+        with self.assertRaisesMessage(Exception, 'No available segmenters'):
+            run_batch_upload(*args)
+
+        batch.refresh_from_db()
+        self.assertEqual(batch.status, 'FAILED')
+        self.assertFalse(os.path.exists(self.archive_path))
+
+    def test_retry_of_an_interrupted_batch_marks_it_failed(self):
+        batch, args = self.queue()
+        # The first attempt was killed by the cluster timeout
+        Batch.objects.filter(pk=batch.pk).update(status='PROCESSING')
+
+        self.assertIsNone(run_batch_upload(*args))
+
+        batch.refresh_from_db()
+        self.assertEqual(batch.status, 'FAILED')
+        self.assertIn('interrupted', batch.error_message)
+        self.assertIsNotNone(batch.completed_at)
+        self.assertFalse(os.path.exists(self.archive_path))
+
+    def test_precompute_is_queued_for_uncached_images_only(self):
+        batch, args = self.queue(precompute_embeddings=True)
+        cached = []
+
+        def contains(checksum):
+            # The first image in priority order is already encoded
+            if not cached:
+                cached.append(checksum)
+            return checksum == cached[0]
+
+        with mock.patch.object(embedding_precompute.embedding_cache, 'contains', side_effect=contains), \
+                mock.patch.object(embedding_precompute, 'async_task') as async_task:
+            summary = run_batch_upload(*args)
+
+        self.assertEqual(summary["embeddings_queued"], 2)
+        batch.refresh_from_db()
+        self.assertIn('embeddings_queue', batch.stage_timings)
+        self.assertEqual((batch.embeddings_total, batch.embeddings_done), (3, 1))
+
+        async_task.assert_called_once()
+        func, batch_pk, image_ids = async_task.call_args.args
+        self.assertEqual(func, 'segmentation.services.embedding_precompute.precompute_embeddings')
+        self.assertEqual(batch_pk, batch.pk)
+        self.assertEqual(async_task.call_args.kwargs["group"], 'embeddings_upload_1')
+        self.assertEqual(
+            set(Image.objects.filter(id__in=image_ids).values_list('checksum', flat=True)),
+            set(Image.objects.filter(dataset=batch.dataset).exclude(checksum=cached[0])
+                .values_list('checksum', flat=True))
+        )
+
+        # The chunk runs: one image encodes, the other fails
+        with mock.patch.object(
+            embedding_precompute, 'set_image_cached', side_effect=[None, RuntimeError("CUDA error")]
+        ):
+            embedding_precompute.precompute_embeddings(batch_pk, image_ids)
+
+        batch.refresh_from_db()
+        self.assertEqual((batch.embeddings_done, batch.embeddings_failed), (2, 1))
+
+        # Once every image is cached a rerun queues nothing
+        with mock.patch.object(embedding_precompute.embedding_cache, 'contains', return_value=True), \
+                mock.patch.object(embedding_precompute, 'async_task') as async_task:
+            result = embedding_precompute.queue_embedding_precompute(batch)
+
+        self.assertEqual(result, {"total": 3, "already_done": 3, "queued": 0, "tasks": 0})
+        async_task.assert_not_called()
+        batch.refresh_from_db()
+        self.assertEqual(batch.embedding_percentage(), 100)
+
+    def test_precompute_is_off_by_default(self):
+        batch, args = self.queue()
+        with override_settings(SAM_PRECOMPUTE_ON_UPLOAD=False), \
+                mock.patch.object(embedding_precompute, 'async_task') as async_task:
+            summary = run_batch_upload(*args)
+        self.assertEqual(summary["embeddings_queued"], 0)
+        async_task.assert_not_called()
+
+    def test_files_are_paginated_in_archive_order_and_filtered(self):
+        with open(self.archive_path, 'wb') as f:
+            f.write(make_zip(5, duplicate_of=[1], extra={'bad.jpg': b'x'}).getvalue())
+        batch, args = self.queue()
+        run_batch_upload(*args)
+        self.client.force_login(self.uploader)
+        url = f'/api/admin/batches/{batch.batch_id}/files/'
+
+        first = self.client.get(url, {'page_size': 3}).json()
+        self.assertEqual((first["count"], first["num_pages"], first["page"]), (7, 3, 1))
+        self.assertTrue(first["has_next"])
+        self.assertEqual([row["filename"] for row in first["results"]], ['img_0.jpg', 'img_1.jpg', 'img_2.jpg'])
+
+        last = self.client.get(url, {'page_size': 3, 'page': 3}).json()
+        self.assertFalse(last["has_next"])
+        self.assertEqual([row["filename"] for row in last["results"]], ['bad.jpg'])
+        self.assertEqual(self.client.get(url, {'page_size': 3, 'page': 99}).json()["page"], 3)
+
+        failed = self.client.get(url, {'status': 'failed'}).json()
+        self.assertEqual(failed["count"], 1)
+        self.assertEqual(failed["results"][0]["filename"], 'bad.jpg')
+        self.assertIsNone(failed["results"][0]["image_id"])
+        self.assertTrue(failed["results"][0]["error"])
+
+        duplicate = self.client.get(url, {'status': 'DUPLICATE'}).json()["results"]
+        self.assertEqual([row["filename"] for row in duplicate], ['copy_of_1.jpg'])
+        self.assertEqual(duplicate[0]["image_id"], first["results"][1]["image_id"])
+
+        # Bad or out-of-range page sizes fall back to the limits
+        self.assertEqual(self.client.get(url, {'page_size': 'all'}).json()["page_size"], 100)
+        self.assertEqual(self.client.get(url, {'page_size': 0}).json()["page_size"], 1)
+        self.assertEqual(self.client.get(url, {'page_size': 10 ** 6}).json()["page_size"], 1000)
+
+    def test_status_is_visible_to_the_uploader_and_admins_only(self):
+        batch, args = self.queue()
+        run_batch_upload(*args)
+        stranger = User.objects.create_user('stranger', password='x')
+
+        for user, expected in ((self.uploader, 200), (self.admin, 200), (stranger, 404)):
+            self.client.force_login(user)
+            for url in (
+                f'/api/admin/batches/{batch.batch_id}/status/',
+                f'/api/admin/batches/{batch.batch_id}/files/',
+            ):
+                self.assertEqual(self.client.get(url).status_code, expected, (user, url))
+
+        self.client.force_login(self.uploader)
+        data = self.client.get(f'/api/admin/batches/{batch.batch_id}/status/').json()
+        self.assertEqual(data["status"], 'COMPLETED')
+        self.assertEqual(data["images_extracted"], 3)
+        self.assertEqual(data["total_tasks_created"], 3)
+        self.assertEqual(data["completion_percentage"], 100.0)
+        self.assertEqual(set(data["stage_timings"]), {'validate', 'ingest', 'previews', 'tasks'})
+        self.assertEqual(data["files_url"], f'/api/admin/batches/{batch.batch_id}/files/')
+
+
+class PreviewPyramidTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+
+    def write_image(self, width, height):
+        path = f'{self.root}/{width}x{height}.jpg'
+        PILImage.new('RGB', (width, height), 'white').save(path)
+        return path
+
+    @override_settings(PREVIEW_SIZES=(256, 1024))
+    def test_levels_smaller_than_the_image_only(self):
+        built = build_pyramid(self.write_image(1600, 800), 'big', self.root)
+
+        self.assertEqual(sorted(built, key=int), ['256', '1024'])
+        self.assertEqual(PILImage.open(built['1024']).size, (1024, 512))
+        self.assertEqual(PILImage.open(built['256']).size, (256, 128))
+
+        built = build_pyramid(self.write_image(600, 300), 'small', self.root)
+        self.assertEqual(list(built), ['256'])
+
+    @override_settings(PREVIEW_SIZES=(256, 1024))
+    def test_task_lists_link_the_smallest_preview(self):
+        user = User.objects.create_user('seg', password='x')
+        project = Project.objects.create(name='P', code='p1', created_by=user, storage_path=self.root)
+        dataset = Dataset.objects.create(
+            project=project, name='d1', code='d1', status='ACTIVE',
+            storage_path=self.root, created_by=user
+        )
+        path = self.write_image(1600, 800)
+        image = Image.objects.create(
+            dataset=dataset, file_name='big.jpg', file_path=path, width=1600, height=800,
+            file_size=1, checksum='ab' * 32, previews=build_pyramid(path, 'big', self.root)
+        )
+        SegmentationTask.objects.create(image=image, segmenter=user, assigned_to=user, status='ASSIGNED')
+        self.client.force_login(user)
+
+        with self.settings(MEDIA_ROOT=self.root, MEDIA_URL='/media/'):
+            task, = self.client.get('/api/segmenter/my-tasks/').json()
+
+        self.assertEqual(task["thumbnail_url"], '/media/' + os.path.relpath(image.previews['256'], self.root))
+
+
+class DeepZoomTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+
+        path = f'{self.root}/image.png'
+        PILImage.new('RGB', (600, 300), 'white').save(path)
+        self.image = SimpleNamespace(file_path=path, checksum='ab' * 32, previews={})
+
+    def test_levels_and_tile_edges(self):
+        with override_settings(TILE_SIZE=256, TILE_OVERLAP=1, TILE_CACHE_ROOT=self.root):
+            top = max_level(600, 300)
+            self.assertEqual(top, 10)
+
+            # Inner edges carry the overlap, image edges do not
+            self.assertEqual(PILImage.open(get_tile(self.image, top, 0, 0)).size, (257, 257))
+            self.assertEqual(PILImage.open(get_tile(self.image, top, 2, 1)).size, (89, 45))
+            self.assertEqual(PILImage.open(get_tile(self.image, 0, 0, 0)).size, (1, 1))
+
+            # The whole level is cut on the first request
+            self.assertFalse(os.path.exists(tile_path(self.image, top - 1, 1, 0)))
+            get_tile(self.image, top - 1, 0, 0)
+            self.assertTrue(os.path.exists(tile_path(self.image, top - 1, 1, 0)))
+
+            with self.assertRaises(ValueError):
+                get_tile(self.image, top, 3, 0)
+
+    def test_on_demand_render_is_capped_to_a_block(self):
+        with override_settings(TILE_SIZE=256, TILE_OVERLAP=1, TILE_CACHE_ROOT=self.root,
+                               TILE_RENDER_BLOCK=2):
+            top = max_level(600, 300)
+            get_tile(self.image, top, 2, 0)
+
+            # Columns 2-3 of block (1, 0): only column 2 exists
+            self.assertTrue(os.path.exists(tile_path(self.image, top, 2, 1)))
+            self.assertFalse(os.path.exists(tile_path(self.image, top, 0, 0)))
+            self.assertFalse(os.path.exists(tile_path(self.image, top, 1, 1)))
+            self.assertEqual(
+                [name for name in os.listdir(os.path.dirname(tile_path(self.image, top, 0, 0)))
+                 if name.startswith('.lock')],
+                []
+            )
+
+
+class RegionReaderTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+
+    def test_windows_follow_exif_orientation(self):
+        pixels = np.random.default_rng(0).integers(0, 255, (20, 40, 3), dtype=np.uint8)
+        img = PILImage.fromarray(pixels)
+        exif = img.getexif()
+        exif[0x0112] = 6
+        path = f'{self.root}/rotated.png'
+        img.save(path, exif=exif)
+
+        with override_settings(SAM_TILE_RASTER_DIR=self.root):
+            reader = RegionReader(path, 'cd' * 32)
+            self.assertEqual((reader.width, reader.height), (20, 40))
+
+            expected = np.asarray(ImageOps.exif_transpose(PILImage.open(path)).convert('RGB'))
+            np.testing.assert_array_equal(reader.read(0, 0, 20, 40), expected)
+            np.testing.assert_array_equal(reader.read(5, 30, 15, 40), expected[30:40, 5:15])
+
+    def test_uncompressed_tiff_is_read_in_place(self):
+        pixels = np.random.default_rng(1).integers(0, 255, (50, 30), dtype=np.uint8)
+        path = f'{self.root}/gray.tif'
+        PILImage.fromarray(pixels).save(path)
+        compressed = f'{self.root}/gray_lzw.tif'
+        PILImage.fromarray(pixels).save(compressed, compression='tiff_lzw')
+
+        with override_settings(SAM_TILE_RASTER_DIR=self.root):
+            reader = RegionReader(path, 'cd' * 32)
+            self.assertTrue(reader.windowed)
+            window = reader.read(3, 10, 13, 40)
+            self.assertEqual(window.shape, (30, 10, 3))
+            np.testing.assert_array_equal(window[:, :, 1], pixels[10:40, 3:13])
+
+            self.assertFalse(RegionReader(compressed, 'ce' * 32).windowed)
+
+    def test_tiled_region_is_capped(self):
+        with mock.patch.object(tiling, 'TILED_MAX_REGION_PIXELS', 100):
+            tiling.check_region((0, 0, 10, 10))
+            with self.assertRaises(tiling.RegionTooLarge):
+                tiling.presegment_tiled(None, 'cd' * 32, None, (0, 0, 10, 11))
+
+
+class MaskUploadTests(TestCase):
+
+    def test_rle_size_must_match_the_image(self):
+        mask = np.zeros((3, 4), dtype=bool)
+        mask[1:, 2] = True
+
+        np.testing.assert_array_equal(decode_rle(encode_rle(mask), expected_size=(3, 4)), mask)
+
+        with self.assertRaisesMessage(ValueError, 'RLE size must be [3, 4]'):
+            decode_rle({"size": [100000, 100000], "counts": [10000000000]}, expected_size=(3, 4))
+
+    def test_presegment_mask_of_rotated_jpeg_can_be_saved(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+
+        # Stored 400x300, displayed 300x400 (EXIF orientation 6)
+        path = f'{media}/rotated.jpg'
+        img = PILImage.new('RGB', (400, 300), 'white')
+        exif = img.getexif()
+        exif[0x0112] = 6
+        img.save(path, exif=exif)
+
+        user = User.objects.create_user('seg', password='x')
+        project = Project.objects.create(name='P', code='p1', created_by=user, storage_path=media)
+        dataset = Dataset.objects.create(
+            project=project, name='d1', code='d1', status='ACTIVE',
+            storage_path=media, created_by=user
+        )
+        image = Image.objects.create(
+            dataset=dataset, file_name='rotated.jpg', file_path=path,
+            width=400, height=300, file_size=1, checksum='ef' * 32
+        )
+        task = SegmentationTask.objects.create(
+            image=image, segmenter=user, assigned_to=user, status='ASSIGNED'
+        )
+
+        # What presegment returns for it: the embedding was computed on
+        # the displayed (portrait) decode
+        predictor = SimpleNamespace(
+            original_size=(1024, 768),
+            model=SimpleNamespace(mask_threshold=0.0),
+            predict=lambda **kwargs: (np.ones((1, 1024, 768), dtype=np.float32), None, None),
+        )
+        mask = predict_full_image(predictor, (image.height, image.width))
+        self.assertEqual(mask.shape, (400, 300))
+
+        self.client.force_login(user)
+        with override_settings(MEDIA_ROOT=media):
+            response = self.client.post(
+                f'/api/segmenter/task/{task.id}/save-mask/',
+                {"mask": encode_rle(mask), "mask_format": "rle", "metadata": {}},
+                content_type='application/json'
+            )
+
+        self.assertEqual(response.status_code, 200, response.content)
+        task.refresh_from_db()
+        self.assertEqual(PILImage.open(task.mask_path).size, (300, 400))
+
+
+class DecodedImageCacheTests(TestCase):
+
+    def test_least_recently_used_image_is_evicted(self):
+        image = np.zeros((10, 10, 3), dtype=np.uint8)
+        cache = image_io.DecodedImageCache(max_bytes=2 * image.nbytes)
+        loads = []
+
+        def get(key):
+            return cache.get_or_load(key, lambda: loads.append(key) or image.copy())
+
+        get('a')
+        get('b')
+        get('a')
+        get('c')
+        get('a')
+        get('b')
+
+        self.assertEqual(loads, ['a', 'b', 'c', 'b'])
+        self.assertEqual(cache.stats()["evictions"], 2)
+        self.assertEqual((cache.stats()["hits"], cache.stats()["misses"]), (2, 4))
+        self.assertFalse(get('a').flags.writeable)
+
+    def test_rewritten_file_is_decoded_again(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        path = f'{root}/image.png'
+        PILImage.new('RGB', (8, 6), 'black').save(path)
+
+        with mock.patch.object(image_io, 'decoded_cache', image_io.DecodedImageCache(10 ** 6)):
+            first = image_io.read_file_rgb(path)
+            self.assertIs(image_io.read_file_rgb(path), first)
+
+            PILImage.new('RGB', (8, 6), 'white').save(path)
+            mtime = os.stat(path).st_mtime_ns + 10 ** 9
+            os.utime(path, ns=(mtime, mtime))
+
+            second = image_io.read_file_rgb(path)
+            self.assertEqual((first.max(), second.min()), (0, 255))
+            self.assertEqual(image_io.decoded_cache.stats()["misses"], 2)
+
+
+class EmbeddingCacheTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+
+    @staticmethod
+    def embedding(value=0):
+        return ImageEmbedding(
+            features=np.full((1, 4, 2, 2), value, dtype=np.float16),
+            original_size=(30, 40),
+            input_size=(24, 32),
+        )
+
+    def cache(self, memory_entries, disk_bytes):
+        return EmbeddingCache(
+            namespace='test',
+            memory_bytes=memory_entries * self.embedding().nbytes,
+            disk_dir=self.root,
+            disk_bytes=disk_bytes,
+        )
+
+    def test_memory_tier_evicts_least_recently_used(self):
+        cache = self.cache(memory_entries=2, disk_bytes=0)
+        cache.put('a', self.embedding(1))
+        cache.put('b', self.embedding(2))
+        cache.get('a')
+        cache.put('c', self.embedding(3))
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a').features[0, 0, 0, 0], 1)
+        self.assertTrue(cache.contains('c'))
+
+        stats = cache.stats()
+        self.assertEqual(stats["memory_evictions"], 1)
+        self.assertEqual((stats["memory_hits"], stats["disk_hits"], stats["misses"]), (2, 0, 1))
+        self.assertEqual(stats["hit_rate"], round(2 / 3, 4))
+
+    def test_disk_tier_promotes_and_keeps_to_its_byte_budget(self):
+        cache = self.cache(memory_entries=1, disk_bytes=10 ** 9)
+        cache.put('a', self.embedding(1))
+        file_size = cache.stats()["disk_bytes"]
+
+        # Rewriting an entry does not count its file twice
+        cache.put('a', self.embedding(1))
+        self.assertEqual(cache.stats()["disk_bytes"], file_size)
+
+        cache.clear_memory()
+        self.assertEqual(cache.get('a').original_size, (30, 40))
+        self.assertEqual(cache.stats()["disk_hits"], 1)
+        cache.get('a')
+        self.assertEqual(cache.stats()["memory_hits"], 1)
+
+        # Room for two files: the least recently used one goes
+        cache.disk_bytes = int(file_size * 2.5)
+        cache.put('b', self.embedding(2))
+        past = time.time() - 60
+        os.utime(cache._disk_path('b'), (past, past))
+        os.utime(cache._disk_path('a'), (past + 1, past + 1))
+        cache.put('c', self.embedding(3))
+
+        self.assertFalse(os.path.exists(cache._disk_path('b')))
+        self.assertTrue(os.path.exists(cache._disk_path('a')))
+        self.assertEqual(cache.stats()["disk_bytes"], 2 * file_size)
+        self.assertEqual(cache.stats()["disk_evictions"], 1)
+
+    def test_corrupt_disk_entry_is_a_miss_and_removed(self):
+        cache = self.cache(memory_entries=1, disk_bytes=10 ** 9)
+        cache.put('a', self.embedding(1))
+        cache.clear_memory()
+        with open(cache._disk_path('a'), 'wb') as f:
+            f.write(b'not an npz')
+
+        self.assertIsNone(cache.get('a'))
+        self.assertFalse(os.path.exists(cache._disk_path('a')))
+        self.assertEqual(cache.stats()["misses"], 1)
+
+
+class InferenceSchedulerTests(TestCase):
+    """The scheduler's own logic, with the model and encoder stubbed out."""
+
+    def setUp(self):
+        self.encoded = []
+        cache = EmbeddingCache(namespace='test', memory_bytes=10 ** 6, disk_dir='', disk_bytes=0)
+
+        def encode(scheduler, predictor, loaders, jobs):
+            self.encoded.append(sorted(loaders))
+            embeddings = {}
+            for image_key, load_image in loaders.items():
+                load_image()
+                embeddings[image_key] = EmbeddingCacheTests.embedding()
+                cache.put(image_key, embeddings[image_key])
+            return embeddings
+
+        for patcher in (
+            mock.patch.object(sam, 'embedding_cache', cache),
+            mock.patch.object(sam, 'new_predictor', object),
+            mock.patch.object(sam, 'restore_embedding'),
+            mock.patch.object(InferenceScheduler, '_encode', autospec=True, side_effect=encode),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def scheduler(self, **kwargs):
+        options = dict(workers=1, max_queue_depth=8, max_batch_size=4, max_wait_ms=0)
+        options.update(kwargs)
+        scheduler = InferenceScheduler(**options)
+        self.addCleanup(scheduler.shutdown)
+        return scheduler
+
+    def test_queued_jobs_share_one_encoder_pass(self):
+        scheduler = self.scheduler(max_wait_ms=500)
+        futures = [
+            scheduler.submit(key, lambda: None, lambda predictor, key=key: key)
+            for key in ('a', 'b', 'a')
+        ]
+
+        self.assertEqual([future.result(timeout=5) for future in futures], ['a', 'b', 'a'])
+        self.assertEqual(self.encoded, [['a', 'b']])
+
+        # Cached now: decoder only, no encoder call
+        self.assertEqual(scheduler.run('a', lambda: None, lambda predictor: 'again'), 'again')
+        self.assertEqual(self.encoded, [['a', 'b']])
+
+        scheduler.shutdown()
+        stats = scheduler.stats()
+        self.assertEqual((stats["batches"], stats["jobs_done"]), (2, 4))
+
+    def test_image_encoded_by_another_worker_is_not_encoded_again(self):
+        scheduler = self.scheduler()
+        other_worker = threading.Event()
+        scheduler._encoding['a'] = other_worker
+
+        def finish():
+            sam.embedding_cache.put('a', EmbeddingCacheTests.embedding(1))
+            other_worker.set()
+
+        threading.Timer(0.05, finish).start()
+        embeddings = scheduler._encode_once(None, {'a': None, 'b': lambda: None}, [])
+
+        self.assertEqual(sorted(embeddings), ['a', 'b'])
+        self.assertEqual(embeddings['a'].features[0, 0, 0, 0], 1)
+        self.assertEqual(self.encoded, [['b']])
+
+        # The other worker failed: encode it here after all
+        scheduler._encoding['c'] = failed = threading.Event()
+        failed.set()
+        scheduler._encode_once(None, {'c': lambda: None}, [])
+        self.assertEqual(self.encoded, [['b'], [], ['c']])
+
+    def test_job_still_queued_after_its_timeout_is_cancelled(self):
+        scheduler = self.scheduler()
+        release = threading.Event()
+        ran = []
+
+        def blocking(predictor):
+            ran.append('first')
+            release.wait(5)
+
+        first = scheduler.submit('a', lambda: None, blocking)
+        while not ran:
+            time.sleep(0.01)
+
+        with self.assertRaises(SchedulerBusy):
+            scheduler.run('a', lambda: None, lambda predictor: ran.append('second'), queue_timeout=0.05)
+
+        release.set()
+        first.result(timeout=5)
+        scheduler.shutdown()
+
+        self.assertEqual(ran, ['first'])
+        self.assertEqual(scheduler.stats()["jobs_timed_out"], 1)
+
+
+class PromptInferenceTests(TestCase):
+    """Prompt decoding against an embedding computed from a reduced decode."""
+
+    def predictor(self, original_size):
+        h, w = original_size
+        logits = np.full((1, h, w), -1.0, dtype=np.float32)
+        logits[:, :, :w // 2] = 1.0
+        low_res = np.zeros((1, 256, 256), dtype=np.float32)
+        return SimpleNamespace(
+            original_size=original_size,
+            model=SimpleNamespace(mask_threshold=0.0),
+            predict=mock.Mock(return_value=(logits, np.array([0.9]), low_res)),
+        )
+
+    def test_prompts_are_scaled_to_the_embedding_and_mask_back(self):
+        predictor = self.predictor((150, 200))
+
+        mask, score, low_res = predict_from_prompts(
+            predictor,
+            points=np.array([[100, 60]], dtype=np.float32),
+            labels=np.array([1]),
+            boxes=np.array([[40, 20, 360, 280]], dtype=np.float32),
+            target_size=(300, 400),
+        )
+
+        kwargs = predictor.predict.call_args.kwargs
+        np.testing.assert_allclose(kwargs["point_coords"], [[50, 30]])
+        np.testing.assert_allclose(kwargs["box"], [20, 10, 180, 140])
+        self.assertEqual(mask.shape, (300, 400))
+        self.assertTrue(mask[:, :190].all())
+        self.assertFalse(mask[:, 210:].any())
+        self.assertAlmostEqual(score, 0.9, places=5)
+        self.assertEqual(low_res.shape, (1, 256, 256))
+
+    def test_full_size_embedding_leaves_prompts_alone(self):
+        predictor = self.predictor((300, 400))
+        predict_from_prompts(
+            predictor,
+            points=np.array([[100, 60]], dtype=np.float32),
+            labels=np.array([1]),
+            target_size=(300, 400),
+        )
+        np.testing.assert_allclose(predictor.predict.call_args.kwargs["point_coords"], [[100, 60]])
+
+    def test_output_size_follows_exif_rotation(self):
+        predictor = self.predictor((200, 150))
+        self.assertEqual(output_size(predictor, (300, 400)), (400, 300))
+        self.assertEqual(output_size(predictor, None), (200, 150))
+
+
+class AIEndpointTests(TestCase):
+    """AI views on the in-process path (no inference server)."""
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        path = f'{media}/image.jpg'
+        PILImage.new('RGB', (400, 300), 'white').save(path)
+
+        self.user = User.objects.create_user('seg', password='x')
+        project = Project.objects.create(name='P', code='p1', created_by=self.user, storage_path=media)
+        dataset = Dataset.objects.create(
+            project=project, name='d1', code='d1', status='ACTIVE',
+            storage_path=media, created_by=self.user
+        )
+        self.image = Image.objects.create(
+            dataset=dataset, file_name='image.jpg', file_path=path,
+            width=400, height=300, file_size=1, checksum='ab' * 32
+        )
+        self.task = SegmentationTask.objects.create(
+            image=self.image, segmenter=self.user, assigned_to=self.user, status='ASSIGNED'
+        )
+
+        patcher = mock.patch.object(server, 'get_client', return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client.force_login(self.user)
+
+    def test_full_queue_returns_503_with_retry_after(self):
+        # A scheduler whose workers never start: one queued job fills it
+        scheduler = InferenceScheduler(workers=1, max_queue_depth=1, max_batch_size=1, max_wait_ms=0)
+        with mock.patch.object(scheduler, '_ensure_started'), \
+                mock.patch.object(server, 'get_scheduler', return_value=scheduler):
+            scheduler.submit('cd' * 32, None, None)
+            response = self.client.get(f'/api/ai/presegment/{self.task.id}/')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], str(sam.RETRY_AFTER_SECONDS))
+        self.assertEqual(response.json()["retry_after"], sam.RETRY_AFTER_SECONDS)
+        self.assertEqual(scheduler.stats()["jobs_rejected"], 1)
+
+    def test_server_timing_header_and_stage_metrics(self):
+        registry.reset()
+        self.addCleanup(registry.reset)
+
+        def presegment(image):
+            with stage("inference_server"):
+                return np.ones((image.height, image.width), dtype=bool)
+
+        url = f'/api/ai/presegment/{self.task.id}/'
+        with mock.patch.object(server, 'presegment', side_effect=presegment):
+            with override_settings(SAM_SERVER_TIMING=True):
+                timed = self.client.get(url)
+            untimed = self.client.get(url)
+
+        self.assertEqual(timed.status_code, 200)
+        stages = {part.split(';')[0] for part in timed["Server-Timing"].split(', ')}
+        self.assertLessEqual({'total', 'inference_server'}, stages)
+        self.assertNotIn("Server-Timing", untimed)
+
+        operation = self.client.get('/api/ai/metrics/').json()["operations"]["presegment"]
+        self.assertEqual(operation["stages_ms"]["total"]["count"], 2)
+        self.assertEqual(operation["stages_ms"]["inference_server"]["count"], 2)
+        self.assertEqual(operation["image_megapixels"]["count"], 2)
+
+    def prompt(self, body, task=None):
+        task = task or self.task
+        return self.client.post(f'/api/ai/prompt/{task.id}/', body, content_type='application/json')
+
+    def test_invalid_prompts_are_rejected(self):
+        invalid = [
+            {},
+            {"points": [], "labels": []},
+            {"points": [[10, 10]], "labels": [1, 0]},
+            {"box": [0, 0, 10, 10], "boxes": [[0, 0, 10, 10]]},
+            {"points": [[10, 10]], "mask_input": "not-logits"},
+            {"boxes": [[0, 0, 10, 10], [5, 5, 20, 20]], "mask_input": "AAAA"},
+            {"points": [[10, 10]], "mask_format": "jpeg"},
+        ]
+        with mock.patch.object(server, 'prompt') as prompt:
+            for body in invalid:
+                response = self.prompt(body)
+                self.assertEqual(response.status_code, 400, body)
+                self.assertIn("error", response.json())
+        prompt.assert_not_called()
+
+    def test_prompt_returns_mask_and_logits_for_the_next_click(self):
+        logits = np.linspace(-1, 1, 256 * 256, dtype=np.float32).reshape(1, 256, 256)
+        mask = np.zeros((300, 400), dtype=bool)
+        mask[50:100, 60:120] = True
+
+        with mock.patch.object(server, 'prompt', return_value=(mask, 0.87654, logits)) as prompt:
+            first = self.prompt({"points": [[80, 70], [10, 10]], "labels": [1, 0], "mask_format": "rle"})
+            body = first.json()
+            second = self.prompt({
+                "points": [[90, 70]],
+                "box": [60, 50, 120, 100],
+                "mask_input": body["low_res_logits"],
+            })
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(body["score"], 0.8765)
+        np.testing.assert_array_equal(decode_rle(body["mask"]), mask)
+
+        prompts = prompt.call_args_list[0].args[1]
+        np.testing.assert_array_equal(prompts["points"], [[80, 70], [10, 10]])
+        np.testing.assert_array_equal(prompts["labels"], [1, 0])
+        self.assertIsNone(prompts["boxes"])
+        self.assertIsNone(prompts["mask_input"])
+
+        self.assertEqual(second.status_code, 200)
+        self.assertTrue(second.json()["mask"].startswith("data:image/png;base64,"))
+        prompts = prompt.call_args_list[1].args[1]
+        np.testing.assert_array_equal(prompts["labels"], [1])
+        np.testing.assert_array_equal(prompts["boxes"], [[60, 50, 120, 100]])
+        np.testing.assert_allclose(prompts["mask_input"], logits, atol=1e-3)
+
+    def test_prompt_on_a_task_assigned_to_someone_else_is_not_found(self):
+        other = User.objects.create_user('other', password='x')
+        task = SegmentationTask.objects.create(
+            image=self.image, segmenter=other, assigned_to=other, status='ASSIGNED'
+        )
+        with mock.patch.object(server, 'prompt') as prompt:
+            response = self.prompt({"points": [[10, 10]]}, task=task)
+        self.assertEqual(response.status_code, 404)
+        prompt.assert_not_called()
+
+    def test_busy_prompt_returns_503(self):
+        with mock.patch.object(server, 'prompt', side_effect=sam.InferenceBusy()):
+            response = self.prompt({"points": [[10, 10]]})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], str(sam.RETRY_AFTER_SECONDS))
+
+    def test_status_and_metrics_require_login(self):
+        self.client.logout()
+        for url in ('/api/ai/status/', '/api/ai/metrics/'):
+            self.assertEqual(self.client.get(url).status_code, 403, url)
+
+
+class ImmediateScheduler:
+    """InferenceScheduler stand-in that runs each job on submit."""
+
+    def __init__(self, **kwargs):
+        pass
+
+    def submit(self, key, load_image, run):
+        future = Future()
+        try:
+            future.set_result(run(None))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self):
+        pass
+
+
+class AutoSegmentationTests(TestCase):
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        settings_patch = override_settings(MEDIA_ROOT=media)
+        settings_patch.enable()
+        self.addCleanup(settings_patch.disable)
+
+        self.user = User.objects.create_user('seg', password='x')
+        project = Project.objects.create(name='P', code='p1', created_by=self.user, storage_path=media)
+        self.dataset = Dataset.objects.create(
+            project=project, name='d1', code='d1', status='ACTIVE',
+            storage_path=media, created_by=self.user
+        )
+
+    def make_task(self, index, width=40, height=30, **fields):
+        image = Image.objects.create(
+            dataset=self.dataset, file_name=f'{index}.jpg', file_path=f'/missing/{index}.jpg',
+            width=width, height=height, file_size=1, checksum=f'{index:064x}'
+        )
+        fields.setdefault('status', 'ASSIGNED')
+        return SegmentationTask.objects.create(image=image, segmenter=self.user, **fields)
+
+    def test_draft_is_written_once_and_never_over_a_saved_mask(self):
+        task = self.make_task(1)
+
+        self.assertTrue(auto_segmentation.write_draft_mask(task, b'draft'))
+        task.refresh_from_db()
+        self.assertEqual(task.mask_path, os.path.join(auto_segmentation.task_annotation_dir(task), 'mask.png'))
+        with open(task.mask_path, 'rb') as f:
+            self.assertEqual(f.read(), b'draft')
+
+        self.assertFalse(auto_segmentation.write_draft_mask(task, b'second'))
+        with open(task.mask_path, 'rb') as f:
+            self.assertEqual(f.read(), b'draft')
+        self.assertEqual(os.listdir(os.path.dirname(task.mask_path)), ['mask.png'])
+
+    def test_mask_is_in_place_before_the_task_points_at_it(self):
+        task = self.make_task(1)
+        real_replace = os.replace
+
+        def replace(src, dst):
+            self.assertFalse(SegmentationTask.objects.get(pk=task.pk).mask_path)
+            real_replace(src, dst)
+
+        with mock.patch.object(auto_segmentation.os, 'replace', side_effect=replace) as moved:
+            auto_segmentation.write_draft_mask(task, b'draft')
+        moved.assert_called_once()
+        task.refresh_from_db()
+        self.assertTrue(os.path.exists(task.mask_path))
+
+    def test_failed_move_leaves_the_task_to_be_resumed(self):
+        task = self.make_task(1)
+
+        with mock.patch.object(auto_segmentation.os, 'replace', side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                auto_segmentation.write_draft_mask(task, b'draft')
+
+        task.refresh_from_db()
+        self.assertFalse(task.mask_path)
+        self.assertEqual(os.listdir(auto_segmentation.task_annotation_dir(task)), [])
+        self.assertEqual(list(auto_segmentation.tasks_needing_draft(self.dataset)), [task])
+
+    def test_command_drafts_pending_tasks_and_resumes(self):
+        first = self.make_task(1)
+        shared = SegmentationTask.objects.create(image=first.image, segmenter=self.user, status='PENDING')
+        failing = self.make_task(2, width=80, height=60)
+        saved = self.make_task(3, mask_path='/saved/mask.png')
+        opened = self.make_task(4, status='IN_PROGRESS')
+
+        # The second image fails on the first run only
+        broken = [(failing.image.height, failing.image.width)]
+
+        def predict(predictor, size):
+            if size in broken:
+                raise RuntimeError("CUDA error")
+            return np.ones(size, dtype=bool)
+
+        with mock.patch.object(auto_segmentation, 'InferenceScheduler', ImmediateScheduler), \
+                mock.patch.object(auto_segmentation, 'predict_full_image', side_effect=predict):
+            out = io.StringIO()
+            call_command('auto_segment', 'd1', stdout=out)
+            self.assertIn('2 images without a mask', out.getvalue())
+            self.assertIn('2 draft masks written (0 skipped, 1 images failed)', out.getvalue())
+
+            broken.clear()
+            out = io.StringIO()
+            call_command('auto_segment', 'd1', stdout=out)
+            self.assertIn('1 images without a mask', out.getvalue())
+            self.assertIn('1 draft masks written (0 skipped, 0 images failed)', out.getvalue())
+
+        for task in (first, shared, failing):
+            task.refresh_from_db()
+            mask = PILImage.open(task.mask_path)
+            self.assertEqual(mask.size, (task.image.width, task.image.height))
+        saved.refresh_from_db()
+        opened.refresh_from_db()
+        self.assertEqual(saved.mask_path, '/saved/mask.png')
+        self.assertFalse(opened.mask_path)
+
+
+class InferenceServerProtocolTests(TestCase):
+
+    def test_prompt_and_result_round_trip(self):
+        image = server.ImageRef(7, '/tmp/a.jpg', 'ab' * 32, 300, 400)
+        logits = np.linspace(-4, 4, 256 * 256, dtype=np.float32).reshape(1, 256, 256)
+        prompts = {
+            "points": np.array([[10, 20], [30, 40]], dtype=np.float32),
+            "labels": np.array([1, 0], dtype=np.int64),
+            "boxes": None,
+            "mask_input": logits,
+            "multimask_output": True,
+        }
+
+        decoded_image, decoded = server.unpack_prompts(server.pack_prompts(image, prompts))
+
+        self.assertEqual(decoded_image, image)
+        np.testing.assert_array_equal(decoded["points"], prompts["points"])
+        np.testing.assert_array_equal(decoded["labels"], prompts["labels"])
+        self.assertIsNone(decoded["boxes"])
+        np.testing.assert_allclose(decoded["mask_input"], logits, atol=1e-2)
+        self.assertTrue(decoded["multimask_output"])
+
+        mask = np.zeros((3, 5), dtype=bool)
+        mask[1, 2:] = True
+        meta, data, decoded_mask = server.unpack_result(
+            server.pack_result({"score": 0.5}, mask, b"xy")
+        )
+        self.assertEqual((meta, data), ({"score": 0.5}, b"xy"))
+        np.testing.assert_array_equal(decoded_mask, mask)
+
+        _, _, no_mask = server.unpack_result(server.pack_result({"region": None}))
+        self.assertIsNone(no_mask)
+
+    @skipUnless(server.UNIX_SOCKETS_SUPPORTED, "needs Unix sockets")
+    def test_client_retries_a_connection_the_server_closed(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        path = f'{root}/sam.sock'
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(1)
+        self.addCleanup(listener.close)
+
+        def serve_once():
+            conn, _ = listener.accept()
+            with conn:
+                server.recv_frame(conn)
+                server.send_frame(conn, server.STATUS_OK, b'{"loaded": true}')
+
+        thread = threading.Thread(target=serve_once)
+        thread.start()
+
+        # A pooled connection from before a server restart
+        client = server.InferenceClient(path)
+        stale, peer = socket.socketpair()
+        peer.close()
+        client._local.sock = stale
+
+        self.assertEqual(client.health(), {"loaded": True})
+        thread.join()
+        client.close()
@@ -1,12 +1,24 @@
 from segmentation.api.segmenter_task import SubmitTaskAPIView, SaveMaskAPIView
 from django.urls import path
-from segmentation.api.admin import AdminBatchUploadAPIView
+from segmentation.api.admin import AdminBatchUploadAPIView, BatchStatusAPIView, BatchFilesAPIView
+from segmentation.api.chunked_upload import (
+    ChunkedUploadInitiateAPIView,
+    ChunkedUploadDetailAPIView,
+    ChunkedUploadPartAPIView,
+    ChunkedUploadCompleteAPIView,
+)
 from segmentation.api.common import ProjectListAPIView, DatasetListAPIView
 from segmentation.views import admin_batch_upload_page
 from segmentation.api.segmenter import MyTasksAPIView
 from segmentation.views import my_tasks_view, task_detail_view
 from segmentation.api.segmenter import TaskDetailAPIView
-from segmentation.api.ai import AIPreSegmentationAPIView
+from segmentation.api.tiles import ImageTileAPIView, ImageTilesDescriptorAPIView
+from segmentation.api.ai import (
+    AIPreSegmentationAPIView,
+    AIPromptAPIView,
+    AIModelStatusAPIView,
+    AIMetricsAPIView,
+)
 from segmentation.views import qa_tool_view 
 from segmentation.api.qa import QADecisionAPIView, QADashboardAPIView 
 from segmentation.views import qa_tool_view, qa_dashboard_view  
@@ -18,6 +30,38 @@ urlpatterns = [
         AdminBatchUploadAPIView.as_view(),
         name='admin-batch-upload'
     ),
+    path(
+        'api/admin/batches/<str:batch_id>/status/',
+        BatchStatusAPIView.as_view(),
+        name='batch-status'
+    ),
+    path(
+        'api/admin/batches/<str:batch_id>/files/',
+        BatchFilesAPIView.as_view(),
+        name='batch-files'
+    ),
+
+    # Resumable chunked uploads
+    path(
+        'api/admin/uploads/',
+        ChunkedUploadInitiateAPIView.as_view(),
+        name='chunked-upload-initiate'
+    ),
+    path(
+        'api/admin/uploads/<str:upload_id>/',
+        ChunkedUploadDetailAPIView.as_view(),
+        name='chunked-upload-detail'
+    ),
+    path(
+        'api/admin/uploads/<str:upload_id>/parts/<int:part_number>/',
+        ChunkedUploadPartAPIView.as_view(),
+        name='chunked-upload-part'
+    ),
+    path(
+        'api/admin/uploads/<str:upload_id>/complete/',
+        ChunkedUploadCompleteAPIView.as_view(),
+        name='chunked-upload-complete'
+    ),
 
     # Project & Dataset APIs
     path(
@@ -72,6 +116,36 @@ urlpatterns = [
         name="ai-presegment"
     ),
 
+    path(
+        "api/ai/prompt/<int:task_id>/",
+        AIPromptAPIView.as_view(),
+        name="ai-prompt"
+    ),
+
+    path(
+        "api/ai/status/",
+        AIModelStatusAPIView.as_view(),
+        name="ai-status"
+    ),
+
+    path(
+        "api/ai/metrics/",
+        AIMetricsAPIView.as_view(),
+        name="ai-metrics"
+    ),
+
+    # Deep Zoom tiles (URL layout: <name>.dzi + <name>_files/<level>/<col>_<row>.jpg)
+    path(
+        'api/images/<int:image_id>/tiles.dzi',
+        ImageTilesDescriptorAPIView.as_view(),
+        name='image-tiles'
+    ),
+    path(
+        'api/images/<int:image_id>/tiles_files/<int:level>/<int:col>_<int:row>.jpg',
+        ImageTileAPIView.as_view(),
+        name='image-tile'
+    ),
+
 
     path('api/qa/task/<int:task_id>/decision/', QADecisionAPIView.as_view(), name='qa_decision'),
     path('qa/task/<int:task_id>/', qa_tool_view, name='qa_tool_page'),
@@ -0,0 +1,175 @@
+import base64
+import json
+
+import cv2
+import numpy as np
+
+from segmentation.utils.metrics import stage
+
+# Values accepted in the `mask_format` request field
+MASK_FORMAT_PNG = 'png'
+MASK_FORMAT_RLE = 'rle'
+MASK_FORMATS = (MASK_FORMAT_PNG, MASK_FORMAT_RLE)
+
+
+# --------------------------------------------------
+# COCO run-length encoding
+#
+# Same layout as pycocotools: the mask is scanned column-major and
+# counts alternate 0-runs / 1-runs, starting with a (possibly empty)
+# 0-run. counts is a list of ints, or the compact COCO string form.
+# --------------------------------------------------
+def encode_rle(mask, compressed=False):
+    """
+    Binary mask (h, w) -> {"size": [h, w], "counts": [...] or str}
+    """
+    mask = np.asarray(mask)
+    h, w = mask.shape
+    flat = mask.ravel(order='F').astype(bool, copy=False)
+
+    if flat.size == 0:
+        counts = np.zeros(0, dtype=np.int64)
+    else:
+        changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        boundaries = np.concatenate(([0], changes, [flat.size]))
+        counts = np.diff(boundaries)
+        if flat[0]:
+            counts = np.concatenate(([0], counts))
+
+    counts = counts.tolist()
+    return {
+        "size": [int(h), int(w)],
+        "counts": _counts_to_string(counts) if compressed else counts,
+    }
+
+
+def decode_rle(rle, expected_size=None):
+    """
+    {"size": [h, w], "counts": [...] or str} -> bool mask (h, w)
+
+    expected_size (h, w): reject any other size before decoding, so a
+    client-supplied size cannot make the decode allocate arbitrary
+    memory. (w, h) is accepted too: Image.width / height are the stored
+    file's, and the AI returns masks of EXIF-rotated images in the
+    displayed orientation (see inference.output_size).
+    Raises ValueError on malformed input.
+    """
+    try:
+        h, w = (int(v) for v in rle["size"])
+        counts = rle["counts"]
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("RLE must have 'size' [h, w] and 'counts'")
+
+    if expected_size is not None and (h, w) not in (tuple(expected_size), tuple(expected_size)[::-1]):
+        raise ValueError(f"RLE size must be {list(expected_size)}")
+
+    if isinstance(counts, str):
+        counts = _counts_from_string(counts)
+
+    counts = np.asarray(counts, dtype=np.int64)
+    if counts.ndim != 1 or (counts < 0).any() or counts.sum() != h * w:
+        raise ValueError("RLE counts do not match mask size")
+
+    values = np.zeros(len(counts), dtype=bool)
+    values[1::2] = True
+
+    return np.repeat(values, counts).reshape((h, w), order='F')
+
+
+def _counts_to_string(counts):
+    chars = []
+    for i, x in enumerate(counts):
+        if i > 2:
+            x -= counts[i - 2]
+        more = True
+        while more:
+            c = x & 0x1f
+            x >>= 5
+            more = (x != -1) if (c & 0x10) else (x != 0)
+            if more:
+                c |= 0x20
+            chars.append(chr(c + 48))
+    return ''.join(chars)
+
+
+def _counts_from_string(s):
+    counts = []
+    p = 0
+    while p < len(s):
+        x = 0
+        k = 0
+        more = True
+        while more:
+            if p >= len(s):
+                raise ValueError("Truncated RLE string")
+            c = ord(s[p]) - 48
+            x |= (c & 0x1f) << (5 * k)
+            more = bool(c & 0x20)
+            p += 1
+            k += 1
+            if not more and (c & 0x10):
+                x |= -1 << (5 * k)
+        if len(counts) > 2:
+            x += counts[-2]
+        counts.append(x)
+    return counts
+
+
+# --------------------------------------------------
+# PNG data URLs
+# --------------------------------------------------
+def encode_mask_png(mask):
+    """Bool / 0-1 mask -> base64 PNG data URL"""
+    with stage("imencode"):
+        _, buffer = cv2.imencode(".png", np.asarray(mask, dtype=np.uint8) * 255)
+    with stage("base64"):
+        mask_base64 = base64.b64encode(buffer).decode("utf-8")
+    return f"data:image/png;base64,{mask_base64}"
+
+
+# --------------------------------------------------
+# Request / response helpers
+# --------------------------------------------------
+def requested_mask_format(value):
+    value = (value or MASK_FORMAT_PNG).lower()
+    if value not in MASK_FORMATS:
+        raise ValueError(f"mask_format must be one of: {', '.join(MASK_FORMATS)}")
+    return value
+
+
+def encode_mask(mask, mask_format):
+    """Mask -> response payload in the negotiated format."""
+    if mask_format == MASK_FORMAT_RLE:
+        with stage("rle"):
+            return encode_rle(mask)
+    return encode_mask_png(mask)
+
+
+def mask_upload_to_png(mask_data, mask_format=None, image_size=None):
+    """
+    Uploaded mask -> PNG bytes to store as mask.png.
+
+    PNG data URLs are written as-is (no decode / re-encode). RLE is
+    accepted as a dict, or with mask_format='rle' also as a JSON
+    string, and encoded once to a 0/255 grayscale PNG; its size must
+    equal image_size (h, w), or its transpose, when given.
+    Raises ValueError on malformed input.
+    """
+    if isinstance(mask_data, dict) or mask_format == MASK_FORMAT_RLE:
+        if isinstance(mask_data, str):
+            try:
+                mask_data = json.loads(mask_data)
+            except json.JSONDecodeError:
+                raise ValueError("Invalid RLE mask")
+
+        mask = decode_rle(mask_data, expected_size=image_size)
+        ok, buffer = cv2.imencode(".png", mask.astype(np.uint8) * 255)
+        if not ok:
+            raise ValueError("Could not encode mask")
+        return buffer.tobytes()
+
+    if not isinstance(mask_data, str):
+        raise ValueError("Invalid mask data format")
+
+    header, encoded = mask_data.split(",", 1)
+    return base64.b64decode(encoded)
@@ -19,3 +19,32 @@ def media_path_to_url(file_path: str) -> str:
     relative_path = file_path[len(media_root):].lstrip(os.sep)
 
     return settings.MEDIA_URL + relative_path.replace(os.sep, "/")
+
+
+def blob_root() -> str:
+    """Root of the content-addressed image store."""
+    return getattr(settings, "BLOB_STORE_ROOT", None) or os.path.join(settings.MEDIA_ROOT, "blobs")
+
+
+def blob_path(root: str, checksum: str, ext: str) -> str:
+    """
+    Where the file with this SHA256 lives: two levels of 256-way
+    fan-out keep directories small at millions of files.
+    """
+    return os.path.join(root, checksum[:2], checksum[2:4], checksum + ext)
+
+
+def preview_urls(image) -> dict:
+    """MEDIA URLs of an image's preview levels, by longest side."""
+    return {
+        size: media_path_to_url(path)
+        for size, path in sorted(image.previews.items(), key=lambda item: int(item[0]))
+    }
+
+
+def thumbnail_url(image) -> str:
+    """Smallest preview of the image, or the original if it has none."""
+    if image.previews:
+        size = min(image.previews, key=int)
+        return media_path_to_url(image.previews[size])
+    return media_path_to_url(image.file_path)
@@ -0,0 +1,231 @@
+"""
+Per-stage latency instrumentation.
+
+A request creates a StageTimings and activates it; code on the hot
+path wraps its work in `with stage("name"):`, which adds the elapsed
+time to whatever StageTimings is active in the current context and is
+a no-op otherwise. Work handed to another thread (the inference
+scheduler) carries the request's timings along and re-activates them
+there.
+
+Finished requests are recorded into process-wide histograms, read by
+the metrics endpoint.
+"""
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+
+# Upper bounds of the latency buckets, milliseconds
+LATENCY_BUCKETS_MS = (
+    1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000
+)
+
+# Upper bounds of the image size buckets, megapixels
+MEGAPIXEL_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128, 512)
+
+_active = ContextVar("stage_timings", default=None)
+
+
+def server_timing_enabled():
+    return getattr(settings, "SAM_SERVER_TIMING", False)
+
+
+class StageTimings:
+    """Stage -> milliseconds for one request. Thread-safe."""
+
+    def __init__(self):
+        self.stages = {}
+        self.image_size = None
+        self._lock = threading.Lock()
+
+    def add(self, name, ms):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + ms
+
+    def set_image_size(self, height, width):
+        self.image_size = (height, width)
+
+    def record(self, operation):
+        registry.record(operation, self)
+
+    def server_timing(self):
+        """Server-Timing header value."""
+        with self._lock:
+            return ", ".join(
+                f"{name};dur={ms:.1f}" for name, ms in self.stages.items()
+            )
+
+
+class FanOut:
+    """Adds every stage to several StageTimings (jobs sharing work)."""
+
+    def __init__(self, timings):
+        self.timings = [t for t in timings if t is not None]
+
+    def add(self, name, ms):
+        for timings in self.timings:
+            timings.add(name, ms)
+
+    def set_image_size(self, height, width):
+        for timings in self.timings:
+            timings.set_image_size(height, width)
+
+
+@contextmanager
+def activate(timings):
+    token = _active.set(timings)
+    try:
+        yield timings
+    finally:
+        _active.reset(token)
+
+
+def current():
+    return _active.get()
+
+
+@contextmanager
+def stage(name):
+    timings = _active.get()
+    if timings is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, (time.perf_counter() - start) * 1000.0)
+
+
+def note_image_size(height, width):
+    timings = _active.get()
+    if timings is not None:
+        timings.set_image_size(height, width)
+
+
+# --------------------------------------------------
+# Histograms
+# --------------------------------------------------
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile."""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return self.buckets[i] if i < len(self.buckets) else None
+        return None
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 2),
+            "mean": round(self.sum / self.count, 2) if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": {
+                **{str(bound): n for bound, n in zip(self.buckets, self.counts)},
+                "+Inf": self.counts[-1],
+            },
+        }
+
+
+class MetricsRegistry:
+    """operation -> stage latency histograms + image size histogram."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latency = {}
+        self._image_megapixels = {}
+
+    def record(self, operation, timings):
+        with timings._lock:
+            stages = dict(timings.stages)
+
+        with self._lock:
+            histograms = self._latency.setdefault(operation, {})
+            for name, ms in stages.items():
+                if name not in histograms:
+                    histograms[name] = Histogram(LATENCY_BUCKETS_MS)
+                histograms[name].observe(ms)
+
+            if timings.image_size:
+                h, w = timings.image_size
+                if operation not in self._image_megapixels:
+                    self._image_megapixels[operation] = Histogram(MEGAPIXEL_BUCKETS)
+                self._image_megapixels[operation].observe(h * w / 1e6)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                operation: {
+                    "stages_ms": {
+                        name: histogram.snapshot()
+                        for name, histogram in histograms.items()
+                    },
+                    "image_megapixels": (
+                        self._image_megapixels[operation].snapshot()
+                        if operation in self._image_megapixels else None
+                    ),
+                }
+                for operation, histograms in self._latency.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._latency.clear()
+            self._image_megapixels.clear()
+
+
+registry = MetricsRegistry()
+
+
+# --------------------------------------------------
+# Process memory
+# --------------------------------------------------
+def peak_rss_kb():
+    """
+    Peak resident set size of this process in KiB, or None where it
+    cannot be measured: `resource` on Unix, psutil (when installed)
+    elsewhere.
+    """
+    try:
+        import resource
+    except ImportError:
+        pass
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS reports bytes, Linux KiB
+        return peak // 1024 if sys.platform == "darwin" else peak
+
+    try:
+        import psutil
+    except ImportError:
+        return None
+    info = psutil.Process().memory_info()
+    return getattr(info, "peak_wset", info.rss) // 1024